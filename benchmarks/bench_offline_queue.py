@@ -0,0 +1,102 @@
+# Measure OfflineQueue (SQLite backend) throughput under concurrent writers.
+# python benchmarks/bench_offline_queue.py --> 8 writers x 500 items
+# python benchmarks/bench_offline_queue.py --writers 16 --items 1000 --batch 200
+#
+# Compares, on a temporary database file:
+# - legacy: new connection + commit per item, SELECT + DELETE per dequeue (the previous implementation)
+# - enqueue / dequeue: shared WAL connection, one item per call
+# - enqueue_many / dequeue_batch: shared WAL connection, one transaction per batch
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+os.environ.pop("DATABRICKS_RUNTIME_VERSION", None)
+from modules import OfflineQueue
+
+PAYLOAD = {"message_id": "01f0a1b2c3d4", "conversation_id": "01f0a1b2c3d5", "space_id": "01f0", "user_id": "123",
+           "prompt": "How many vins are by region?", "completion": "Counts of vins per region.",
+           "user_attachment": None, "assistant_attachment": "SELECT region, count(*) FROM vins GROUP BY region",
+           "created_timestamp": "2025-01-01T00:00:00", "operation": "insert_message"}
+
+class LegacyQueue:
+    """Previous behaviour: connect and commit for every call."""
+    def __init__(self, sqlite_file: str):
+        self.sqlite_file = sqlite_file
+        conn = sqlite3.connect(sqlite_file, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS pending (id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+        conn.commit()
+        conn.close()
+
+    def enqueue(self, payload: dict):
+        conn = sqlite3.connect(self.sqlite_file, timeout=30)
+        conn.execute("INSERT INTO pending (payload) VALUES (?)", (json.dumps(payload),))
+        conn.commit()
+        conn.close()
+
+    def dequeue(self):
+        conn = sqlite3.connect(self.sqlite_file, timeout=30)
+        row = conn.execute("SELECT id, payload FROM pending ORDER BY id ASC LIMIT 1").fetchone()
+        if not row:
+            conn.close()
+            return None
+        conn.execute("DELETE FROM pending WHERE id = ?", (row[0],))
+        conn.commit()
+        conn.close()
+        return json.loads(row[1])
+
+def timed_writers(writers: int, work) -> float:
+    threads = [threading.Thread(target=work) for _ in range(writers)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def drain(dequeue) -> tuple:
+    count, start = 0, time.perf_counter()
+    while True:
+        items = dequeue()
+        if not items:
+            return count, time.perf_counter() - start
+        count += len(items)
+
+def run(writers: int, items: int, batch: int):
+    total = writers * items
+    print(f"{writers} writers x {items} items, batch {batch}")
+    print(f"{'mode':<28} {'enqueue/s':>12} {'dequeue/s':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = LegacyQueue(os.path.join(tmp, "legacy.db"))
+        enq = timed_writers(writers, lambda: [legacy.enqueue(PAYLOAD) for _ in range(items)])
+        count, deq = drain(lambda: [item] if (item := legacy.dequeue()) else [])
+        print(f"{'legacy (connect per call)':<28} {total / enq:>12,.0f} {count / deq:>12,.0f}")
+
+        queue = OfflineQueue(sqlite_file=os.path.join(tmp, "single.db"))
+        enq = timed_writers(writers, lambda: [queue.enqueue(PAYLOAD) for _ in range(items)])
+        count, deq = drain(lambda: [item] if (item := queue.dequeue()) else [])
+        print(f"{'enqueue / dequeue':<28} {total / enq:>12,.0f} {count / deq:>12,.0f}")
+        queue.close()
+
+        queue = OfflineQueue(sqlite_file=os.path.join(tmp, "batch.db"))
+        def batched():
+            for start in range(0, items, batch):
+                queue.enqueue_many([PAYLOAD] * min(batch, items - start))
+        enq = timed_writers(writers, batched)
+        count, deq = drain(lambda: queue.dequeue_batch(batch))
+        print(f"{'enqueue_many / dequeue_batch':<28} {total / enq:>12,.0f} {count / deq:>12,.0f}")
+        queue.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark OfflineQueue enqueue/dequeue throughput.")
+    parser.add_argument("--writers", type=int, default=8, help="Concurrent writer threads")
+    parser.add_argument("--items", type=int, default=500, help="Items per writer")
+    parser.add_argument("--batch", type=int, default=100, help="Batch size for enqueue_many / dequeue_batch")
+    args = parser.parse_args()
+    run(args.writers, args.items, args.batch)
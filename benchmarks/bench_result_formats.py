@@ -0,0 +1,149 @@
+# Compare client-side decode cost of the statement execution result formats.
+# python benchmarks/bench_result_formats.py --> 10k, 100k and 1M rows
+# python benchmarks/bench_result_formats.py --rows 10000 --repeat 5
+#
+# Payloads are built locally to mirror what the warehouse sends (CHUNK_ROWS per chunk), so no workspace is needed.
+# Each format goes through the app's own code in genie_room, with the Genie client and the HTTP session served
+# from memory:
+# - JSON_ARRAY: every value as a string, parsed and typed by fetch_json_chunks (build_typed_dataframe)
+# - CSV: text with header row, streamed by fetch_external_chunks into download_csv
+# - ARROW_STREAM: Arrow IPC stream, streamed by fetch_external_chunks into download_arrow (read_arrow_stream)
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import genie_room
+from genie_room import download_arrow, download_csv, fetch_external_chunks, fetch_json_chunks
+
+logging.getLogger("genie_room").setLevel(logging.WARNING)  # No per-statement chunk logs in the table
+
+CHUNK_ROWS = 100_000  # Rows per result chunk
+SCHEMA_TYPES = {pa.int64(): "LONG", pa.int32(): "INT", pa.float64(): "DOUBLE", pa.string(): "STRING"}
+
+def build_table(rows: int) -> pa.Table:
+    """Synthetic result set shaped like a typical Genie answer: ids, measures, dimensions and dates."""
+    rng = np.random.default_rng(42)
+    return pa.table({
+        "vin_id": pa.array(np.arange(rows, dtype=np.int64)),
+        "model_year": pa.array(rng.integers(2010, 2026, rows).astype(np.int32)),
+        "price": pa.array(rng.normal(35000, 8000, rows)),
+        "region": pa.array(rng.choice(["EMEA", "NA", "LATAM", "APAC"], rows)),
+        "model": pa.array(rng.choice([f"model_{i}" for i in range(40)], rows)),
+        "sold_at": pa.array(pd.date_range("2020-01-01", periods=rows, freq="min")),
+    })
+
+def schema_columns(table: pa.Table) -> list:
+    """Manifest schema columns of the table, in their dict form."""
+    return [{"name": field.name, "type_name": SCHEMA_TYPES.get(field.type, "TIMESTAMP")} for field in table.schema]
+
+def chunks(table: pa.Table) -> list:
+    return [table.slice(start, CHUNK_ROWS) for start in range(0, table.num_rows, CHUNK_ROWS)]
+
+def to_json_array(table: pa.Table) -> list:
+    payloads = []
+    for chunk in chunks(table):
+        columns = [chunk.column(i).to_pylist() for i in range(chunk.num_columns)]
+        rows = [[None if v is None else v.isoformat() if hasattr(v, "isoformat") else str(v) for v in row] for row in zip(*columns)]
+        payloads.append(json.dumps({"data_array": rows}).encode("utf-8"))
+    return payloads
+
+def to_csv(table: pa.Table) -> list:
+    return [chunk.to_pandas().to_csv(index=False).encode("utf-8") for chunk in chunks(table)]
+
+def to_arrow_stream(table: pa.Table) -> list:
+    payloads = []
+    for chunk in chunks(table):
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, chunk.schema) as writer:
+            writer.write_table(chunk)
+        payloads.append(sink.getvalue().to_pybytes())
+    return payloads
+
+class MemoryClient:
+    """Stands in for AsyncGenieClient.get_chunk. JSON chunks are parsed here, as the SDK does on arrival;
+    external chunks are links served by MemorySession."""
+    def __init__(self, payloads: list, inline: bool):
+        self.payloads = payloads
+        self.inline = inline
+
+    async def get_chunk(self, statement_id: str, idx: int):
+        if self.inline:
+            return SimpleNamespace(data_array=json.loads(self.payloads[idx])["data_array"])
+        link = SimpleNamespace(chunk_index=idx, external_link=f"memory://{idx}", http_headers=None, expiration=None)
+        return SimpleNamespace(external_links=[link])
+
+class MemoryResponse:
+    def __init__(self, payload: bytes):
+        self.raw = BytesIO(payload)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+class MemorySession:
+    """Stands in for genie_room.download_session: serves the chunk payloads as streamed responses."""
+    def __init__(self, payloads: list):
+        self.payloads = payloads
+
+    def get(self, url: str, headers=None, stream=True, timeout=None):
+        return MemoryResponse(self.payloads[int(url.rsplit("/", 1)[-1])])
+
+def statement(payloads: list, inline: bool):
+    """Statement response as the app gets it: manifest chunk count, first JSON chunk inline."""
+    result = SimpleNamespace(data_array=json.loads(payloads[0])["data_array"]) if inline else SimpleNamespace(external_links=[])
+    return SimpleNamespace(manifest=SimpleNamespace(total_chunk_count=len(payloads)), result=result)
+
+def decode_json_array(payloads: list, columns: list) -> pd.DataFrame:
+    client = MemoryClient(payloads, inline=True)
+    return asyncio.run(fetch_json_chunks(client, "bench", statement(payloads, inline=True), columns))
+
+def decode_external(download):
+    def decode(payloads: list, columns: list) -> pd.DataFrame:
+        genie_room.download_session = MemorySession(payloads)
+        client = MemoryClient(payloads, inline=False)
+        return asyncio.run(fetch_external_chunks(client, "bench", statement(payloads, inline=False), download=download))
+    return decode
+
+FORMATS = {
+    "JSON_ARRAY": (to_json_array, decode_json_array),
+    "CSV": (to_csv, decode_external(download_csv)),
+    "ARROW_STREAM": (to_arrow_stream, decode_external(download_arrow)),
+}
+
+def run(rows_list, repeat: int):
+    print(f"{'rows':>9} {'format':<13} {'payload MB':>10} {'decode s':>9} {'rows/s':>12} {'frame MB':>9}")
+    for rows in rows_list:
+        table = build_table(rows)
+        for name, (encode, decode) in FORMATS.items():
+            payloads = encode(table)
+            best = float("inf")
+            for _ in range(repeat):
+                start = time.perf_counter()
+                df = decode(payloads, schema_columns(table))
+                best = min(best, time.perf_counter() - start)
+            frame_mb = df.memory_usage(deep=True).sum() / 1e6
+            print(f"{rows:>9} {name:<13} {sum(map(len, payloads)) / 1e6:>10.1f} {best:>9.3f} {rows / best:>12,.0f} {frame_mb:>9.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark JSON_ARRAY vs CSV vs ARROW_STREAM result decoding.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per format, best time is reported")
+    args = parser.parse_args()
+    run(args.rows, args.repeat)
@@ -3,12 +3,11 @@
 # Uncomment the last lines to run the reprocessing.
 
 import logging
-import time
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 from databricks import sql
-from modules import OfflineQueue
+from modules import OfflineQueue, PersistenceStatements
 
 # Load environment variables
 load_dotenv()
@@ -18,179 +17,99 @@ DATABRICKS_TOKEN = os.environ.get("DATABRICKS_TOKEN")
 HTTP_PATH = os.environ.get("HTTP_PATH")
 CATALOG = os.environ.get("CATALOG")
 SCHEMA = os.environ.get("SCHEMA")
-RETRY_DELAY = 10  # seconds between items
-MAX_RETRIES = 3 # max retries per item
+MAX_RETRIES = 3 # max retries per item, then it goes to the dead letter store
+BATCH_SIZE = 500 # items drained from the queue per round
+
+def retry(queue, items, err):
+    """Schedule failed items for a later attempt (exponential backoff), dead-lettering those past MAX_RETRIES."""
+    dead = queue.retry(items, err, max_retries=MAX_RETRIES)
+    for item in (i for i in items if i["attempts"] <= MAX_RETRIES):
+        logging.warning(f"Retry {item['attempts']}/{MAX_RETRIES} for {item.get('operation')} item at {datetime.fromtimestamp(item['next_attempt_at']):%H:%M:%S} — {err}")
+    if dead:
+        logging.error(f"FAILED permanently: {dead} {items[0].get('operation')} items moved to dead letter: {err}")
+
+def apply_group(statements, cursor, queue, op, group) -> int:
+    """Apply one operation group with a single statement per table and ack it. If that fails, apply its items one
+    by one so a bad item doesn't hold back the rest. Returns how many items were applied."""
+    try:
+        statements.apply(cursor, op, group)
+        queue.ack(group)
+        logging.info(f"[OK] {op}: {len(group)} items")
+        return len(group)
+    except Exception as err:
+        if len(group) == 1:
+            retry(queue, group, err)
+            return 0
+        logging.warning(f"Batch {op} of {len(group)} items failed, retrying item by item — {err}")
+
+    applied = 0
+    for item in group:
+        try:
+            statements.apply(cursor, op, [item])
+            queue.ack([item])
+            applied += 1
+        except Exception as err:
+            retry(queue, [item], err)
+    logging.info(f"[OK] {op}: {applied}/{len(group)} items")
+    return applied
 
-def reprocess_offline_queue(queue, host, token, http_path, catalog, schema):
+def reprocess_offline_queue(queue, host, token, http_path, catalog, schema, batch_size=BATCH_SIZE):
     """
     Reprocess failed SQL operations from the offline queue.
     Designed to be triggered manually (local) or by a Databricks Job (prod).
+    Items are claimed in batches, grouped by operation and applied with one MERGE per table over a single
+    connection, then acked. Several reprocessors (processes or job tasks) can run at once: each claims its own
+    items under a lease, and items of one that dies are claimed again once the lease expires. MERGE keys make
+    those replays idempotent.
+    Returns False if it stopped early because the warehouse rejected a whole batch, True otherwise.
     """
     logging.info("Starting offline queue reprocessing...")
-
-    while True:
-        item = queue.dequeue()
-        if not item:
-            logging.info("Queue is empty. Nothing to reprocess.")
-            break
-
-        op = item.get("operation")
-        conversation_id = item.get("conversation_id")
-        message_id = item.get("message_id")
-        search_timestamp = item.get("created_timestamp")
-
-        try:
-            with sql.connect(
-                server_hostname=host,
-                http_path=http_path,
-                access_token=token
-            ) as conn:
-                cursor = conn.cursor()
-
-                ### Insert operations ###
-                # New conversation + initial messages
-                if op == "insert_new_conversation":
-                    
-                    # Check duplicates for conversations to insert
-                    cursor.execute(
-                        f"SELECT 1 FROM {catalog}.{schema}.conversations WHERE conversation_id = ?", 
-                        (conversation_id,)
-                    )
-                    exists_convs = cursor.fetchone()
-
-                    if exists_convs:
-                        logging.info(f"[SKIP] Conversation {conversation_id} already exists.")
-                        continue
-
-                    # Perform insert for conversations queued
-                    cursor.execute(f"""
-                                    INSERT INTO {catalog}.{schema}.conversations
-                                    (space_id, conversation_id, user_id, chat_title, ai_title, created_timestamp)
-                                    VALUES (?, ?, ?, ?, ?, ?)
-                                    """, (item["space_id"], item["conversation_id"], item["user_id"], item["chat_title"], None, datetime.fromisoformat(item["created_timestamp"])))
-                    logging.info(f"[OK] Insert retried: {conversation_id}")
-
-                    # Perform insert for initial messages queued
-                    cursor.execute(f"""
-                                    INSERT INTO {catalog}.{schema}.messages
-                                    (message_id, conversation_id, space_id, user_id, prompt, completion, user_attachment, assistant_attachment, created_timestamp, rating, sql_run_version)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                    """, (item["message_id"], item["conversation_id"], item["space_id"], item["user_id"], item["prompt"], item["completion"], item["user_attachment"], item["assistant_attachment"], datetime.fromisoformat(item["created_timestamp"]), None, 1))
-                    logging.info(f"[OK] Insert retried: {message_id}")
-
-                # Follow up messages
-                elif op == "insert_message":
-                    # Check duplicates for messages to insert
-                    cursor.execute(
-                        f"SELECT 1 FROM {catalog}.{schema}.messages WHERE message_id = ?",
-                        (message_id,)
-                    )
-                    exists_mssgs = cursor.fetchone()
-
-                    if exists_mssgs:
-                        logging.info(f"[SKIP] Message {message_id} already exists.")
-                        continue
-
-                    # Perform insert for follow up messages queued
-                    cursor.execute(f"""
-                                    INSERT INTO {catalog}.{schema}.messages
-                                    (message_id, conversation_id, space_id, user_id, prompt, completion, user_attachment, assistant_attachment, created_timestamp, rating, sql_run_version)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                    """, (item["message_id"], item["conversation_id"], item["space_id"], item["user_id"], item["prompt"], item["completion"], item["user_attachment"], item["assistant_attachment"], datetime.fromisoformat(item["created_timestamp"]), None, 1))
-                    logging.info(f"[OK] Insert retried: {message_id}")
-
-                # Similarity search
-                elif op == "insert_similar_search":
-                    # Check duplicates for messages to insert
-                    cursor.execute(
-                        f"SELECT 1 FROM {catalog}.{schema}.similarity_search WHERE created_timestamp = ?",
-                        (search_timestamp,)
-                    )
-                    exists_search = cursor.fetchone()
-
-                    if exists_search:
-                        logging.info(f"[SKIP] Search at timestamp {search_timestamp} already exists.")
-                        continue
-
-                    # Perform insert for messages queued
-                    cursor.execute(f"""
-                                    INSERT INTO {catalog}.{schema}.similarity_search
-                                    (space_id, message_id, user_id, user_name, user_email, prompt, completion, score, created_timestamp)
-                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                    """, (item["space_id"], item["message_id"], item["user_id"], item["user_name"], item["user_email"], item["prompt"], item["completion"], item["score"], item["created_timestamp"]))
-                    logging.info(f"[OK] Insert retried: {search_timestamp}")
-
-                ### Delete operations ###
-                elif op == "delete":
-                    # Check duplicates for conversations to delete
-                    cursor.execute(
-                        f"SELECT 1 FROM {catalog}.{schema}.conversations WHERE conversation_id = ?",
-                        (conversation_id,)
-                    )
-                    exists_convers = cursor.fetchone()
-
-                    if not exists_convers:
-                        logging.info(f"[SKIP] Conversation {conversation_id} already deleted.")
-                        continue
-
-                    # Perform delete for messages queued (messages first to guarantee referential integrity)
-                    cursor.execute(f"""
-                                   DELETE FROM {catalog}.{schema}.messages
-                                   WHERE conversation_id = ?
-                                   """, (conversation_id,))
-                    logging.info(f"[OK] Delete retried: conversation {conversation_id} messages")
-
-                    # Perform delete for conversations queued
-                    cursor.execute(f"""
-                                   DELETE FROM {catalog}.{schema}.conversations
-                                   WHERE conversation_id = ?
-                                   """, (conversation_id,))
-                    logging.info(f"[OK] Delete retried: {conversation_id}")
-
-                ### Update rating ###
-                elif op == "update_rating":
-                    # Check existing rating for messages to update
-                    cursor.execute(
-                        f"SELECT rating FROM {catalog}.{schema}.messages WHERE message_id = ?",
-                        (message_id,)
-                    )
-                    exists_rating = cursor.fetchone()
-
-                    if exists_rating == item['rating']:
-                        logging.info(f"[SKIP] Message {message_id} already rated.")
-                        continue
-
-                    # Perform update rating for messages queued
-                    cursor.execute(f"""
-                                   UPDATE {catalog}.{schema}.messages
-                                   SET rating = ?
-                                   WHERE message_id = ?
-                                   """, (item['rating'], message_id))
-                    logging.info(f"[OK] Update retried: message {message_id} rating to {item['rating']}")
-
-        # Handle exceptions and retries
-        except Exception as err:
-            attempts = item.get("retries", 0)
-            if attempts < MAX_RETRIES:
-                item["retries"] = attempts + 1
-                queue.enqueue(item)  # back to queue
-                logging.warning(f"Retry {attempts+1}/{MAX_RETRIES} for item {item["id"]} — {err}")
-            else:
-                item["retries"] = 0 # reset retries for future reprocessing
-                queue.enqueue(item)  # back to queue permanently
-                logging.error(f"FAILED permanently: {item["id"]}: {err}")
-            time.sleep(RETRY_DELAY)
-            continue
-
-        finally:
-            try:
-                cursor.close()
-                conn.close()
-                logging.info("Closed Databricks SQL connection after offline queue reprocessing.")
-            except Exception as close_err:
-                logging.warning(f"Error closing connection: {str(close_err)}")
-
-    logging.info("Finished offline queue reprocessing.")
+    try:
+        return drain(queue, PersistenceStatements(catalog, schema), host, token, http_path, batch_size)
+    finally:
+        # Leases still held (segments on DBFS) would lock other reprocessors out until they expire
+        queue.release_all()
+
+def drain(queue, statements, host, token, http_path, batch_size) -> bool:
+    """Compact the queue, then claim, apply and ack batches until it is empty or the warehouse fails a batch."""
+    # Drop redundant work first: superseded ratings, writes to deleted conversations, duplicates
+    removed = queue.compact()
+    if sum(removed.values()):
+        logging.info(f"Compaction removed {sum(removed.values())} redundant items: {removed}")
+
+    # Items re-queued during this run are left for the next one
+    remaining = len(queue)
+    if not remaining:
+        logging.info("Queue is empty. Nothing to reprocess.")
+        return True
+
+    applied, healthy = 0, True
+    with sql.connect(
+        server_hostname=host,
+        http_path=http_path,
+        access_token=token
+    ) as conn, conn.cursor() as cursor:
+        while remaining > 0:
+            items = queue.claim(min(batch_size, remaining))
+            if not items:
+                break
+            remaining -= len(items)
+
+            groups = statements.group(items)
+            for i, (op, group) in enumerate(groups):
+                done = apply_group(statements, cursor, queue, op, group)
+                applied += done
+                if not done:
+                    # Nothing in the group could be written: likely the warehouse, not the data. Stop here.
+                    rest = [item for _, later in groups[i + 1:] for item in later]
+                    if rest:
+                        queue.release(rest)
+                    logging.error(f"Stopping reprocessing after failed {op} batch, {remaining + len(rest)} items left.")
+                    remaining, healthy = 0, False
+                    break
+
+    logging.info(f"Finished offline queue reprocessing: {applied} items applied.")
+    return healthy
 
 #queue = OfflineQueue()
 #reprocess_offline_queue(queue, DATABRICKS_HOST, DATABRICKS_TOKEN, HTTP_PATH, CATALOG, SCHEMA)
\ No newline at end of file
@@ -1,10 +1,15 @@
 from multiprocessing import context
 import streamlit as st
-from genie_room import start_new_conversation, continue_conversation, delete_conversation, execute_sql_with_polling, semantic_search
+from genie_room import start_new_conversation, continue_conversation, delete_conversation, execute_sql_with_polling, semantic_search, sql_pool, result_cache, persistence_writer, persist_login, title_updates
 from databricks.sdk.service.dashboards import GenieFeedbackRating
+from modules import ChatSearchIndex, ConversationStore, history_delta
 from dotenv import load_dotenv
 import logging
 import os
+import tempfile
+import time
+import zipfile
+from datetime import datetime, timedelta, timezone
 import pandas as pd
 
 # Load environment variables
@@ -38,112 +43,192 @@ def current_user():
 
 # Insert/Update user_info Database
 def user_info(user: dict):
-    from databricks import sql
     pat = st.session_state.get("Databricks PAT")
     space_id = st.session_state.get("GENIE_SPACE")
     if not pat or not space_id:
         pass
     try:
-        user_groups_list = "ARRAY(" + ", ".join(f"'{x}'" for x in user["groups"]) + ")"
-        with sql.connect(
-            server_hostname=DATABRICKS_HOST,
-            http_path=HTTP_PATH,
-            access_token=pat
-        ) as conn:
-            cursor = conn.cursor()
-            # Check existence
-            cursor.execute(f"""
-                            SELECT 1
-                            FROM {CATALOG}.{SCHEMA}.users_info
-                            WHERE user_id = ?
-                            LIMIT 1
-                            """, (st.session_state["current_user_id"],))
-
-            exists = cursor.fetchone()
-
-            # Insert if not exists, update if exists
-            if not exists:
-                cursor.execute(f"""
-                    INSERT INTO {CATALOG}.{SCHEMA}.users_info
-                    (user_id, user_name, email, groups, first_login_timestamp, last_login_timestamp, total_logins)
-                    VALUES (?, ?, ?, {user_groups_list}, current_timestamp(), current_timestamp(), 1)
-                """, (user["user_id"], user["user_name"],user["email"],))
-
-                logger.info(f"Inserted new user {user['user_id']} into users_info")
-
-            else:
-                cursor.execute(f"""
-                                UPDATE {CATALOG}.{SCHEMA}.users_info
-                                SET last_login_timestamp = current_timestamp(), total_logins = total_logins + 1
-                                WHERE user_id = ?
-                                """, (user["user_id"],))
-                
-                logger.info(f"Updated existing user {user['user_id']} in users_info")
+        # Insert if not exists, update if exists (written behind the request path)
+        persist_login(pat, HTTP_PATH, CATALOG, SCHEMA, user)
+        logger.info(f"Queued login of user {user['user_id']} for users_info")
 
     except Exception as e:
         logger.error(f"Error ensuring user exists: {str(e)}")
 
-    finally:
-        try:
-            cursor.close()
-            conn.close()
-            logging.info("Closed Databricks SQL connection successfully.")
-        except Exception as close_err:
-            logging.warning(f"Error closing connection: {str(close_err)}")
-
 # Data retrieval
-# Bulk load conversations and messages
-def initial_load():
-    from databricks import sql
+# Conversation summaries are loaded page by page, messages only when a conversation is opened (keyset pagination)
+CONVERSATIONS_PAGE_SIZE = 30
+MESSAGES_PAGE_SIZE = 50
+
+def like_pattern(token):
+    """ILIKE pattern matching token anywhere, with LIKE wildcards in it escaped."""
+    return "%" + token.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def load_conversations_page(before=None, limit=CONVERSATIONS_PAGE_SIZE, query=None):
+    """Newest conversations (id, title, timestamp, message count) older than the before key
+    (created_timestamp, conversation_id), only those matching query if given: every query token in the title or
+    in a prompt. Returns (conversations, key of the next page or None)."""
     pat = st.session_state.get("Databricks PAT")
     space_id = st.session_state.get("GENIE_SPACE")
     user_id = st.session_state.get("current_user_id")
-    if not pat or not space_id:
-        pass
+    tokens = ChatSearchIndex.tokens(query) if query else []
+    if query and not tokens:
+        return [], None
+    match = "".join(f"""
+                                AND (COALESCE(c.ai_title, c.chat_title) ILIKE ? OR EXISTS (
+                                    SELECT 1 FROM {CATALOG}.{SCHEMA}.messages m
+                                    WHERE m.conversation_id = c.conversation_id AND m.prompt ILIKE ?))""" for _ in tokens)
+    keyset = "AND (created_timestamp < ? OR (created_timestamp = ? AND conversation_id < ?))" if before else ""
+    params = ((space_id, user_id) + tuple(p for token in tokens for p in (like_pattern(token),) * 2)
+              + ((before[0], before[0], before[1]) if before else ()))
     try:
-        with sql.connect(
-            server_hostname=DATABRICKS_HOST,
-            http_path=HTTP_PATH,
-            access_token=pat
-        ) as conn:
-            cursor = conn.cursor()
+        with sql_pool.connection(DATABRICKS_HOST, HTTP_PATH, pat) as conn, conn.cursor() as cursor:
             cursor.execute(f"""
-                            SELECT conversation_id, COALESCE(ai_title, chat_title) AS title, created_timestamp
-                            FROM {CATALOG}.{SCHEMA}.conversations
-                            WHERE space_id = ? AND user_id = ?
-                            ORDER BY created_timestamp DESC
-                            """, (space_id, user_id,))
-            convs_rows = cursor.fetchall()
-            convs_cols = [c[0] for c in cursor.description]
-            all_conversations = [dict(zip(convs_cols, r)) for r in convs_rows]
+                            WITH page AS (
+                                SELECT conversation_id, COALESCE(ai_title, chat_title) AS title, created_timestamp
+                                FROM {CATALOG}.{SCHEMA}.conversations c
+                                WHERE space_id = ? AND user_id = ? {match} {keyset}
+                                ORDER BY created_timestamp DESC, conversation_id DESC
+                                LIMIT {int(limit) + 1}
+                            )
+                            SELECT p.conversation_id, p.title, p.created_timestamp, COUNT(m.message_id) AS message_count
+                            FROM page p
+                            LEFT JOIN {CATALOG}.{SCHEMA}.messages m ON m.conversation_id = p.conversation_id
+                            GROUP BY p.conversation_id, p.title, p.created_timestamp
+                            ORDER BY p.created_timestamp DESC, p.conversation_id DESC
+                            """, params)
+            cols = [c[0] for c in cursor.description]
+            conversations = [dict(zip(cols, r)) for r in cursor.fetchall()]
+
+        next_key = None
+        if len(conversations) > limit:
+            conversations = conversations[:limit]
+            next_key = (conversations[-1]["created_timestamp"], conversations[-1]["conversation_id"])
+        logging.info(f"Loaded {len(conversations)} {'matching ' if query else ''}chats{' (more available)' if next_key else ''}.")
+        return conversations, next_key
 
-            cursor.execute(f"""
-                            SELECT *
-                            FROM {CATALOG}.{SCHEMA}.messages
-                            WHERE user_id = ?
-                            ORDER BY created_timestamp ASC
-                            """, (user_id,))
-            msgs_rows = cursor.fetchall()
-            msgs_cols = [c[0] for c in cursor.description]
-            all_msgs = [dict(zip(msgs_cols, r)) for r in msgs_rows]
-
-            logging.info(f"Initial load completed: {len(all_conversations)} chats and {len(all_msgs)} messages.")
-            return all_conversations, all_msgs
-        
     except Exception as e:
-        logger.error(f"Couldn't load previous chats and messages: {str(e)}")
-        return [], []
-    
-    finally:
-        try:
-            cursor.close()
-            conn.close()
-            logging.info("Closed Databricks SQL connection successfully.")
-        except Exception as close_err:
-            logging.warning(f"Error closing connection: {str(close_err)}")
-
-def transform_db_to_chat(messages):
-    """Convierte filas de la DB al formato de mensajes de la App."""
+        logger.error(f"Couldn't load previous chats: {str(e)}")
+        return [], None
+
+def load_messages_page(conversation_id, before=None, limit=MESSAGES_PAGE_SIZE):
+    """Latest messages of a conversation older than the before key (created_timestamp, message_id), oldest first.
+    Returns (messages, key of the previous page or None)."""
+    pat = st.session_state.get("Databricks PAT")
+    keyset = "AND (created_timestamp < ? OR (created_timestamp = ? AND message_id < ?))" if before else ""
+    params = (conversation_id,) + ((before[0], before[0], before[1]) if before else ())
+    with sql_pool.connection(DATABRICKS_HOST, HTTP_PATH, pat) as conn, conn.cursor() as cursor:
+        cursor.execute(f"""
+                        SELECT conversation_id, message_id, prompt, completion, assistant_attachment, rating, created_timestamp
+                        FROM {CATALOG}.{SCHEMA}.messages
+                        WHERE conversation_id = ? {keyset}
+                        ORDER BY created_timestamp DESC, message_id DESC
+                        LIMIT {int(limit) + 1}
+                        """, params)
+        cols = [c[0] for c in cursor.description]
+        messages = [dict(zip(cols, r)) for r in cursor.fetchall()]
+
+    next_key = None
+    if len(messages) > limit:
+        messages = messages[:limit]
+        next_key = (messages[-1]["created_timestamp"], messages[-1]["message_id"])
+    return messages[::-1], next_key
+
+def conversation_store() -> ConversationStore:
+    """Chat history of this session: conversations and loaded messages, indexed by id."""
+    if "conversation_store" not in st.session_state:
+        st.session_state.conversation_store = ConversationStore()
+    return st.session_state.conversation_store
+
+def load_conversation(conversation_id):
+    """Load the latest page of a conversation's messages into the store once."""
+    store = conversation_store()
+    if not store.is_loaded(conversation_id):
+        messages, before = load_messages_page(conversation_id)
+        store.set_messages(conversation_id, messages, before)
+
+def load_earlier_messages(conversation_id):
+    """Prepend the previous page of a conversation's messages."""
+    store = conversation_store()
+    messages, before = load_messages_page(conversation_id, before=store.earlier_page(conversation_id))
+    store.prepend_messages(conversation_id, messages, before)
+
+def remember_message(row: dict):
+    """Keep a message sent in this session with the loaded messages of its conversation."""
+    if row.get("conversation_id"):
+        conversation_store().add_message(row, merge=True)
+
+# Incremental sync: conversations and messages written after the session high-water mark and tombstones of deleted
+# conversations, merged into session_state. Both sides use the warehouse clock: the high-water mark is its
+# current_timestamp() and every write sets updated_timestamp, so rows drained late from the offline queue (with an
+# old created_timestamp) are still synced. The lookback covers writes that started before a sync and committed after.
+SYNC_INTERVAL_SECONDS = 30
+SYNC_LOOKBACK = timedelta(seconds=60)
+
+def fetch_history_delta(since):
+    """Conversations, messages and deleted conversation ids written after since (minus SYNC_LOOKBACK).
+    Returns (server time of this sync, UTC, conversations, messages, deleted ids); no delta when since is None."""
+    pat = st.session_state.get("Databricks PAT")
+    space_id = st.session_state.get("GENIE_SPACE")
+    user_id = st.session_state.get("current_user_id")
+    with sql_pool.connection(DATABRICKS_HOST, HTTP_PATH, pat) as conn, conn.cursor() as cursor:
+        cursor.execute("SELECT unix_micros(current_timestamp())")
+        synced_at = datetime.fromtimestamp(cursor.fetchone()[0] / 1_000_000, timezone.utc)
+        if since is None:
+            return synced_at, [], [], []
+        return (synced_at, *history_delta(cursor, CATALOG, SCHEMA, space_id, user_id, since - SYNC_LOOKBACK))
+
+def forget_search_results(conversation_ids):
+    """Drop deleted conversations from the cached server-side search results."""
+    search = st.session_state.get("chat_search")
+    if search and conversation_ids:
+        search["found"] = [c for c in search["found"] if c["conversation_id"] not in conversation_ids]
+
+def apply_history_delta(conversations, messages, deleted) -> bool:
+    """Merge a delta into the store, deduplicated by id. Returns True if the visible history changed."""
+    store = conversation_store()
+    current_conv_id = st.session_state.get("conversation_id")
+    deleted = set(deleted)
+    changed = False
+
+    # New conversations on top, newer titles (e.g. AI titles) for known ones
+    for conv in conversations:
+        if conv["conversation_id"] in store and conv["conversation_id"] not in deleted:
+            changed |= store.set_title(conv["conversation_id"], conv["title"])
+    changed |= store.add_conversations([c for c in conversations if c["conversation_id"] not in deleted], first=True) > 0
+
+    # New messages of loaded conversations
+    for m in messages:
+        if store.is_loaded(m["conversation_id"]) and m["conversation_id"] not in deleted:
+            if store.add_message(m) and m["conversation_id"] == current_conv_id:
+                st.session_state.messages = transform_db_to_chat(current_conv_id)
+                changed = True
+
+    # Deleted conversations
+    for conv_id in deleted:
+        changed |= store.remove_conversation(conv_id)
+    forget_search_results(deleted)
+    if current_conv_id in deleted:
+        st.session_state.conversation_id = None
+        st.session_state.messages = []
+        st.session_state.last_message_id = None
+        st.session_state.show_examples = True
+
+    return changed
+
+def transform_db_to_chat(conversation_id):
+    """Convierte filas de la DB (del store de la sesión) al formato de mensajes de la App."""
+    messages = conversation_store().messages(conversation_id)
+
+    # Sync ratings in session_state
+    for m in messages:
+        if m.get("rating") and (m.get("completion") or m.get("regenerated_df") is not None):
+            st.session_state[f"rating_{m.get('message_id')}"] = m["rating"]
+
+    return chat_from_rows(messages)
+
+def chat_from_rows(messages):
+    """Message rows (oldest first) in the App chat format. No Streamlit calls, so exports can build from any rows."""
     chat_history = []
     processed_prompts = set()
 
@@ -173,13 +258,81 @@ def transform_db_to_chat(messages):
                 "query_text": sql_query,
                 "text_display": assistant_response if regen_df is not None else None
             })
-            
-            # Sync rating in session_state
-            if m.get("rating"):
-                st.session_state[f"rating_{m_id}"] = m["rating"]
-                
+
     return chat_history
 
+# Chat exports: built only when a "prepare" button is clicked, memoized per (conversation_id, version) and spooled to
+# disk past EXPORT_SPOOL_BYTES. The download button then gets the bytes (no on-click data callables on streamlit 1.50).
+EXPORT_SPOOL_BYTES = 4 * 1024 * 1024
+EXPORT_FETCH_ROWS = 500
+
+def transcript_chunks(chat_history):
+    """Transcript text of a conversation, message by message."""
+    for i, m in enumerate(chat_history):
+        yield ("\n\n" if i else "") + f"**{m['role'].capitalize()}**:\n{m['content']}"
+
+def fetch_conversation_rows(pat, conversation_id):
+    """Every message row of a conversation, oldest first."""
+    with sql_pool.connection(DATABRICKS_HOST, HTTP_PATH, pat) as conn, conn.cursor() as cursor:
+        cursor.execute(f"""
+                        SELECT message_id, prompt, completion, assistant_attachment, created_timestamp
+                        FROM {CATALOG}.{SCHEMA}.messages
+                        WHERE conversation_id = ?
+                        ORDER BY created_timestamp ASC, message_id ASC
+                        """, (conversation_id,))
+        cols = [c[0] for c in cursor.description]
+        return [dict(zip(cols, r)) for r in cursor.fetchall()]
+
+def export_conversation(pat, store, exports, conversation_id):
+    """Transcript of a conversation as bytes. Fully loaded conversations are built from the store and memoized
+    per (conversation_id, version); others are read from the database."""
+    if not store.is_loaded(conversation_id) or store.earlier_page(conversation_id):
+        return "".join(transcript_chunks(chat_from_rows(fetch_conversation_rows(pat, conversation_id)))).encode("utf-8")
+
+    version = store.version(conversation_id)
+    cached = exports.get(conversation_id)
+    if cached is None or cached[0] != version:
+        if cached is not None:
+            cached[1].close()
+        spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+        for chunk in transcript_chunks(chat_from_rows(store.messages(conversation_id))):
+            spool.write(chunk.encode("utf-8"))
+        exports[conversation_id] = cached = (version, spool)
+    cached[1].seek(0)
+    return cached[1].read()
+
+def export_all_conversations(pat, space_id, user_id):
+    """Zip archive with one transcript per conversation of the user in the space, streamed from the database
+    in EXPORT_FETCH_ROWS row batches."""
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_BYTES)
+    with sql_pool.connection(DATABRICKS_HOST, HTTP_PATH, pat) as conn, conn.cursor() as cursor, \
+            zipfile.ZipFile(spool, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        cursor.execute(f"""
+                        SELECT c.conversation_id, COALESCE(c.ai_title, c.chat_title) AS title,
+                               m.message_id, m.prompt, m.completion, m.assistant_attachment
+                        FROM {CATALOG}.{SCHEMA}.conversations c
+                        JOIN {CATALOG}.{SCHEMA}.messages m ON m.conversation_id = c.conversation_id
+                        WHERE c.space_id = ? AND c.user_id = ?
+                        ORDER BY c.created_timestamp DESC, c.conversation_id, m.created_timestamp ASC, m.message_id ASC
+                        """, (space_id, user_id))
+        cols = [c[0] for c in cursor.description]
+        current, entry, first = None, None, True
+        while rows := cursor.fetchmany(EXPORT_FETCH_ROWS):
+            for row in (dict(zip(cols, r)) for r in rows):
+                if row["conversation_id"] != current:
+                    if entry is not None:
+                        entry.close()
+                    current, first = row["conversation_id"], True
+                    name = "".join(ch if ch.isalnum() or ch in " -_" else "_" for ch in (row["title"] or "Untitled Chat"))
+                    entry = archive.open(f"{name[:80]}_{current}.txt", "w")
+                for chunk in transcript_chunks(chat_from_rows([row])):
+                    entry.write((chunk if first else "\n\n" + chunk).encode("utf-8"))
+                    first = False
+        if entry is not None:
+            entry.close()
+    spool.seek(0)
+    return spool.read()
+
 # Callback functions
 # Callback function to regenerate SQL result
 def regenerate_sql_callback(message_id, sql_text, context):
@@ -187,6 +340,8 @@ def regenerate_sql_callback(message_id, sql_text, context):
     pat = st.session_state.get("Databricks PAT")
     space_id = st.session_state.get("GENIE_SPACE")
     use_external = st.session_state.get("use_external_results", False)
+    result_format = st.session_state.get("result_format")
+    force_refresh = st.session_state.get("force_refresh_results", False)
     try:
         df = execute_sql_with_polling(
             space_id=space_id,
@@ -197,7 +352,9 @@ def regenerate_sql_callback(message_id, sql_text, context):
             warehouse_id=WAREHOUSE_ID,
             message_id=message_id,
             sql_text=sql_text,
-            use_external=use_external
+            use_external=use_external,
+            result_format=result_format,
+            force_refresh=force_refresh
         )
 
         # Chat context
@@ -207,15 +364,11 @@ def regenerate_sql_callback(message_id, sql_text, context):
                 st.session_state.regenerated_results = {}
             st.session_state.regenerated_results[message_id] = df
 
-            if "all_user_messages" in st.session_state:
-                for msg in st.session_state.all_user_messages:
-                    if msg.get("message_id") == message_id:
-                        msg["content"] = df
-                        base_text = msg.get("text_display", "")
-                        regen_text = f"\n\n🔄 Result regenerated at {pd.Timestamp.utcnow()}"
-                        msg["text_display"] = base_text + regen_text
-                        msg["regenerated_df"] = df
-                        break
+            msg = conversation_store().message(message_id)
+            if msg is not None:
+                regen_text = f"\n\n🔄 Result regenerated at {pd.Timestamp.utcnow()}"
+                conversation_store().update_message(message_id, content=df, regenerated_df=df,
+                                                    text_display=msg.get("text_display", "") + regen_text)
 
             if "messages" in st.session_state:
                 for m in st.session_state.messages:
@@ -263,15 +416,9 @@ def run_semantic_search(semantic_query):
 
 # Load users info for semantic search results
 def load_users_info(user_ids):
-    from databricks import sql
     placeholders = ",".join(["?"] * len(user_ids))
 
-    with sql.connect(
-            server_hostname=DATABRICKS_HOST,
-            http_path=HTTP_PATH,
-            access_token=st.session_state.get("Databricks PAT")
-        ) as conn:
-        cursor = conn.cursor()
+    with sql_pool.connection(DATABRICKS_HOST, HTTP_PATH, st.session_state.get("Databricks PAT")) as conn, conn.cursor() as cursor:
         cursor.execute(f"""
                         SELECT user_id, user_name, email
                         FROM {CATALOG}.{SCHEMA}.users_info
@@ -310,12 +457,8 @@ def send_feedback_callback(conversation_id: str, message_id: str, rating_str):
             schema=SCHEMA
         )
 
-        # Update all_user_messages in session_state
-        if "all_user_messages" in st.session_state:
-            for msg in st.session_state.all_user_messages:
-                if msg.get("message_id") == f"assistant_{message_id}":
-                    msg["rating"] = str(rating_str).split('.')[-1] 
-                    break
+        # Update loaded message in session_state
+        conversation_store().update_message(message_id, rating=str(rating_str).split('.')[-1])
 
         # Register feedback for visual persistence
         st.session_state[f"rating_{message_id}"] = rating_str.value # Stores 'positive' or 'negative'
@@ -324,6 +467,45 @@ def send_feedback_callback(conversation_id: str, message_id: str, rating_str):
         logger.error(f"Feedback submission failed: {str(e)}")
         st.toast("⚠️ Error while sending feedback", icon="⚠️")
 
+# Fragment to refresh sidebar titles once their AI title is generated in the background. A title that has not
+# arrived after TITLE_WAIT_SECONDS (batch sent to the offline queue, AI_SUMMARIZE failed) is given up on: the chat
+# keeps its prompt-based title.
+TITLE_WAIT_SECONDS = 120
+
+@st.fragment(run_every=2)
+def watch_pending_titles():
+    """Swaps provisional titles for AI titles as they arrive, then reruns the app to redraw the sidebar."""
+    pending = st.session_state.get("pending_titles", {})
+    arrived = {conv_id: title_updates.get(conv_id) for conv_id in pending}
+    arrived = {conv_id: title for conv_id, title in arrived.items() if title}
+    now = time.monotonic()
+    expired = {conv_id for conv_id, deadline in pending.items() if deadline <= now and conv_id not in arrived}
+    if expired:
+        logger.info(f"Gave up waiting for AI titles of {len(expired)} conversations.")
+    if arrived or expired:
+        for conv_id, title in arrived.items():
+            conversation_store().set_title(conv_id, title)
+        st.session_state.pending_titles = {conv_id: deadline for conv_id, deadline in pending.items()
+                                           if conv_id not in arrived and conv_id not in expired}
+        # Rerun to redraw the sidebar, or to stop this fragment once nothing is pending
+        if arrived or not st.session_state.pending_titles:
+            st.rerun(scope="app")
+
+# Fragment to merge history changes made elsewhere (other tabs, offline queue drain)
+@st.fragment(run_every=SYNC_INTERVAL_SECONDS)
+def sync_history():
+    """Fetches the history delta at most every SYNC_INTERVAL_SECONDS and reruns the app if it changed."""
+    if time.monotonic() - st.session_state.get("synced_monotonic", 0) < SYNC_INTERVAL_SECONDS:
+        return
+    st.session_state.synced_monotonic = time.monotonic()
+    try:
+        st.session_state.synced_at, *delta = fetch_history_delta(st.session_state.get("synced_at"))
+    except Exception as e:
+        logger.warning(f"History sync failed: {str(e)}")
+        return
+    if apply_history_delta(*delta):
+        st.rerun(scope="app")
+
 # Page configuration
 st.set_page_config(
     page_title="<team_name> Bot powered by Genie", #TabularAI
@@ -399,7 +581,32 @@ with st.sidebar:
         help="Enable this option to fetch large result sets (30k + rows)."
     )
 
+    use_arrow = st.checkbox(
+        "Arrow results (typed, fastest)",
+        value=False,
+        help="Fetch regenerated results as Arrow record batches: typed columns and no text parsing. Uses external links."
+    )
+
+    force_refresh = st.checkbox(
+        "Bypass result cache",
+        value=False,
+        help="Always re-run SQL on the warehouse when regenerating, instead of reusing a recent identical result."
+    )
+
+    use_answer_cache = st.checkbox(
+        "Reuse answers to repeated questions",
+        value=True,
+        help="When a question was already answered in this space, re-run its SQL directly instead of asking Genie again."
+    )
+
     st.session_state.use_external_results = use_external
+    st.session_state.result_format = "ARROW_STREAM" if use_arrow else None
+    st.session_state.force_refresh_results = force_refresh
+    st.session_state.use_answer_cache = use_answer_cache
+    cache_stats = result_cache.stats()
+    st.caption(f"Result cache: {cache_stats['hits']} hits · {cache_stats['misses']} misses · {cache_stats['bytes'] / 1e6:.1f} MB")
+    writer_stats = persistence_writer.stats()
+    st.caption(f"Pending writes: {writer_stats['depth']} · last flush {writer_stats['last_flush_seconds']}s · {writer_stats['failed_events']} queued offline")
     if st.session_state.get("use_external_results"):
         st.info("External results enabled. Large datasets may take longer to load.")
 
@@ -410,6 +617,21 @@ with st.sidebar:
         st.info("Switch back to **Chat** tab to continue conversations.")
     else:
         st.header("💬 Chats")
+        # Export every chat as a zip of transcripts, built only when asked for
+        if st.button("📦 Export all chats", type="tertiary", help="Build a zip of transcripts of every chat of this Genie space."):
+            try:
+                with st.spinner("Exporting chats..."):
+                    archive = export_all_conversations(databricks_pat, genie_id, st.session_state.get("current_user_id"))
+                st.download_button(
+                        label="📥 Download genie_chats.zip",
+                        data=archive,
+                        file_name="genie_chats.zip",
+                        mime="application/zip",
+                        type="tertiary",
+                        on_click="ignore"
+                        )
+            except Exception as e:
+                st.error(f"Couldn't export chats: {str(e)}")
     
         # Button to start a new chat
         if st.button("➕ New Chat"):
@@ -426,18 +648,32 @@ with st.sidebar:
     
         # Retrieve previous conversations from Genie
         try: 
-            # Call Databricks backend database
-            if "all_user_messages" not in st.session_state:
+            # Call Databricks backend database: first page of chats, messages load when a chat is opened
+            if "conversation_store" not in st.session_state:
                 with st.spinner("Querying database..."):
-                    conversations, messages = initial_load()
-                    st.session_state.all_conversations = conversations
-                    st.session_state.all_user_messages = messages
+                    conversations, st.session_state.conversations_before = load_conversations_page()
+                    conversation_store().add_conversations(conversations)
+            store = conversation_store()
+            exports = st.session_state.setdefault("exports", {})
     
-            # Filter search coincidences on visible chats
-            filtered_chats = [
-                conv for conv in st.session_state.all_conversations
-                if isinstance(conv, dict) and search_query.lower() in conv.get("title", "").lower()
-            ] if search_query else st.session_state.all_conversations
+            # Merge chats created or deleted elsewhere since the last sync
+            sync_history()
+
+            # Poll for AI titles of new chats
+            if st.session_state.get("pending_titles"):
+                watch_pending_titles()
+
+            # Search: ranked over loaded chats (titles and prompts; prefix and fuzzy matches), then the server-side
+            # matches over all chats (titles and prompts of unopened chats too), paged like the chat list
+            if search_query:
+                search = st.session_state.get("chat_search")
+                if search is None or search["query"] != search_query:
+                    with st.spinner("Searching chats..."):
+                        found, before = load_conversations_page(query=search_query)
+                    search = st.session_state.chat_search = {"query": search_query, "found": found, "before": before}
+                filtered_chats = store.search(search_query, found=search["found"])
+            else:
+                filtered_chats = store.conversations()
     
             for conv in filtered_chats:
                 conv_id = conv.get("conversation_id", "")
@@ -448,7 +684,9 @@ with st.sidebar:
     
                     with cols[0]:
                         # Chat title as button to open conversation
-                        if st.button(conv_title, key=f"open_{conv_id}", use_container_width=True):
+                        message_count = conv.get("message_count")
+                        if st.button(conv_title, key=f"open_{conv_id}", use_container_width=True,
+                                     help=f"{message_count} messages" if message_count is not None else None):
                             st.session_state.show_examples = False
                             st.session_state.conversation_id = conv_id
                             st.session_state.selected_chat = conv
@@ -461,8 +699,9 @@ with st.sidebar:
     
                             # Load messages for the selected conversation
                             try:
-                                messages = [m for m in st.session_state.all_user_messages if m["conversation_id"] == conv_id]      
-                                st.session_state.messages = transform_db_to_chat(messages)
+                                with st.spinner("Loading messages..."):
+                                    load_conversation(conv_id)
+                                st.session_state.messages = transform_db_to_chat(conv_id)
                                 st.rerun()
     
                             except Exception as e:
@@ -476,15 +715,10 @@ with st.sidebar:
                                 try:
                                     delete_conversation(databricks_pat, genie_id, conv_id, HTTP_PATH, CATALOG, SCHEMA)
 
-                                    # Clean conversation from session_state
-                                    if "all_conversations" in st.session_state:
-                                        st.session_state.all_conversations = [c for c in st.session_state.all_conversations 
-                                                                              if c.get("conversation_id") != conv_id]
-
-                                    # Clean conversation messages from session_state                                       
-                                    if "all_user_messages" in st.session_state:
-                                        st.session_state.all_user_messages = [m for m in st.session_state.all_user_messages 
-                                                                              if m.get("conversation_id") != conv_id]
+                                    # Clean conversation, its messages, its export and search results from session_state
+                                    store.remove_conversation(conv_id)
+                                    exports.pop(conv_id, None)
+                                    forget_search_results({conv_id})
 
                                     # Reset current conversation if it was the deleted one
                                     if st.session_state.get("conversation_id") == conv_id:
@@ -499,25 +733,36 @@ with st.sidebar:
                                 except Exception as e:
                                     st.error(f"Failed to delete conversation: {str(e)}")
     
-                            # Download conversation as .txt
-                            try:
-                                raw_messages = [m for m in st.session_state.all_user_messages if m["conversation_id"] == conv_id]
-                                formatted_dl = transform_db_to_chat(raw_messages)
-                                
-                                chat_text = "\n\n".join([f"**{m['role'].capitalize()}**:\n{m['content']}"
-                                                        for m in formatted_dl
-                                                        ])
-                                st.download_button(
-                                        label="📥 Download chat",
-                                        data=chat_text,
-                                        file_name=f"{conv_title}.txt",
-                                        mime="text/plain",
-                                        key=f"dl_{conv_id}",
-                                        use_container_width=True
-                                        )
-                            except Exception as e:
-                                st.warning(f"Couldn't prepare download: {str(e)}")
+                            # Download conversation as .txt, built only when asked for
+                            if st.button("📄 Prepare download", key=f"prepare_{conv_id}", use_container_width=True):
+                                try:
+                                    transcript = export_conversation(databricks_pat, store, exports, conv_id)
+                                    st.download_button(
+                                            label="📥 Download chat",
+                                            data=transcript,
+                                            file_name=f"{conv_title}.txt",
+                                            mime="text/plain",
+                                            key=f"dl_{conv_id}",
+                                            use_container_width=True,
+                                            on_click="ignore"
+                                            )
+                                except Exception as e:
+                                    st.error(f"Couldn't export conversation: {str(e)}")
     
+            # Next page of search results or chats
+            if search_query:
+                if search["before"] and st.button("Load more results", key="load_more_results", use_container_width=True):
+                    with st.spinner("Searching chats..."):
+                        more, search["before"] = load_conversations_page(search["before"], query=search_query)
+                    search["found"].extend(more)
+                    st.rerun()
+            elif st.session_state.get("conversations_before"):
+                if st.button("Load more chats", key="load_more_chats", use_container_width=True):
+                    with st.spinner("Querying database..."):
+                        more, st.session_state.conversations_before = load_conversations_page(st.session_state.conversations_before)
+                    store.add_conversations(more)
+                    st.rerun()
+
             # Message if no chats found
             if not filtered_chats:
                 st.info("No previous chats found.")
@@ -546,6 +791,15 @@ if st.session_state.active_tab == "chat":
     if "conversation_id" not in st.session_state or st.session_state.conversation_id is None:
         st.session_state.messages = []
 
+    # Older messages of long conversations are loaded on request
+    current_conv_id = st.session_state.get("conversation_id")
+    if current_conv_id and conversation_store().earlier_page(current_conv_id):
+        if st.button("⬆️ Load earlier messages", key=f"earlier_{current_conv_id}"):
+            with st.spinner("Loading messages..."):
+                load_earlier_messages(current_conv_id)
+            st.session_state.messages = transform_db_to_chat(current_conv_id)
+            st.rerun()
+
     # Display chat messages history on app rerun
     rendered_user_prompts = set()
     for message in st.session_state.get("messages", []):
@@ -678,8 +932,7 @@ if st.session_state.active_tab == "chat":
         st.session_state.messages.append({"role": "user", "content": user_text})
         st.session_state.show_examples = False
 
-        if "all_user_messages" in st.session_state:
-            st.session_state.all_user_messages.append({
+        remember_message({
                                 "conversation_id": st.session_state.conversation_id,
                                 "prompt": user_text,
                                 "role": "user",
@@ -715,7 +968,9 @@ if st.session_state.active_tab == "chat":
                         CATALOG,
                         SCHEMA,
                         attachment=attachment_bytes,
-                        filename=filename
+                        filename=filename,
+                        warehouse_id=WAREHOUSE_ID,
+                        use_answer_cache=st.session_state.get("use_answer_cache", True)
                     )
 
                     st.session_state.conversation_id = conv_id
@@ -724,10 +979,11 @@ if st.session_state.active_tab == "chat":
                                  "title": ai_title,
                                  "created_timestamp": pd.Timestamp.utcnow()}
                     
-                    if "all_conversations" in st.session_state:
-                        st.session_state.all_conversations.insert(0, new_chats)
-                    else:
-                        st.session_state.all_conversations = [new_chats]
+                    conversation_store().add_conversations([new_chats], first=True)
+
+                    # Title is the question for now, the AI title replaces it when generated
+                    if conv_id:
+                        st.session_state.setdefault("pending_titles", {})[conv_id] = time.monotonic() + TITLE_WAIT_SECONDS
 
                     #st.rerun()
                     
@@ -748,9 +1004,8 @@ if st.session_state.active_tab == "chat":
                 # Store last assistant message ID for feedback
                 st.session_state["last_message_id"] = assistant_message_id
 
-            # Update all user messages with user message
-            if "all_user_messages" in st.session_state:
-                st.session_state.all_user_messages.append({
+            # Update loaded messages with user message
+            remember_message({
                                     "conversation_id": st.session_state.conversation_id,
                                     "message_id": f"user_{assistant_message_id}",
                                     "prompt": user_text,
@@ -766,9 +1021,8 @@ if st.session_state.active_tab == "chat":
                     message_data["query_text"] = query_text
                 st.session_state.messages.append(message_data)
 
-                # Update all user messages
-                if "all_user_messages" in st.session_state:
-                    st.session_state.all_user_messages.append({
+                # Update loaded messages
+                remember_message({
                                     "conversation_id": st.session_state.conversation_id,
                                     "message_id": f"assistant_{assistant_message_id}",
                                     "prompt": user_text,
@@ -790,9 +1044,8 @@ if st.session_state.active_tab == "chat":
                     message_data["query_text"] = query_text
                 st.session_state.messages.append(message_data)
 
-                # Update all user messages
-                if "all_user_messages" in st.session_state:
-                    st.session_state.all_user_messages.append({
+                # Update loaded messages
+                remember_message({
                                     "conversation_id": st.session_state.conversation_id,
                                     "message_id": f"assistant_{assistant_message_id}",
                                     "prompt": user_text,
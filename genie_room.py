@@ -1,16 +1,21 @@
 import pandas as pd
+import pyarrow as pa
 import os
 import json
+import asyncio
+import atexit
+import tempfile
+import uuid
 import requests
-from io import BytesIO
-from typing import Optional, Union, Tuple
+from requests.adapters import HTTPAdapter
+from typing import Optional, Union, Tuple, Callable
 import time
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 from dotenv import load_dotenv
-from databricks import sql
-from modules import OfflineQueue, GenieClient
+from modules import OfflineQueue, GenieClientRegistry, SQLConnectionPool, AsyncGenieClient, EventLoopThread, ResultCache, TTLCache, PersistenceWriter, PersistenceStatements, DrainScheduler, token_fingerprint, normalize_text, normalize_question, values_rows, param_chunks
 from databricks.sdk.service.sql import Disposition, Format
+from db_offline_queue import reprocess_offline_queue
 
 # Configure logging level
 logging.basicConfig(level=logging.INFO)
@@ -23,507 +28,836 @@ DATABRICKS_HOST = os.environ.get("DATABRICKS_HOST")
 # Create Queue object
 offline_queue = OfflineQueue()
 
+# Process-wide registry of warm Genie clients, shared by every Streamlit session
+client_registry = GenieClientRegistry()
+
+# Process-wide pool of Databricks SQL connections for every persistence path
+sql_pool = SQLConnectionPool()
+
+# Background event loop that drives the async API on behalf of the sync wrappers
+event_loop = EventLoopThread()
+
+# Regenerated SQL results, scoped per token by default: Unity Catalog grants, row filters and column masks can
+# make the same SQL return different rows to different users. Set RESULT_CACHE_SHARED=true to share entries
+# across sessions only when every user is entitled to the same data.
+result_cache = ResultCache()
+RESULT_CACHE_SHARED = os.environ.get("RESULT_CACHE_SHARED", "false").lower() == "true"
+
+# Semantic search results shared by every session, keyed by (index, normalized query, space_id, num_results).
+# Entries expire after SEMANTIC_CACHE_TTL_SECONDS, or as soon as the index sync version changes
+# (checked at most every SEMANTIC_INDEX_CHECK_SECONDS).
+SEMANTIC_INDEX = "messages_user_questions_index"
+SEMANTIC_NUM_RESULTS = 3
+SEMANTIC_CACHE_TTL_SECONDS = int(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", "900"))
+SEMANTIC_INDEX_CHECK_SECONDS = 60
+semantic_cache = TTLCache(max_entries=2048, ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS)
+semantic_index_checks = TTLCache(max_entries=64, ttl_seconds=SEMANTIC_INDEX_CHECK_SECONDS)
+semantic_index_versions = {}
+
+# Current user info per token, so searches don't call the SCIM API every time
+user_cache = TTLCache(max_entries=1024, ttl_seconds=3600)
+
+# Generated SQL (plus its description) of answered questions, keyed by (space_id, prompt lowercased with collapsed
+# whitespace). A repeated question re-runs the cached SQL with the asking user's token instead of going through Genie.
+# Conversations served this way get ids prefixed with CACHED_ID_PREFIX; the first follow-up opens the real Genie
+# conversation behind them, stored as conversations.genie_conversation_id. answer_aliases caches those links, and
+# the original question and SQL, which are read back from the database after a restart or on another replica.
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "86400"))
+CACHED_ID_PREFIX = "cached-"
+answer_cache = TTLCache(max_entries=4096, ttl_seconds=ANSWER_CACHE_TTL_SECONDS)
+answer_aliases = TTLCache(max_entries=8192, ttl_seconds=7 * 86400)
+
+# Write-behind persistence: events are batched per (operation, target) and flushed as multi-row MERGEs
+# every PERSIST_FLUSH_SECONDS or once PERSIST_BATCH_SIZE events of one kind are waiting
+PERSIST_BATCH_SIZE = int(os.environ.get("PERSIST_BATCH_SIZE", "50"))
+PERSIST_FLUSH_SECONDS = float(os.environ.get("PERSIST_FLUSH_SECONDS", "2"))
+
+# Conversation titles: saved as chat_title right away, AI_SUMMARIZE runs later for many conversations at once.
+# Generated titles are published to title_updates, where sessions pick them up to refresh their sidebar.
+TITLE_BATCH_SIZE = int(os.environ.get("TITLE_BATCH_SIZE", "20"))
+TITLE_FLUSH_SECONDS = float(os.environ.get("TITLE_FLUSH_SECONDS", "3"))
+title_updates = TTLCache(max_entries=4096, ttl_seconds=3600)
+
+# Optional drain of the offline queue from inside the app, every OFFLINE_DRAIN_INTERVAL_SECONDS (0 = off, leave it
+# to db_offline_queue.py / a job). Uses the app credentials; one drainer per host (lock file), leases across hosts.
+OFFLINE_DRAIN_INTERVAL_SECONDS = float(os.environ.get("OFFLINE_DRAIN_INTERVAL_SECONDS", "0"))
+OFFLINE_DRAIN_LOCK_FILE = os.path.join(tempfile.gettempdir(), "genie_offline_drain.lock")
+
+# Max result chunks downloaded at the same time per statement
+CHUNK_FETCH_CONCURRENCY = 4
+
+# Result formats selectable for statement execution: name -> (disposition, format)
+RESULT_FORMATS = {
+    "JSON_ARRAY": (Disposition.INLINE, Format.JSON_ARRAY),
+    "CSV": (Disposition.EXTERNAL_LINKS, Format.CSV),
+    "ARROW_STREAM": (Disposition.EXTERNAL_LINKS, Format.ARROW_STREAM),
+}
+
+# String columns with at most this share of distinct values (and enough rows) become categoricals
+CATEGORICAL_MAX_UNIQUE_RATIO = 0.5
+CATEGORICAL_MIN_ROWS = 100
+
+# Presigned links closer than this to expiry are refreshed before downloading
+LINK_EXPIRY_MARGIN_SECONDS = 30
+
+# Pooled HTTP session for presigned external result links. It carries no Databricks credentials on purpose.
+download_session = requests.Session()
+download_session.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32))
+
 #################
 ### Functions ###
 #################
 
-def process_genie_response(client, conversation_id, message_id, complete_message) -> Tuple[Union[str, pd.DataFrame], Optional[str]]:
+def async_client(space_id: str, token: str) -> AsyncGenieClient:
+    """Async view over the shared warm client for (host, token, space_id)."""
+    return AsyncGenieClient(client_registry.get(
+        host=DATABRICKS_HOST,
+        space_id=space_id,
+        token=token
+    ))
+
+def is_cached_id(conversation_or_message_id: Optional[str]) -> bool:
+    """True for conversation/message ids created by the answer cache rather than by Genie."""
+    return str(conversation_or_message_id or "").startswith(CACHED_ID_PREFIX)
+
+def invalidate_answer_cache(space_id: Optional[str] = None) -> int:
+    """Drop cached answers for one Genie space (e.g. after its instructions or tables change), or all of them."""
+    if space_id is None:
+        dropped = len(answer_cache)
+        answer_cache.clear()
+    else:
+        dropped = answer_cache.invalidate_where(lambda key: key[0] == space_id)
+    logger.info(f"Dropped {dropped} cached answers for space {space_id or 'all'}.")
+    return dropped
+
+def column_specs(schema_columns: list) -> list:
+    """Normalize schema columns (ColumnInfo objects, their dict form or bare names) to
+    (name, type_name, precision, scale) tuples."""
+    specs = []
+    for col in schema_columns or []:
+        if isinstance(col, str):
+            specs.append((col, None, None, None))
+        elif isinstance(col, dict):
+            specs.append((col.get("name"), col.get("type_name"), col.get("type_precision"), col.get("type_scale")))
+        else:
+            type_name = getattr(col.type_name, "value", col.type_name)
+            specs.append((col.name, type_name, col.type_precision, col.type_scale))
+    return specs
+
+def convert_column(values, type_name: Optional[str], precision: Optional[int], scale: Optional[int]) -> pd.Series:
+    """Convert one column of wire values (strings for JSON_ARRAY) to a compact typed Series.
+    Falls back to the raw values if conversion would turn non-null values into nulls."""
+    raw = pd.Series(values, dtype=object)
+    try:
+        if type_name in ("BYTE", "SHORT", "INT", "LONG") or (type_name == "DECIMAL" and not scale and (precision or 38) <= 18):
+            converted = pd.to_numeric(raw, errors="coerce", dtype_backend="numpy_nullable")
+            if not converted.hasnans:  # No nulls: plain numpy ints, as small as the values allow
+                converted = pd.to_numeric(converted.astype("int64"), downcast="integer")
+        elif type_name in ("FLOAT", "DOUBLE") or (type_name == "DECIMAL" and (precision or 38) <= 15):
+            # FLOAT is single precision at the source, so float32 loses nothing; DECIMAL(<=15) round-trips through float64
+            converted = pd.to_numeric(raw, errors="coerce", downcast="float" if type_name == "FLOAT" else None)
+        elif type_name == "BOOLEAN":
+            converted = raw.astype("string").str.lower().map({"true": True, "false": False}).astype("boolean")
+        elif type_name in ("DATE", "TIMESTAMP"):
+            converted = pd.to_datetime(raw, errors="coerce", format="ISO8601")
+        else:
+            # STRING, CHAR, wide DECIMAL and nested types stay as they are
+            return raw
+    except (ValueError, TypeError, OverflowError):
+        return raw
+
+    if converted.isna().sum() > raw.isna().sum():
+        return raw
+    return converted
+
+def categorize_strings(df: pd.DataFrame, specs: list) -> pd.DataFrame:
+    """Turn low-cardinality string columns into categoricals. Run once on the full frame so chunks share categories."""
+    if len(df) < CATEGORICAL_MIN_ROWS:
+        return df
+    for name, type_name, _, _ in specs:
+        if type_name in ("STRING", "CHAR") and name in df.columns and df[name].dtype == object:
+            if df[name].nunique(dropna=True) <= CATEGORICAL_MAX_UNIQUE_RATIO * len(df):
+                df[name] = df[name].astype("category")
+    return df
+
+def build_typed_dataframe(data_array: list, schema_columns: list, categorize: bool = True) -> pd.DataFrame:
+    """Build a DataFrame from row-major wire values using the result schema: numbers, booleans and dates
+    get real dtypes (downcast where safe) and, with categorize=True, repetitive strings become categoricals."""
+    specs = column_specs(schema_columns)
+    if not specs and data_array:
+        specs = [(f"column_{i}", None, None, None) for i in range(len(data_array[0]))]
+    names = [name for name, _, _, _ in specs]
+    if not data_array:
+        return pd.DataFrame(columns=names)
+
+    # Transpose once, then convert column by column with vectorized pandas converters
+    columns = list(zip(*data_array))
+    df = pd.DataFrame({
+        name: convert_column(values, type_name, precision, scale)
+        for (name, type_name, precision, scale), values in zip(specs, columns)
+    })
+    return categorize_strings(df, specs) if categorize else df
+
+async def process_genie_response_async(client: AsyncGenieClient, conversation_id, message_id, complete_message) -> Tuple[Union[str, pd.DataFrame], Optional[str]]:
     """Process the response from Genie"""
     # Check attachments first
     attachments = complete_message.get("attachments", [])
     for attachment in attachments:
         attachment_id = attachment.get("attachment_id")
-        
+
         # If there's text content in the attachment, return it
         if "text" in attachment and "content" in attachment["text"]:
             return attachment["text"]["content"], None
-        
+
         # If there's a query, get the result
         elif "query" in attachment:
             query_text = attachment.get("query", {}).get("query", "")
-            query_result = client.get_query_result(conversation_id, message_id, attachment_id)
-           
+            query_result = await client.get_query_result(conversation_id, message_id, attachment_id)
+
             data_array = query_result.get('data_array', [])
             schema = query_result.get('schema', {})
-            columns = [col.get('name') for col in schema.get('columns', [])]
-            
-            # If we have data, return as DataFrame
+
+            # If we have data, return as DataFrame typed from the schema (generic column names if it has none)
             if data_array:
-                # If no columns from schema, create generic ones
-                if not columns and data_array and len(data_array) > 0:
-                    columns = [f"column_{i}" for i in range(len(data_array[0]))]
-                
-                df = pd.DataFrame(data_array, columns=columns)
+                df = await asyncio.to_thread(build_typed_dataframe, data_array, schema.get('columns', []))
                 return df, query_text
-    
+
     # If no attachments or no data in attachments, return text content
     if 'content' in complete_message:
         return complete_message.get('content', ''), None
-    
+
     return "No response available", None
-    
-def start_new_conversation(question: str, token: str, space_id: str, http_path: str, catalog: str, schema: str, attachment: bytes = None, filename: str = None) -> Tuple[str, Union[str, pd.DataFrame], Optional[str]]:
-    """Start a new conversation with Genie, optionally including an attachment."""
-    client = GenieClient(
-        host=DATABRICKS_HOST,
-        space_id=space_id,
-        token=token
+
+def process_genie_response(client, conversation_id, message_id, complete_message) -> Tuple[Union[str, pd.DataFrame], Optional[str]]:
+    """Process the response from Genie (sync wrapper, accepts a GenieClient or an AsyncGenieClient)."""
+    if not isinstance(client, AsyncGenieClient):
+        client = AsyncGenieClient(client)
+    return event_loop.run(process_genie_response_async(client, conversation_id, message_id, complete_message))
+
+def write_batch(key: tuple, events: list):
+    """Write one batch of same-operation events for one (http_path, token, catalog, schema) target."""
+    operation, http_path, token, catalog, schema = key
+    with sql_pool.connection(DATABRICKS_HOST, http_path, token) as conn, conn.cursor() as cursor:
+        PersistenceStatements(catalog, schema).apply(cursor, operation, events)
+    logger.info(f"Persisted {len(events)} {operation} events.")
+
+def queue_failed_batch(key: tuple, events: list, error: Exception):
+    """Events are offline queue payloads already, so a failed batch is queued as is for reprocessing."""
+    logging.warning(f"Error persisting {len(events)} {key[0]} events: {str(error)} — Falling back to offline queue.")
+    offline_queue.enqueue_many(events)
+
+# Process-wide write-behind worker, flushed at exit
+persistence_writer = PersistenceWriter(write_batch, queue_failed_batch, max_batch=PERSIST_BATCH_SIZE, flush_interval=PERSIST_FLUSH_SECONDS,
+                                       order=lambda key: PersistenceStatements.rank(key[0]))
+atexit.register(persistence_writer.stop)
+
+def persist_event(token: str, http_path: str, catalog: str, schema: str, payload: dict):
+    """Hand an offline-queue shaped payload to the write-behind worker."""
+    persistence_writer.submit((payload["operation"], http_path, token, catalog, schema), payload)
+
+def summarize_titles(key: tuple, events: list):
+    """Generate AI titles for a batch of conversations with one AI_SUMMARIZE statement, publish them and
+    queue the conversations update."""
+    operation, http_path, token, catalog, schema = key
+    titles = {}
+    with sql_pool.connection(DATABRICKS_HOST, http_path, token) as conn, conn.cursor() as cursor:
+        for chunk in param_chunks(events, 2):
+            cursor.execute(f"""
+                            SELECT conversation_id, AI_SUMMARIZE(chat_title, 5) AS summarized_title
+                            FROM VALUES {values_rows(2, len(chunk))} AS src(conversation_id, chat_title)
+                            """, [value for e in chunk for value in (e["conversation_id"], e["chat_title"])])
+            titles.update({conversation_id: title for conversation_id, title in cursor.fetchall()})
+    logger.info(f"Generated {len(titles)} conversation titles.")
+
+    for conversation_id, title in titles.items():
+        title_updates.put(conversation_id, title)
+
+    # The conversations rows must be written before their title update
+    persistence_writer.flush()
+    for conversation_id, title in titles.items():
+        persist_event(token, http_path, catalog, schema, {
+            "conversation_id": conversation_id,
+            "ai_title": title,
+            "operation": "update_title"
+        })
+
+# Process-wide title worker, stopped at exit before the persistence worker it feeds
+title_writer = PersistenceWriter(summarize_titles, queue_failed_batch, max_batch=TITLE_BATCH_SIZE, flush_interval=TITLE_FLUSH_SECONDS, name="title-summarizer")
+atexit.register(title_writer.stop)
+
+def drain_offline_queue() -> bool:
+    """Reprocess the offline queue with the app credentials. False while the warehouse rejects the writes."""
+    if not len(offline_queue):
+        return True
+    return reprocess_offline_queue(offline_queue, DATABRICKS_HOST, os.environ.get("DATABRICKS_TOKEN"),
+                                   os.environ.get("HTTP_PATH"), os.environ.get("CATALOG"), os.environ.get("SCHEMA"))
+
+# Process-wide drain scheduler (opt-in), stopped at exit first
+drain_scheduler = None
+if OFFLINE_DRAIN_INTERVAL_SECONDS > 0:
+    drain_scheduler = DrainScheduler(drain_offline_queue, interval=OFFLINE_DRAIN_INTERVAL_SECONDS, lock_file=OFFLINE_DRAIN_LOCK_FILE).start()
+    atexit.register(drain_scheduler.stop)
+
+def request_title(token: str, http_path: str, catalog: str, schema: str, conversation_id: str, chat_title: str):
+    """Queue AI title generation for a conversation."""
+    title_writer.submit(("generate_title", http_path, token, catalog, schema), {
+        "conversation_id": conversation_id,
+        "chat_title": chat_title,
+        "operation": "generate_title"
+    })
+
+def persist_new_conversation(token: str, http_path: str, catalog: str, schema: str, space_id: str, conversation_id: str, user_id: str, chat_title: str, created_timestamp: str, message_id: str, question: str, assistant_description: str, filename: Optional[str], query_text: Optional[str]) -> Optional[str]:
+    """Queue a new conversation and its first message for write-behind persistence, and its AI title generation.
+    Returns the title to show until the AI title arrives in title_updates."""
+    persist_event(token, http_path, catalog, schema, {
+        "space_id": space_id,
+        "conversation_id": conversation_id,
+        "user_id": user_id,
+        "chat_title": chat_title,
+        "ai_title": None,
+        "created_timestamp": created_timestamp,
+        "message_id": message_id,
+        "prompt": question,
+        "completion": assistant_description,
+        "user_attachment": filename,
+        "assistant_attachment": query_text,
+        "operation": "insert_new_conversation"
+    })
+    request_title(token, http_path, catalog, schema, conversation_id, chat_title)
+    return chat_title
+
+def persist_message(token: str, http_path: str, catalog: str, schema: str, space_id: str, conversation_id: str, user_id: str, created_timestamp: str, message_id: str, question: str, assistant_description: str, filename: Optional[str], query_text: Optional[str]):
+    """Queue a follow-up message for write-behind persistence."""
+    persist_event(token, http_path, catalog, schema, {
+        "message_id": message_id,
+        "conversation_id": conversation_id,
+        "space_id": space_id,
+        "user_id": user_id,
+        "prompt": question,
+        "completion": assistant_description,
+        "user_attachment": filename,
+        "assistant_attachment": query_text,
+        "created_timestamp": created_timestamp,
+        "operation": "insert_message"
+    })
+
+def persist_login(token: str, http_path: str, catalog: str, schema: str, user: dict):
+    """Queue a login (insert or update of users_info) for write-behind persistence."""
+    persist_event(token, http_path, catalog, schema, {
+        "user_id": user["user_id"],
+        "user_name": user["user_name"],
+        "email": user["email"],
+        "groups": list(user.get("groups", [])),
+        "login_timestamp": datetime.now(timezone.utc).isoformat(),
+        "operation": "upsert_user"
+    })
+
+async def start_cached_conversation_async(question: str, token: str, space_id: str, http_path: str, catalog: str, schema: str, warehouse_id: str, cached: dict) -> Tuple[str, Union[str, pd.DataFrame], Optional[str]]:
+    """Answer a repeated question from the answer cache: re-run its SQL on the warehouse, no LLM generation."""
+    conversation_id = f"{CACHED_ID_PREFIX}{uuid.uuid4().hex}"
+    message_id = f"{CACHED_ID_PREFIX}{uuid.uuid4().hex}"
+    query_text = cached["query_text"]
+    assistant_description = cached["description"]
+
+    user_info, result = await asyncio.gather(
+        current_user_async(space_id, token),
+        execute_sql_with_polling_async(space_id, token, http_path, catalog, schema, warehouse_id, message_id, query_text, use_external=False, record_run=False)
     )
-    queue = offline_queue
-    
+    answer_aliases.put(conversation_id, {"question": question, "query_text": query_text, "genie_conversation_id": None})
+    logging.info(f"Answered from cache as conversation {conversation_id} ({len(result)} rows).")
+
+    # Persist conversation and messages to database
+    created_timestamp = datetime.now(timezone.utc).isoformat()
+    ai_title = persist_new_conversation(token, http_path, catalog, schema, space_id, conversation_id, user_info["user_id"], question, created_timestamp, message_id, question, assistant_description, None, query_text)
+
+    return conversation_id, result, query_text, message_id, assistant_description, ai_title
+
+async def start_new_conversation_async(question: str, token: str, space_id: str, http_path: str, catalog: str, schema: str, attachment: bytes = None, filename: str = None, warehouse_id: Optional[str] = None, use_answer_cache: bool = True) -> Tuple[str, Union[str, pd.DataFrame], Optional[str]]:
+    """Start a new conversation with Genie, optionally including an attachment.
+    Repeated questions are answered from the answer cache when warehouse_id is given and use_answer_cache is set."""
+    client = async_client(space_id, token)
+    cache_key = (space_id, normalize_question(question))
+    use_answer_cache = use_answer_cache and bool(warehouse_id) and not attachment
+
     try:
-        # Start a new conversation
-        response = client.start_conversation(question)
+        if use_answer_cache:
+            cached = answer_cache.get(cache_key)
+            if cached is not None:
+                try:
+                    return await start_cached_conversation_async(question, token, space_id, http_path, catalog, schema, warehouse_id, cached)
+                except Exception as e:
+                    logging.warning(f"Cached answer failed, asking Genie instead: {str(e)}")
+                    answer_cache.invalidate(cache_key)
+
+        # Start a new conversation (returns once accepted, completion is polled below)
+        response = await client.start_conversation(question)
         space_id = response["space_id"]
         conversation_id = response["conversation_id"]
         message_id = response["message_id"]
         user_id = response["user_id"]
         chat_title = response["chat_title"]
         created_timestamp = response["created_timestamp"]
-        assistant_description = response["assistant_description"]
 
         logging.info(f"Started new conversation {conversation_id} in Genie.")
 
         # If an attachment is provided, upload it
         if attachment and filename:
-            client.upload_message_attachment(conversation_id, message_id, attachment, filename)
+            await client.upload_message_attachment(conversation_id, message_id, attachment, filename)
             logging.info(f"Uploaded attachment {filename} to conversation {conversation_id}.")
-        
+
         # Wait for the message to complete
-        complete_message = client.wait_for_message_completion(conversation_id, message_id)
-        
+        complete_message = await client.wait_for_message_completion(conversation_id, message_id)
+        assistant_description = str(client.message_description(complete_message))
+
         # Process the response
-        result, query_text = process_genie_response(client, conversation_id, message_id, complete_message)
+        result, query_text = await process_genie_response_async(client, conversation_id, message_id, complete_message)
 
-        # Persist conversation and messages to database
-        try:
-            with sql.connect(
-            server_hostname=DATABRICKS_HOST,
-            http_path=http_path,
-            access_token=token
-            ) as conn:
-                cursor = conn.cursor()
-
-                # Generate friendly conversation title
-                cursor.execute(f"""
-                                SELECT AI_SUMMARIZE(?, 5) AS summarized_title
-                                """, (chat_title,))
-                ai_title = cursor.fetchone()[0]
-
-                # Save conversation
-                cursor.execute(f"""
-                                INSERT INTO {catalog}.{schema}.conversations 
-                                (space_id, conversation_id, user_id, chat_title, ai_title, created_timestamp)
-                                VALUES (?, ?, ?, ?, ?, ?)
-                                """, (space_id, conversation_id, user_id, chat_title, ai_title, datetime.fromisoformat(created_timestamp)))
-
-                # Save messages
-                cursor.execute(f"""
-                                INSERT INTO {catalog}.{schema}.messages 
-                                (message_id, conversation_id, space_id, user_id, prompt, completion, user_attachment, assistant_attachment, created_timestamp, rating, sql_run_version)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                """, (message_id, conversation_id, space_id, user_id, question, assistant_description, filename, query_text, datetime.fromisoformat(created_timestamp), None, 1))
-
-            logging.info(f"Persisted conversation {conversation_id} and initial messages.")
-
-        except Exception as db_err:
-            logging.warning(f"Error persisting conversation {conversation_id}: {str(db_err)} — Falling back to offline queue.")
-
-            # Queue the data for later insertion
-            queue.enqueue({
-                "space_id": space_id,
-                "conversation_id": conversation_id,
-                "user_id": user_id,
-                "chat_title": chat_title,
-                "created_timestamp": created_timestamp,
-                "message_id": message_id,
-                "prompt": question,
-                "completion": assistant_description,
-                "user_attachment": filename,
-                "assistant_attachment": query_text,
-                "operation": "insert_new_conversation"
-            })
+        # Remember generated SQL so the same question can skip Genie next time
+        if use_answer_cache and query_text and isinstance(result, pd.DataFrame):
+            answer_cache.put(cache_key, {"query_text": query_text, "description": assistant_description})
 
-        finally:
-            try:
-                cursor.close()
-                conn.close()
-                logging.info("Closed Databricks SQL connection.")
-            except Exception as close_err:
-                logging.warning(f"Error closing connection: {str(close_err)}")
+        # Persist conversation and messages to database
+        ai_title = persist_new_conversation(token, http_path, catalog, schema, space_id, conversation_id, user_id, chat_title, created_timestamp, message_id, question, assistant_description, filename, query_text)
 
         return conversation_id, result, query_text, message_id, assistant_description, ai_title
-        
+
     except Exception as e:
         logging.error(f"Error starting new conversation: {str(e)}")
         return None, f"Sorry, an error occurred: {str(e)}. Please try again.", None, None, None, None
 
-def continue_conversation(conversation_id: str, question: str, token: str, space_id: str, http_path: str, catalog: str, schema: str, attachment: bytes = None, filename: str = None) -> Tuple[Union[str, pd.DataFrame], Optional[str]]:
+def start_new_conversation(question: str, token: str, space_id: str, http_path: str, catalog: str, schema: str, attachment: bytes = None, filename: str = None, warehouse_id: Optional[str] = None, use_answer_cache: bool = True) -> Tuple[str, Union[str, pd.DataFrame], Optional[str]]:
+    """Start a new conversation with Genie, optionally including an attachment."""
+    return event_loop.run(start_new_conversation_async(question, token, space_id, http_path, catalog, schema, attachment=attachment, filename=filename, warehouse_id=warehouse_id, use_answer_cache=use_answer_cache))
+
+def load_answer_alias(token: str, http_path: str, catalog: str, schema: str, conversation_id: str) -> Optional[dict]:
+    """Original question, SQL and Genie conversation of a conversation answered from cache, from its persisted rows."""
+    with sql_pool.connection(DATABRICKS_HOST, http_path, token) as conn, conn.cursor() as cursor:
+        cursor.execute(f"""
+                        SELECT m.prompt, m.assistant_attachment, c.genie_conversation_id
+                        FROM {catalog}.{schema}.conversations c
+                        JOIN {catalog}.{schema}.messages m ON m.conversation_id = c.conversation_id
+                        WHERE c.conversation_id = ?
+                        ORDER BY m.created_timestamp, m.message_id
+                        LIMIT 1
+                        """, (conversation_id,))
+        row = cursor.fetchone()
+    if row is None:
+        return None
+    return {"question": row[0], "query_text": row[1], "genie_conversation_id": row[2]}
+
+async def answer_alias_async(token: str, http_path: str, catalog: str, schema: str, conversation_id: str) -> Optional[dict]:
+    """Alias of a conversation answered from cache (see answer_aliases), None for Genie conversations."""
+    if not is_cached_id(conversation_id):
+        return None
+    alias = answer_aliases.get(conversation_id)
+    if alias is None:
+        # Conversation still queued for write-behind: its row may not be there yet
+        await asyncio.to_thread(persistence_writer.flush)
+        alias = await asyncio.to_thread(load_answer_alias, token, http_path, catalog, schema, conversation_id)
+        if alias is None:
+            raise LookupError("Conversation not found")
+        answer_aliases.put(conversation_id, alias)
+    return alias
+
+def persist_conversation_link(token: str, http_path: str, catalog: str, schema: str, conversation_id: str, genie_conversation_id: str):
+    """Queue the link from a conversation answered from cache to the Genie conversation opened behind it."""
+    persist_event(token, http_path, catalog, schema, {
+        "conversation_id": conversation_id,
+        "genie_conversation_id": genie_conversation_id,
+        "operation": "link_conversation"
+    })
+
+def follow_up_prompt(alias: dict, question: str) -> str:
+    """First message of the Genie conversation opened behind a cached answer: the original question and its SQL
+    give Genie the context of the follow-up, so it takes one generation instead of two."""
+    return (f"Earlier question: {alias['question']}\n"
+            f"It was answered with this SQL:\n{alias['query_text']}\n\n"
+            f"Follow-up question: {question}")
+
+async def continue_conversation_async(conversation_id: str, question: str, token: str, space_id: str, http_path: str, catalog: str, schema: str, attachment: bytes = None, filename: str = None) -> Tuple[Union[str, pd.DataFrame], Optional[str]]:
     """Send a follow-up message in an existing conversation."""
     logger.info(f"Continuing conversation {conversation_id} with question: {question[:30]}...")
-    client = GenieClient(
-        host=DATABRICKS_HOST,
-        space_id=space_id,
-        token=token
-    )
-    queue = offline_queue
-    
+    client = async_client(space_id, token)
+
     try:
-        # Send follow-up message in existing conversation
-        response = client.send_message(conversation_id, question)
+        # Send follow-up message in existing conversation (returns once accepted, completion is polled below).
+        # The first follow-up of a conversation answered from cache opens its Genie conversation instead.
+        alias = await answer_alias_async(token, http_path, catalog, schema, conversation_id)
+        if alias is not None and alias["genie_conversation_id"] is None:
+            response = await client.start_conversation(follow_up_prompt(alias, question))
+            genie_conversation_id = alias["genie_conversation_id"] = response["conversation_id"]
+            persist_conversation_link(token, http_path, catalog, schema, conversation_id, genie_conversation_id)
+            logging.info(f"Opened Genie conversation {genie_conversation_id} behind {conversation_id}.")
+        else:
+            genie_conversation_id = alias["genie_conversation_id"] if alias else conversation_id
+            response = await client.send_message(genie_conversation_id, question)
         message_id = response["message_id"]
         user_id = response["user_id"]
         created_timestamp = response["created_timestamp"]
-        assistant_description = response["assistant_description"]
 
         # If an attachment is provided, upload it
         if attachment and filename:
-            client.upload_message_attachment(conversation_id, message_id, attachment, filename)
-        
+            await client.upload_message_attachment(genie_conversation_id, message_id, attachment, filename)
+
         # Wait for the message to complete
-        complete_message = client.wait_for_message_completion(conversation_id, message_id)
-        
+        complete_message = await client.wait_for_message_completion(genie_conversation_id, message_id)
+        assistant_description = str(client.message_description(complete_message))
+
         # Process the response
-        result, query_text = process_genie_response(client, conversation_id, message_id, complete_message)
+        result, query_text = await process_genie_response_async(client, genie_conversation_id, message_id, complete_message)
 
         # Persist messages to database
-        try:
-            with sql.connect(
-            server_hostname=DATABRICKS_HOST,
-            http_path=http_path,
-            access_token=token
-            ) as conn:
-                cursor = conn.cursor()
-
-                # Save messages
-                cursor.execute(f"""
-                                INSERT INTO {catalog}.{schema}.messages 
-                                (message_id, conversation_id, space_id, user_id, prompt, completion, user_attachment, assistant_attachment, created_timestamp, rating, sql_run_version)
-                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                """, (message_id, conversation_id, space_id, user_id, question, assistant_description, filename, query_text, datetime.fromisoformat(created_timestamp), None, 1))
-
-            logging.info(f"Persisted follow-up message {message_id}.")
-
-        except Exception as db_err:
-            logging.warning(f"Error persisting follow-up message {message_id}: {str(db_err)} — Falling back to offline queue.")
-
-            # Queue the data for later insertion
-            queue.enqueue({
-                "message_id": message_id,
-                "conversation_id": conversation_id,
-                "space_id": space_id,
-                "user_id": user_id,
-                "prompt": question,
-                "completion": assistant_description,
-                "user_attachment": filename,
-                "assistant_attachment": query_text,
-                "created_timestamp": created_timestamp,
-                "operation": "insert_message"
-            })
+        persist_message(token, http_path, catalog, schema, space_id, conversation_id, user_id, created_timestamp, message_id, question, assistant_description, filename, query_text)
 
-        finally:
-            try:
-                cursor.close()
-                conn.close()
-                logging.info("Closed Databricks SQL connection.")
-            except Exception as close_err:
-                logging.warning(f"Error closing connection: {str(close_err)}")
-        
         return result, query_text, message_id, assistant_description
-        
+
     except Exception as e:
         # Handle specific errors
         if "429" in str(e) or "Too Many Requests" in str(e):
-            return "Sorry, the system is currently experiencing high demand. Please try again in a few moments.", None
+            return "Sorry, the system is currently experiencing high demand. Please try again in a few moments.", None, None, None
         elif "Conversation not found" in str(e):
-            return "Sorry, the previous conversation has expired. Please try your query again to start a new conversation.", None
+            return "Sorry, the previous conversation has expired. Please try your query again to start a new conversation.", None, None, None
         else:
             logger.error(f"Error continuing conversation: {str(e)}")
             return f"Sorry, an error occurred: {str(e)}", None, None, None
-    
-def send_message_feedback(token: str, space_id: str, conversation_id: str, message_id: str, rating, http_path: str, catalog: str, schema: str):
+
+def continue_conversation(conversation_id: str, question: str, token: str, space_id: str, http_path: str, catalog: str, schema: str, attachment: bytes = None, filename: str = None) -> Tuple[Union[str, pd.DataFrame], Optional[str]]:
+    """Send a follow-up message in an existing conversation."""
+    return event_loop.run(continue_conversation_async(conversation_id, question, token, space_id, http_path, catalog, schema, attachment=attachment, filename=filename))
+
+def persist_rating(token: str, http_path: str, catalog: str, schema: str, conversation_id: str, message_id: str, rating):
+    """Queue a message rating for write-behind persistence."""
+    persist_event(token, http_path, catalog, schema, {
+        "conversation_id": conversation_id,
+        "message_id": message_id,
+        "rating": str(rating).split('.')[-1],
+        "operation": "update_rating"
+    })
+
+async def send_message_feedback_async(token: str, space_id: str, conversation_id: str, message_id: str, rating, http_path: str, catalog: str, schema: str):
     """Send message feedback for a specific message in a conversation."""
-    client = GenieClient(
-        host=DATABRICKS_HOST,
-        space_id=space_id,
-        token=token
-    )
-    queue = offline_queue
+    client = async_client(space_id, token)
 
     try:
-        client.send_feedback(space_id, conversation_id, message_id, rating)
-        logger.info(f"Sent rating {str(rating)} for message {message_id} in conversation {conversation_id}.")
-    
-        with sql.connect(
-            server_hostname=DATABRICKS_HOST,
-            http_path=http_path,
-            access_token=token
-        ) as conn:
-            cursor = conn.cursor()
-
-            cursor.execute(f"""
-                            UPDATE {catalog}.{schema}.messages
-                            SET rating = ?
-                            WHERE message_id = ?
-                            """, (str(rating).split('.')[-1], message_id))
-            
-            logger.info(f"Message {message_id} rating in conversation {conversation_id} updated in Database.")
+        # Answers served from cache have no Genie message to rate, only the database row
+        if not is_cached_id(message_id):
+            alias = await answer_alias_async(token, http_path, catalog, schema, conversation_id)
+            genie_conversation_id = alias["genie_conversation_id"] if alias else conversation_id
+            await client.send_feedback(space_id, genie_conversation_id, message_id, rating)
+            logger.info(f"Sent rating {str(rating)} for message {message_id} in conversation {conversation_id}.")
 
     except Exception as e:
-        logger.error(f"Error getting feedback: {str(e)} — Falling back to offline queue.")
+        logger.error(f"Error sending feedback to Genie: {str(e)}")
 
-        # Queue the data for later insertion
-        queue.enqueue({
-                "message_id": message_id,
-                "rating": str(rating),
-                "operation": "update_rating"
-            })
-    
-    finally:
-        try:
-            cursor.close()
-            conn.close()
-            logging.info("Closed Databricks SQL connection successfully.")
-        except Exception as close_err:
-            logging.warning(f"Error closing connection: {str(close_err)}")
-    
-def delete_conversation(token: str, space_id: str, conversation_id: str, http_path: str, catalog: str, schema: str):
+    # The rating is stored either way (write-behind, offline queue on failure)
+    persist_rating(token, http_path, catalog, schema, conversation_id, message_id, rating)
+
+def send_message_feedback(token: str, space_id: str, conversation_id: str, message_id: str, rating, http_path: str, catalog: str, schema: str):
+    """Send message feedback for a specific message in a conversation."""
+    return event_loop.run(send_message_feedback_async(token, space_id, conversation_id, message_id, rating, http_path, catalog, schema))
+
+def persist_delete(token: str, http_path: str, catalog: str, schema: str, conversation_id: str):
+    """Delete a conversation and its messages from the database, leaving a tombstone for other sessions."""
+    with sql_pool.connection(DATABRICKS_HOST, http_path, token) as conn, conn.cursor() as cursor:
+        PersistenceStatements(catalog, schema).deletes(cursor, [{"conversation_id": conversation_id}])
+
+    logger.info(f"Deleted conversation {conversation_id} and its messages from Database.")
+
+async def delete_conversation_async(token: str, space_id: str, conversation_id: str, http_path: str, catalog: str, schema: str):
     """Delete conversation in a specific Genie space."""
-    client = GenieClient(
-        host=DATABRICKS_HOST,
-        space_id=space_id,
-        token=token
-    )
-    queue = offline_queue
-    
+    client = async_client(space_id, token)
+
     try:
-        client.delete_conversation(space_id, conversation_id)
-        logger.info(f"Deleted conversation {conversation_id} in Genie.")
+        # Conversations served from cache only exist in Genie once a follow-up opened one
+        if is_cached_id(conversation_id):
+            try:
+                alias = await answer_alias_async(token, http_path, catalog, schema, conversation_id)
+            except LookupError:
+                alias = None
+            answer_aliases.invalidate(conversation_id)
+            genie_conversation_id = alias["genie_conversation_id"] if alias else None
+        else:
+            genie_conversation_id = conversation_id
+        if genie_conversation_id:
+            await client.delete_conversation(space_id, genie_conversation_id)
+            logger.info(f"Deleted conversation {genie_conversation_id} in Genie.")
 
-        with sql.connect(
-            server_hostname=DATABRICKS_HOST,
-            http_path=http_path,
-            access_token=token
-        ) as conn:
-            cursor = conn.cursor()
+        # Pending write-behind inserts for this conversation must land before the delete
+        await asyncio.to_thread(persistence_writer.flush)
 
-            # Delete messages from DB
-            cursor.execute(f"""
-                            DELETE FROM {catalog}.{schema}.messages 
-                            WHERE conversation_id = ? 
-                            """, (conversation_id,))
+        await asyncio.to_thread(persist_delete, token, http_path, catalog, schema, conversation_id)
 
-            # Delete conversation from DB
-            cursor.execute(f"""
-                            DELETE FROM {catalog}.{schema}.conversations 
-                            WHERE conversation_id = ? 
-                            """, (conversation_id,))
-        
-        logger.info(f"Deleted conversation {conversation_id} and its messages from Database.")
-    
     except Exception as e:
         logger.error(f"Error deleting conversation {conversation_id}: {str(e)} — Falling back to offline queue.")
-    
+
         # Queue the data for later insertion
-        queue.enqueue({
+        offline_queue.enqueue({
                 "conversation_id": conversation_id,
                 "operation": "delete"
             })
-    
-    finally:
+
+def delete_conversation(token: str, space_id: str, conversation_id: str, http_path: str, catalog: str, schema: str):
+    """Delete conversation in a specific Genie space."""
+    return event_loop.run(delete_conversation_async(token, space_id, conversation_id, http_path, catalog, schema))
+
+def persist_sql_run_version(token: str, http_path: str, catalog: str, schema: str, message_id: str):
+    """Queue a sql_run_version bump for a message whose SQL was re-executed. It is written after the message
+    insert, which may still be queued itself."""
+    persist_event(token, http_path, catalog, schema, {
+        "message_id": message_id,
+        "operation": "increment_sql_run_version"
+    })
+
+def download_csv(url: str, headers: Optional[dict] = None) -> pd.DataFrame:
+    """Stream one external link straight into the CSV parser, without buffering the whole body."""
+    with download_session.get(url, headers=headers, stream=True, timeout=(10, 300)) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
         try:
-            cursor.close()
-            conn.close()
-            logging.info("Closed Databricks SQL connection successfully.")
-        except Exception as close_err:
-            logging.warning(f"Error closing connection: {str(close_err)}")
+            # CSV to DataFrame
+            return pd.read_csv(resp.raw)
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame()
+
+def read_arrow_stream(source) -> pd.DataFrame:
+    """Decode an Arrow IPC stream into a DataFrame backed by the Arrow buffers (no per-value conversion or copy)."""
+    table = pa.ipc.open_stream(source).read_all()
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+def download_arrow(url: str, headers: Optional[dict] = None) -> pd.DataFrame:
+    """Stream one external link straight into the Arrow IPC reader."""
+    with download_session.get(url, headers=headers, stream=True, timeout=(10, 300)) as resp:
+        resp.raise_for_status()
+        resp.raw.decode_content = True
+        return read_arrow_stream(resp.raw)
+
+def link_expires_soon(link) -> bool:
+    """True if a presigned external link is expired or about to expire."""
+    expiration = getattr(link, "expiration", None)
+    if not expiration:
+        return False
+    try:
+        expires_at = datetime.fromisoformat(expiration.replace("Z", "+00:00"))
+    except ValueError:
+        return False
+    return (expires_at - datetime.now(expires_at.tzinfo)).total_seconds() < LINK_EXPIRY_MARGIN_SECONDS
+
+async def fetch_external_chunks(client: AsyncGenieClient, statement_id: str, stmt, download: Callable = download_csv, max_concurrency: int = CHUNK_FETCH_CONCURRENCY) -> pd.DataFrame:
+    """Download every EXTERNAL_LINKS chunk in parallel over the pooled session and concatenate them in chunk order.
+    Links that expire before or during the download are refreshed with get_chunk and retried once."""
+    inline_links = {link.chunk_index: link for link in (getattr(stmt.result, "external_links", None) or [])}
+    total_chunks = getattr(stmt.manifest, "total_chunk_count", None) or len(inline_links)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def fresh_link(idx: int):
+        chunk = await client.get_chunk(statement_id, idx)
+        return chunk.external_links[0]
+
+    async def fetch(idx: int) -> pd.DataFrame:
+        async with semaphore:
+            link = inline_links.get(idx)
+            if link is None or link_expires_soon(link):
+                link = await fresh_link(idx)
+            try:
+                return await asyncio.to_thread(download, link.external_link, link.http_headers)
+            except requests.HTTPError as err:
+                # Presigned URLs answer 403 once expired: refresh the link and retry once
+                if err.response is None or err.response.status_code not in (400, 403):
+                    raise
+                logger.info(f"External link for chunk {idx} of statement {statement_id} expired, refreshing.")
+                link = await fresh_link(idx)
+                return await asyncio.to_thread(download, link.external_link, link.http_headers)
+
+    start = time.perf_counter()
+    frames = await asyncio.gather(*(fetch(idx) for idx in range(total_chunks)))
+    logger.info(f"Downloaded {total_chunks} external result chunks for statement {statement_id} in {time.perf_counter() - start:.2f}s.")
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+async def fetch_json_chunks(client: AsyncGenieClient, statement_id: str, stmt, schema_columns: list, max_concurrency: int = CHUNK_FETCH_CONCURRENCY) -> pd.DataFrame:
+    """Fetch every JSON_ARRAY chunk listed in the manifest concurrently, turn each into a typed DataFrame as it
+    arrives and concatenate them once, in chunk order."""
+    specs = column_specs(schema_columns)
+    columns = [name for name, _, _, _ in specs]
+    total_chunks = getattr(stmt.manifest, "total_chunk_count", None)
+    first_chunk = getattr(stmt, "result", None)
+
+    # Manifest without chunk count: walk the chunk chain sequentially
+    if total_chunks is None:
+        frames = []
+        idx = 0
+        while True:
+            chunk = await client.get_chunk(statement_id, idx)
+            if not getattr(chunk, "data_array", None):
+                break
+            frames.append(build_typed_dataframe(chunk.data_array, schema_columns, categorize=False))
+            idx = getattr(chunk, "next_chunk_index", None)
+            if idx is None:
+                break
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+        return categorize_strings(df, specs)
 
-def execute_sql_with_polling(space_id: str, token: str, http_path: str, catalog: str, schema: str, warehouse_id: str, message_id: str, sql_text: str, use_external: bool, poll_interval=2, timeout=300):
-    """Executes SQL using statement_execution, waits, gets all chunks and returns a DataFrame."""
-    client = GenieClient(
-        host=DATABRICKS_HOST,
-        space_id=space_id,
-        token=token
-    )
+    semaphore = asyncio.Semaphore(max_concurrency)
 
-    if use_external:
-        disposition = Disposition.EXTERNAL_LINKS
-        fmt = Format.CSV
-    else:
-        disposition = Disposition.INLINE
-        fmt = Format.JSON_ARRAY
+    async def fetch(idx: int) -> pd.DataFrame:
+        # Chunk 0 usually arrives inline with the statement, no need to download it again
+        if idx == 0 and getattr(first_chunk, "data_array", None) is not None:
+            data_array = first_chunk.data_array
+        else:
+            async with semaphore:
+                chunk = await client.get_chunk(statement_id, idx)
+            data_array = getattr(chunk, "data_array", None) or []
+        return await asyncio.to_thread(build_typed_dataframe, data_array, schema_columns, False)
+
+    start = time.perf_counter()
+    frames = await asyncio.gather(*(fetch(idx) for idx in range(total_chunks)))
+    logger.info(f"Fetched {total_chunks} result chunks for statement {statement_id} in {time.perf_counter() - start:.2f}s.")
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    return categorize_strings(df, specs)
+
+async def execute_sql_with_polling_async(space_id: str, token: str, http_path: str, catalog: str, schema: str, warehouse_id: str, message_id: str, sql_text: str, use_external: bool, poll_interval=None, timeout=300, result_format: Optional[str] = None, force_refresh: bool = False, record_run: bool = True):
+    """Executes SQL using statement_execution, waits, gets all chunks and returns a DataFrame.
+    result_format picks a key of RESULT_FORMATS; by default use_external selects CSV links over inline JSON.
+    poll_interval=None polls the statement with the client's adaptive PollingStrategy.
+    Results are served from result_cache when the same normalized SQL ran recently, unless force_refresh is set.
+    record_run=False skips the sql_run_version bump (first run of a message answered from cache)."""
+    client = async_client(space_id, token)
+
+    if result_format is None:
+        result_format = "CSV" if use_external else "JSON_ARRAY"
+    disposition, fmt = RESULT_FORMATS[result_format]
+
+    # Serve recent identical statements from cache
+    scope = () if RESULT_CACHE_SHARED else (token_fingerprint(token),)
+    cache_key = result_cache.key(sql_text, warehouse_id, catalog, schema, result_format, *scope)
+    if not force_refresh:
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Result cache hit for message {message_id} ({len(cached)} rows).")
+            return cached
 
     # Execute statement
-    statement_id = client.execute_statement(warehouse_id, sql_text, disposition, fmt)
+    statement_id = await client.execute_statement(warehouse_id, sql_text, disposition, fmt)
 
     # Polling
-    start = time.time()
-    while True:
-        stmt = client.get_statement(statement_id)
-        state = stmt.status.state.value
-
-        if state in ["SUCCEEDED", "FAILED", "CANCELED", "CLOSED"]:
-            break
-
-        if time.time() - start > timeout:
-            raise TimeoutError(f"Statement {statement_id} timed out.")
-
-        time.sleep(poll_interval)
+    stmt = await client.wait_for_statement(statement_id, timeout=timeout, poll_interval=poll_interval)
+    state = stmt.status.state.value
 
     # Update sql_run_version if succeeded
-    if state == "SUCCEEDED":
-        try:
-            with sql.connect(
-                server_hostname=DATABRICKS_HOST,
-                http_path=http_path,
-                access_token=token
-            ) as conn:
-                cursor = conn.cursor()
-
-                # Update sql_run_version in DB
-                cursor.execute(f"""
-                                UPDATE {catalog}.{schema}.messages
-                                SET sql_run_version = sql_run_version + 1
-                                WHERE message_id = ?
-                                """, (message_id,))
-        
-            logger.info(f"Update message {message_id} in Database.")
-    
-        except Exception as e:
-            logger.error(f"Error updating message {message_id}: {str(e)}.")
-
-        finally:
-            try:
-                cursor.close()
-                conn.close()
-                logging.info("Closed Databricks SQL connection successfully.")
-            except Exception as close_err:
-                logging.warning(f"Error closing connection: {str(close_err)}")
+    if state == "SUCCEEDED" and record_run:
+        persist_sql_run_version(token, http_path, catalog, schema, message_id)
 
     logger.info(f"Statement result format: {fmt}")
 
     # Get results based on response disposition and format
     if fmt == Format.JSON_ARRAY:
 
-        chunks = []
-        idx = 0
-
-        while True:
-            chunk = client.get_chunk(statement_id, idx)
-
-            if not getattr(chunk, "data_array", None):
-                break
-
-            chunks.extend(chunk.data_array)
-            next_idx = getattr(chunk, "next_chunk_index", None)
-            if next_idx is None:
-                break
-            idx = next_idx
-
-        columns = [col.name for col in stmt.manifest.schema.columns]
-        df = pd.DataFrame(chunks, columns=columns)
+        df = await fetch_json_chunks(client, statement_id, stmt, stmt.manifest.schema.columns)
 
     elif fmt == Format.CSV:
-        dfs = []
-
-        for link in stmt.result.external_links:
-            url = link.external_link
+        df = await fetch_external_chunks(client, statement_id, stmt, download=download_csv)
 
-            resp = requests.get(url)
-            resp.raise_for_status()
+    elif fmt == Format.ARROW_STREAM:
+        columns = [col.name for col in stmt.manifest.schema.columns]
+        df = await fetch_external_chunks(client, statement_id, stmt, download=download_arrow)
+        if df.empty and not len(df.columns):
+            df = pd.DataFrame(columns=columns)
 
-            # CSV to DataFrame
-            df_part = pd.read_csv(BytesIO(resp.content))
-            dfs.append(df_part)
+    if state == "SUCCEEDED":
+        result_cache.put(cache_key, df, result_cache.freshness(sql_text))
 
-        df = pd.concat(dfs, ignore_index=True)
-    
     return df
 
-def current_user(space_id: str, token: str):
+def execute_sql_with_polling(space_id: str, token: str, http_path: str, catalog: str, schema: str, warehouse_id: str, message_id: str, sql_text: str, use_external: bool, poll_interval=None, timeout=300, result_format: Optional[str] = None, force_refresh: bool = False):
+    """Executes SQL using statement_execution, waits, gets all chunks and returns a DataFrame."""
+    return event_loop.run(execute_sql_with_polling_async(space_id, token, http_path, catalog, schema, warehouse_id, message_id, sql_text, use_external, poll_interval=poll_interval, timeout=timeout, result_format=result_format, force_refresh=force_refresh))
+
+async def current_user_async(space_id: str, token: str):
     """Get the current authenticated user information"""
-    client = GenieClient(
-        host=DATABRICKS_HOST,
-        space_id=space_id,
-        token=token
-    )
-    user = client.current_user()
+    key = token_fingerprint(token)
+    user = user_cache.get(key)
+    if user is None:
+        client = async_client(space_id, token)
+        user = await client.current_user()
+        user_cache.put(key, user)
     return user
 
-def semantic_search(space_id: str, token: str, http_path: str, catalog: str, schema: str, query_text: str):
+def current_user(space_id: str, token: str):
+    """Get the current authenticated user information"""
+    return event_loop.run(current_user_async(space_id, token))
+
+def persist_similarity_search(token: str, http_path: str, catalog: str, schema: str, space_id: str, user_info: dict, query_text: str, message_ids: list, results_str: list, score: list, timestamp: float):
+    """Queue a semantic search for write-behind persistence."""
+    persist_event(token, http_path, catalog, schema, {
+        "space_id": space_id,
+        "message_id": message_ids,
+        "user_id": user_info["user_id"],
+        "user_name": user_info["user_name"],
+        "user_email": user_info["email"],
+        "prompt": query_text,
+        "completion": results_str,
+        "score": score,
+        "created_timestamp": timestamp,
+        "operation": "insert_similar_search"
+    })
+
+async def check_semantic_index_version(client: AsyncGenieClient, catalog: str, schema: str) -> str:
+    """Drop cached searches for the index once its sync version changes. Throttled to one lookup per
+    SEMANTIC_INDEX_CHECK_SECONDS; if the lookup fails the cache just relies on its TTL."""
+    index_name = f"{catalog}.{schema}.{SEMANTIC_INDEX}"
+    if semantic_index_checks.get(index_name) is not None:
+        return index_name
+    semantic_index_checks.put(index_name, True)
+    try:
+        version = await client.index_version(SEMANTIC_INDEX, catalog, schema)
+    except Exception as e:
+        logger.warning(f"Could not read sync version of {index_name}: {str(e)}")
+        return index_name
+    previous = semantic_index_versions.get(index_name)
+    semantic_index_versions[index_name] = version
+    if previous is not None and previous != version:
+        dropped = semantic_cache.invalidate_where(lambda key: key[0] == index_name)
+        logger.info(f"Index {index_name} synced ({previous} -> {version}), dropped {dropped} cached searches")
+    return index_name
+
+async def semantic_search_async(space_id: str, token: str, http_path: str, catalog: str, schema: str, query_text: str, num_results: int = SEMANTIC_NUM_RESULTS):
     """Query vector search index for similar user questions (see vector_resources.py for further details)."""
-    import datetime
-    client = GenieClient(
-        host=DATABRICKS_HOST,
-        space_id=space_id,
-        token=token
-    )
-    queue = offline_queue
+    client = async_client(space_id, token)
 
     try:
-        user_info = client.current_user()
         columns = ["prompt", "completion", "assistant_attachment", "message_id", "user_id"]
         filters = json.dumps({"space_id": space_id})
-        results = client.similarity_search("messages_user_questions_index",
-                                           catalog,
-                                           schema,
-                                           columns,
-	                                       3,
-                                           query_text,
-                                           filters)
+        index_name = await check_semantic_index_version(client, catalog, schema)
+        key = (index_name, normalize_text(query_text), space_id, num_results)
+        results = semantic_cache.get(key)
+        if results is None:
+            user_info, results = await asyncio.gather(
+                current_user_async(space_id, token),
+                client.similarity_search(SEMANTIC_INDEX,
+                                         catalog,
+                                         schema,
+                                         columns,
+                                         num_results,
+                                         query_text,
+                                         filters)
+            )
+            semantic_cache.put(key, results)
+        else:
+            logger.info("Semantic search served from cache")
+            user_info = await current_user_async(space_id, token)
         results_str = [str(row[2]) for row in results]
         message_ids = [str(row[3]) for row in results]
         score = [float(row[-1]) for row in results]
-        results_str_array = "ARRAY(" + ", ".join(f"'{x}'" for x in results_str) + ")"
-        message_ids_array = "ARRAY(" + ", ".join(f"'{x}'" for x in message_ids) + ")"
-        score_array = "ARRAY(" + ", ".join(str(x) for x in score) + ")"
-        timestamp = datetime.datetime.now().timestamp()
-        
-        # Persist search to database
-        try:
-            with sql.connect(
-            server_hostname=DATABRICKS_HOST,
-            http_path=http_path,
-            access_token=token
-                ) as conn:
-                cursor = conn.cursor()
-
-                # Save messages
-                cursor.execute(f"""
-                                INSERT INTO {catalog}.{schema}.similarity_search 
-                                (space_id, message_id, user_id, user_name, user_email, prompt, completion, score, created_timestamp)
-                                VALUES (?, {message_ids_array}, ?, ?, ?, ?, {results_str_array}, {score_array}, ?)
-                                """, (space_id, user_info["user_id"], user_info["user_name"], user_info["email"], query_text, timestamp))
-                
-            logging.info(f"Persisted semantic search successfully.")
-
-        except Exception as db_err:
-            logging.warning(f"Error persisting semantic search results: {str(db_err)} — Falling back to offline queue.")
-
-            # Queue the data for later insertion
-            queue.enqueue({
-                "space_id": space_id,
-                "message_id": message_ids_array,
-                "user_id": user_info["user_id"],
-                "user_name": user_info["user_name"],
-                "user_email": user_info["email"],
-                "prompt": query_text,
-                "completion": results_str_array,
-                "score": score_array,
-                "created_timestamp": timestamp,
-                "operation": "insert_similar_search"
-            })
+        timestamp = datetime.now().timestamp()
 
-        finally:
-            try:
-                cursor.close()
-                conn.close()
-                logging.info("Closed Databricks SQL connection.")
-            except Exception as close_err:
-                logging.warning(f"Error closing connection: {str(close_err)}")
+        # Persist search to database (cache hits included, the table logs what users look for)
+        persist_similarity_search(token, http_path, catalog, schema, space_id, user_info, query_text, message_ids, results_str, score, timestamp)
 
         return results
-    
+
     except Exception as e:
         logger.error(f"Error getting semantic search results: {str(e)}")
-        return {"error": str(e)}
\ No newline at end of file
+        return {"error": str(e)}
+
+def semantic_search(space_id: str, token: str, http_path: str, catalog: str, schema: str, query_text: str):
+    """Query vector search index for similar user questions (see vector_resources.py for further details)."""
+    return event_loop.run(semantic_search_async(space_id, token, http_path, catalog, schema, query_text))
@@ -1,96 +1,988 @@
 import os
 import sqlite3
+import asyncio
 import time
-from datetime import datetime
+import threading
+import hashlib
+import logging
+import random
+import bisect
+import re
+import socket
+import uuid
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process lock, DrainScheduler only guards its own process
+    fcntl = None
+from collections import OrderedDict, Counter, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 import json
+import queue
+from databricks import sql
 from databricks.sdk import WorkspaceClient
 from databricks.sdk.core import Config
-from typing import Dict, Any
+from typing import Dict, Any, Tuple, Optional, List, Callable, Hashable
+
+###############
+### Helpers ###
+###############
+
+def token_fingerprint(token: str) -> str:
+    """Stable hash of an access token, safe to use in cache keys and logs."""
+    return hashlib.sha256((token or "").encode("utf-8")).hexdigest()
+
+def normalize_text(text: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace, so trivially different prompts share a cache key."""
+    return " ".join(re.sub(r"[^\w\s]", " ", (text or "").lower()).split())
+
+def normalize_question(text: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing ?/!. Operators, signs, decimals and quotes change what a
+    question asks ("amount > 100" vs "amount < 100"), so unlike normalize_text they are kept."""
+    return " ".join((text or "").lower().split()).rstrip("?! ")
+
+def values_rows(width: int, rows: int) -> str:
+    """Placeholder tuples for a multi-row VALUES clause."""
+    return ", ".join(["(" + ", ".join(["?"] * width) + ")"] * rows)
+
+def param_chunks(rows: list, width: int, max_params: int = 250) -> list:
+    """Split rows so one statement binds at most max_params parameters."""
+    size = max(1, max_params // width)
+    return [rows[i:i + size] for i in range(0, len(rows), size)]
 
 ###############
 ### Classes ###
 ###############
 
-# Class to handle offline queuing of failed inserts
+# Class implementing an append-only JSONL log split in size-rotated segments, drained by leased consumers.
+# Used by OfflineQueue on DBFS, where many small files are slow: enqueue is one append, draining is sequential reads.
+# A consumer leases a whole segment (segment-N.lease, created with O_EXCL) and acks what it applied; the read offset
+# of each segment, and how many records lie before it, is checkpointed in segment-N.offset. Expired leases can be
+# taken over by another consumer. Records a consumer is not ready for stay in place, held back in memory.
+class SegmentLog:
+    LEGACY_CHECKPOINT_FILE = "checkpoint.json"
+
+    def __init__(self, path: str, max_segment_bytes: int = 8 * 1024 * 1024):
+        self.path = path
+        self.max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+        self._claimed: Dict[int, Dict[int, bool]] = {}  # Segment -> {record end offset: acked}, for leases held here
+        self._deferred: Dict[int, Dict[int, dict]] = {}  # Segment -> {record end offset: record} read but held back
+        self._lines: Dict[int, Tuple[int, int]] = {}     # Segment -> (bytes scanned, complete lines in them)
+        os.makedirs(path, exist_ok=True)
+        self._migrate_checkpoint()
+
+    def _segments(self) -> List[int]:
+        return sorted(int(name[8:-6]) for name in os.listdir(self.path)
+                      if name.startswith("segment-") and name.endswith(".jsonl"))
+
+    def _file(self, seq: int, suffix: str = "jsonl") -> str:
+        return os.path.join(self.path, f"segment-{seq:010d}.{suffix}")
+
+    def _write_json(self, fname: str, data: dict):
+        # Write then rename, so a crash never leaves a torn file
+        tmp = f"{fname}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(tmp, fname)
+
+    def _checkpoint(self, seq: int) -> Tuple[int, int]:
+        """(read offset, records before it) of a segment. Offsets written by older versions lack the count."""
+        try:
+            with open(self._file(seq, "offset"), "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return 0, 0
+        if "records" not in checkpoint:
+            with open(self._file(seq), "rb") as f:
+                checkpoint["records"] = f.read(checkpoint["offset"]).count(b"\n")
+        return checkpoint["offset"], checkpoint["records"]
+
+    def _offset(self, seq: int) -> int:
+        return self._checkpoint(seq)[0]
+
+    def _line_count(self, seq: int) -> int:
+        """Complete records written to a segment. Segments only grow, so only bytes not scanned yet are read."""
+        scanned, lines = self._lines.get(seq, (0, 0))
+        try:
+            if os.path.getsize(self._file(seq)) > scanned:
+                with open(self._file(seq), "rb") as f:
+                    f.seek(scanned)
+                    data = f.read()
+                end = data.rfind(b"\n") + 1  # A record still being written is counted next time
+                scanned, lines = scanned + end, lines + data.count(b"\n", 0, end)
+        except FileNotFoundError:
+            return 0
+        self._lines[seq] = (scanned, lines)
+        return lines
+
+    def _migrate_checkpoint(self):
+        """Logs written before leases had one checkpoint.json for a single consumer: turn it into segment offsets."""
+        fname = os.path.join(self.path, self.LEGACY_CHECKPOINT_FILE)
+        try:
+            with open(fname, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return
+        for seq in self._segments():
+            if seq < checkpoint["segment"]:
+                os.remove(self._file(seq))
+            elif seq == checkpoint["segment"]:
+                self._write_json(self._file(seq, "offset"), {"offset": checkpoint["offset"]})
+        os.remove(fname)
+
+    def append(self, records: List[dict]):
+        """Append records to the active segment, rotating it once it reaches max_segment_bytes."""
+        data = "".join(json.dumps(record) + "\n" for record in records)
+        with self._lock:
+            segments = self._segments()
+            seq = segments[-1] if segments else 0
+            if segments and os.path.getsize(self._file(seq)) >= self.max_segment_bytes:
+                seq += 1
+            with open(self._file(seq), "a", encoding="utf-8") as f:
+                f.write(data)
+
+    def _read(self, seq: int, offset: int, n) -> List[Tuple[int, dict]]:
+        """Up to n (end offset, record) pairs of a segment from offset on."""
+        records = []
+        try:
+            with open(self._file(seq), "rb") as f:
+                f.seek(offset)
+                while len(records) < n:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        break  # End of segment (or a record still being written)
+                    offset += len(line)
+                    if line.strip():
+                        records.append((offset, json.loads(line)))
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _take_lease(self, seq: int, owner: str, lease_seconds: float) -> bool:
+        """Lease a segment for owner: create the lease file exclusively, renew our own, or take over an expired one."""
+        fname = self._file(seq, "lease")
+        lease = {"owner": owner, "expires_at": time.time() + lease_seconds}
+        try:
+            fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(lease, f)
+            # Records claimed under an older lease may have been taken over since
+            self._claimed.pop(seq, None)
+            self._deferred.pop(seq, None)
+            return True
+        except FileExistsError:
+            pass
+        try:
+            with open(fname, "r", encoding="utf-8") as f:
+                current = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return False  # Released or being written right now: try again on the next claim
+        if current["owner"] == owner:
+            self._write_json(fname, lease)
+            return True
+        if current["expires_at"] > time.time():
+            return False
+        # Expired: only one consumer wins the rename, then it creates a fresh lease
+        try:
+            os.rename(fname, f"{fname}.{owner.replace(os.sep, '_')}.expired")
+            os.remove(f"{fname}.{owner.replace(os.sep, '_')}.expired")
+        except FileNotFoundError:
+            return False
+        return self._take_lease(seq, owner, lease_seconds)
+
+    def _remove(self, seq: int):
+        """Delete a fully acked segment with its offset and lease."""
+        for suffix in ("jsonl", "offset", "lease"):
+            try:
+                os.remove(self._file(seq, suffix))
+            except FileNotFoundError:
+                pass
+        self._claimed.pop(seq, None)
+        self._deferred.pop(seq, None)
+        self._lines.pop(seq, None)
+
+    def _drop_lease(self, seq: int):
+        self._claimed.pop(seq, None)
+        self._deferred.pop(seq, None)
+        try:
+            os.remove(self._file(seq, "lease"))
+        except FileNotFoundError:
+            pass
+
+    def claim(self, n: int, owner: str, lease_seconds: float = 300, due: Optional[Callable[[dict], bool]] = None) -> List[dict]:
+        """Lease segments and return up to n unacked records from them. Each record carries _segment and _end,
+        used by ack and release. Records for which due returns False are held back: they stay in place (the
+        segment offset does not pass them) and later claims under the same lease offer them again, without
+        reading the segment again."""
+        claimed = []
+        with self._lock:
+            segments = self._segments()
+            for seq in segments:
+                if len(claimed) >= n:
+                    break
+                if not self._take_lease(seq, owner, lease_seconds):
+                    continue
+                pending = self._claimed.setdefault(seq, {})
+                deferred = self._deferred.setdefault(seq, {})
+                for end in sorted(deferred):
+                    if len(claimed) >= n:
+                        break
+                    if due is None or due(deferred[end]):
+                        pending[end] = False
+                        claimed.append(dict(deferred.pop(end), _segment=seq, _end=end))
+                start = max([*pending, *deferred], default=None) or self._offset(seq)
+                records = []
+                while len(claimed) < n:
+                    batch = self._read(seq, start, n - len(claimed))
+                    if not batch:
+                        break
+                    records.extend(batch)
+                    start = batch[-1][0]
+                    for end, record in batch:
+                        if due is None or due(record):
+                            pending[end] = False
+                            claimed.append(dict(record, _segment=seq, _end=end))
+                        else:
+                            deferred[end] = record
+                if not records and not pending and not deferred:
+                    # Nothing left: rotated segments go away, the active one stays for the writers
+                    if seq != segments[-1]:
+                        self._remove(seq)
+                    else:
+                        self._drop_lease(seq)
+        return claimed
+
+    def defer(self, records: List[dict]):
+        """Hold claimed records back under their lease, to be offered again by the next claim."""
+        with self._lock:
+            for record in records:
+                pending = self._claimed.get(record["_segment"])
+                if pending is not None and pending.get(record["_end"]) is False:
+                    del pending[record["_end"]]
+                    self._deferred.setdefault(record["_segment"], {})[record["_end"]] = {
+                        k: v for k, v in record.items() if k not in ("_segment", "_end")}
+
+    def ack(self, records: List[dict]):
+        """Mark claimed records as applied. Segment offsets advance over the acked prefix; fully read segments
+        (except the active one) are deleted."""
+        with self._lock:
+            for record in records:
+                pending = self._claimed.get(record["_segment"])
+                if pending is not None and record["_end"] in pending:
+                    pending[record["_end"]] = True
+            segments = self._segments()
+            for seq in {record["_segment"] for record in records}:
+                if seq not in segments:
+                    self._claimed.pop(seq, None)
+                    continue
+                pending = self._claimed.get(seq, {})
+                held_back = min(self._deferred.get(seq, {}), default=float("inf"))
+                done = 0
+                for end in sorted(pending):
+                    if not pending[end] or end > held_back:
+                        break
+                    done = end
+                if not done:
+                    continue
+                passed = [end for end in pending if end <= done]
+                for end in passed:
+                    del pending[end]
+                if not pending and not self._deferred.get(seq) and seq != segments[-1] and done >= os.path.getsize(self._file(seq)):
+                    self._remove(seq)
+                else:
+                    # Every record between the old and the new offset was claimed here, so they are all in passed
+                    records = self._checkpoint(seq)[1] + len(passed)
+                    self._write_json(self._file(seq, "offset"), {"offset": done, "records": records})
+
+    def release(self, records: List[dict]):
+        """Give up the leases of claimed records that were not acked, so any consumer can claim them again."""
+        with self._lock:
+            for seq in {record["_segment"] for record in records}:
+                self._drop_lease(seq)
+
+    def release_all(self, owner: str):
+        """Give up every segment lease owner still holds (e.g. at the end of a drain), so other consumers don't wait
+        for them to expire. Unacked and held back records stay in the log for whoever claims them next."""
+        with self._lock:
+            for seq in set(self._claimed) | set(self._deferred):
+                try:
+                    with open(self._file(seq, "lease"), "r", encoding="utf-8") as f:
+                        mine = json.load(f)["owner"] == owner
+                except (FileNotFoundError, ValueError):
+                    mine = False
+                if mine:
+                    self._drop_lease(seq)
+                else:
+                    # Expired and taken over: only forget our claims
+                    self._claimed.pop(seq, None)
+                    self._deferred.pop(seq, None)
+
+    def peek(self, n) -> List[dict]:
+        """Up to n unacked records, leased or not, without claiming them."""
+        records = []
+        with self._lock:
+            for seq in self._segments():
+                if len(records) >= n:
+                    break
+                records.extend(record for _, record in self._read(seq, self._offset(seq), n - len(records)))
+        return records
+
+    def __len__(self) -> int:
+        """Unacked records, without parsing any: records written to each segment minus those before its offset and
+        those acked here past it (acks of other consumers count once their offset passes them)."""
+        with self._lock:
+            segments = self._segments()
+            for seq in set(self._lines) - set(segments):
+                del self._lines[seq]
+            return sum(self._line_count(seq) - self._checkpoint(seq)[1] - sum(self._claimed.get(seq, {}).values())
+                       for seq in segments)
+
+# Class to handle offline queuing of failed inserts.
+# Consumers claim items under a lease and ack them once applied, so several reprocessors can drain the queue in
+# parallel with at-least-once delivery: items of a consumer that dies are claimable again when the lease expires.
 class OfflineQueue:
-    def __init__(self, dbfs_path: str = "/dbfs/tmp/genie_queue", sqlite_file: str = "fallback.db"):
+    # Retry schedule of failed items: exponential backoff from RETRY_BASE_DELAY, capped, with jitter
+    RETRY_BASE_DELAY = 30
+    RETRY_MAX_DELAY = 3600
+    LEASE_SECONDS = 300
+    # Bookkeeping keys added to claimed items, never persisted
+    ITEM_KEYS = ("_queue_id", "_segment", "_end")
+    # Operations a later delete of the same conversation makes pointless
+    DELETE_COVERS = ("insert_new_conversation", "insert_message", "update_rating", "generate_title", "update_title",
+                     "link_conversation", "increment_sql_run_version")
+    # Operations where every item counts once more (not idempotent): identical copies are never duplicates
+    COUNTED = ("increment_sql_run_version",)
+
+    def __init__(self, dbfs_path: str = "/dbfs/tmp/genie_queue", sqlite_file: str = "fallback.db", owner: Optional[str] = None):
         self.is_databricks = os.getenv("DATABRICKS_RUNTIME_VERSION") is not None
         self.dbfs_path = dbfs_path
         self.sqlite_file = sqlite_file
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._lock = threading.Lock()
+        self._conn = None
 
         if self.is_databricks:
-            os.makedirs(dbfs_path, exist_ok=True)
+            self._log = SegmentLog(dbfs_path)
+            self._dead_letter_log = SegmentLog(os.path.join(dbfs_path, "dead_letter"))
+            self._import_legacy_files()
         else:
-            conn = sqlite3.connect(self.sqlite_file)
-            cursor = conn.cursor()
-            cursor.execute("""
+            # One long-lived connection shared by all threads (serialized by the lock). WAL lets the reprocessor
+            # read while the app writes; transactions are explicit (autocommit mode + BEGIN IMMEDIATE).
+            self._conn = sqlite3.connect(self.sqlite_file, check_same_thread=False, isolation_level=None, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("""
                 CREATE TABLE IF NOT EXISTS pending (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
                     payload TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    attempts INTEGER DEFAULT 0,
+                    next_attempt_at REAL DEFAULT 0,
+                    lease_owner TEXT,
+                    lease_expires_at REAL DEFAULT 0
                 )
             """)
-            conn.commit()
-            conn.close()
+            # Queues created by older versions lack the retry schedule and lease columns
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(pending)")}
+            for column, definition in [("attempts", "INTEGER DEFAULT 0"), ("next_attempt_at", "REAL DEFAULT 0"),
+                                       ("lease_owner", "TEXT"), ("lease_expires_at", "REAL DEFAULT 0")]:
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE pending ADD COLUMN {column} {definition}")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS dead_letter (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    payload TEXT,
+                    attempts INTEGER,
+                    last_error TEXT,
+                    failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+    def _import_legacy_files(self):
+        """Move payloads written one file each (<timestamp>.json) by older versions into the segment log."""
+        legacy = sorted((name for name in os.listdir(self.dbfs_path) if re.fullmatch(r"[0-9.]+\.json", name)), key=lambda name: float(name[:-5]))
+        for name in legacy:
+            fname = os.path.join(self.dbfs_path, name)
+            try:
+                with open(fname, "r", encoding="utf-8") as f:
+                    self._log.append([json.load(f)])
+                os.remove(fname)
+            except Exception as e:
+                logging.warning(f"Could not import legacy queue file {name}: {str(e)}")
+        if legacy:
+            logging.info(f"Imported {len(legacy)} legacy queue files into the segment log.")
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction on the shared SQLite connection."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    @classmethod
+    def _strip(cls, payload: dict) -> dict:
+        return {k: v for k, v in payload.items() if k not in cls.ITEM_KEYS}
+
+    @classmethod
+    def _dump(cls, payload: dict) -> str:
+        return json.dumps(cls._strip(payload))
 
     def enqueue(self, payload: dict):
         """Save failed inserts depending on environment. Priority: DBFS -> SQLite"""
+        self.enqueue_many([payload])
+
+    def enqueue_many(self, payloads: List[dict]):
+        """Save several failed inserts at once (one commit on SQLite).
+        Items taken from the queue keep their place and retry schedule (attempts / next_attempt_at) when put back;
+        on SQLite a claimed item is updated in place and its lease released."""
         if self.is_databricks:
-            fname = f"{self.dbfs_path}/{datetime.now().timestamp()}.json"
-            with open(fname, "w", encoding="utf-8") as f:
-                json.dump(payload, f)
+            self._log.append([self._strip(payload) for payload in payloads])
         else:
-            conn = sqlite3.connect(self.sqlite_file)
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO pending (payload) VALUES (?)",
-                (json.dumps(payload),)
-            )
-            conn.commit()
-            conn.close()
+            with self._transaction() as conn:
+                conn.executemany(
+                    """INSERT INTO pending (id, payload, attempts, next_attempt_at) VALUES (?, ?, ?, ?)
+                       ON CONFLICT(id) DO UPDATE SET payload = excluded.payload, attempts = excluded.attempts,
+                       next_attempt_at = excluded.next_attempt_at, lease_owner = NULL, lease_expires_at = 0""",
+                    [(payload.get("_queue_id"), self._dump(payload), payload.get("attempts", 0), payload.get("next_attempt_at", 0))
+                     for payload in payloads]
+                )
+
+    def retry_delay(self, attempts: int) -> float:
+        """Seconds to wait before attempt number attempts + 1."""
+        delay = min(self.RETRY_MAX_DELAY, self.RETRY_BASE_DELAY * 2 ** max(0, attempts - 1))
+        return delay * random.uniform(0.9, 1.1)
+
+    def retry(self, items: List[dict], error, max_retries: int = 3) -> int:
+        """Put failed items back with their attempt counted and a backoff delay; items past max_retries go to
+        the dead letter store instead. Returns how many were dead-lettered."""
+        now = time.time()
+        retry_items, dead = [], []
+        for item in items:
+            item["attempts"] = item.get("attempts", 0) + 1
+            if item["attempts"] > max_retries:
+                dead.append(item)
+            else:
+                item["next_attempt_at"] = now + self.retry_delay(item["attempts"])
+                retry_items.append(item)
+        if retry_items:
+            self.enqueue_many(retry_items)
+            if self.is_databricks:
+                self._log.ack([item for item in retry_items if "_segment" in item])  # Re-appended: drop the original
+        if dead:
+            self.dead_letter(dead, error)
+        return len(dead)
+
+    def dead_letter(self, items: List[dict], error):
+        """Park items that keep failing, for manual inspection. Claimed items leave the queue."""
+        logging.error(f"Moving {len(items)} items to the dead letter store: {error}")
+        if self.is_databricks:
+            self._dead_letter_log.append([dict(self._strip(item), last_error=str(error)) for item in items])
+            self._log.ack([item for item in items if "_segment" in item])
+        else:
+            with self._transaction() as conn:
+                conn.executemany(
+                    "INSERT INTO dead_letter (payload, attempts, last_error) VALUES (?, ?, ?)",
+                    [(self._dump(item), item.get("attempts", 0), str(error)) for item in items]
+                )
+                conn.executemany("DELETE FROM pending WHERE id = ?", [(item["_queue_id"],) for item in items if "_queue_id" in item])
+
+    def dead_letters(self, n: int = 100) -> List[dict]:
+        """Oldest n dead-lettered items."""
+        if self.is_databricks:
+            return self._dead_letter_log.peek(n)
+        with self._lock:
+            rows = self._conn.execute("SELECT payload, last_error FROM dead_letter ORDER BY id ASC LIMIT ?", (n,)).fetchall()
+        return [dict(json.loads(payload), last_error=last_error) for payload, last_error in rows]
 
     def dequeue(self):
-        """Retrieve and remove the oldest queued item. Priority: DBFS -> SQLite"""
-        # Try DBFS backend 
-        try:
-            if os.path.exists(self.dbfs_path):
-                with open(self.dbfs_path, "r") as f:
-                    data = json.load(f)
-
-                if data:
-                    item = data.pop(0) # remove first item
-                    with open(self.dbfs_path, "w") as f:
-                        json.dump(data, f, indent=2)
-                    return item
-        except Exception:
-            pass  # fallback to sqlite
+        """Retrieve and remove the oldest due queued item. Priority: DBFS -> SQLite"""
+        items = self.dequeue_batch(1)
+        return items[0] if items else None
+
+    def dequeue_batch(self, n: int) -> List[dict]:
+        """Retrieve and remove up to n of the oldest items that are due (next_attempt_at reached), in order.
+        Items waiting for a retry are skipped, not waited for."""
+        items = self.claim(n)
+        self.ack(items)
+        if self.is_databricks:
+            self._log.release(items)
+        return items
 
-        # Try SQLite backend
+    def claim(self, n: int, lease_seconds: Optional[float] = None) -> List[dict]:
+        """Lease up to n of the oldest due items to this consumer (self.owner). They stay queued, hidden from other
+        consumers, until ack'ed, retried or released, or until the lease expires."""
+        now = time.time()
+        lease_seconds = lease_seconds or self.LEASE_SECONDS
         try:
-            conn = sqlite3.connect(self.sqlite_file)
-            cursor = conn.cursor()
+            if self.is_databricks:
+                # Items not due yet keep their place in the log and are skipped until due
+                return self._log.claim(n, self.owner, lease_seconds, due=lambda record: record.get("next_attempt_at", 0) <= now)
 
-            cursor.execute("SELECT id, payload FROM pending ORDER BY id ASC LIMIT 1")
-            row = cursor.fetchone()
+            with self._transaction() as conn:
+                rows = conn.execute(
+                    """SELECT id, payload, attempts FROM pending
+                       WHERE next_attempt_at <= ? AND (lease_owner IS NULL OR lease_expires_at <= ?)
+                       ORDER BY id ASC LIMIT ?""", (now, now, n)
+                ).fetchall()
+                conn.executemany(
+                    "UPDATE pending SET lease_owner = ?, lease_expires_at = ? WHERE id = ?",
+                    [(self.owner, now + lease_seconds, row_id) for row_id, _, _ in rows]
+                )
+            return [dict(json.loads(payload), attempts=attempts, _queue_id=row_id) for row_id, payload, attempts in rows]
 
-            if not row:
-                return None
+        except Exception as e:
+            logging.error(f"Error claiming from offline queue: {str(e)}")
+            return []
 
-            item_id, payload = row
-            cursor.execute("DELETE FROM pending WHERE id = ?", (item_id,))
-            conn.commit()
-            conn.close()
+    def ack(self, items: List[dict]):
+        """Remove claimed items that were applied."""
+        if self.is_databricks:
+            self._log.ack(items)
+        else:
+            with self._transaction() as conn:
+                conn.executemany("DELETE FROM pending WHERE id = ?", [(item["_queue_id"],) for item in items])
 
-            return json.loads(payload)
+    def release(self, items: List[dict]):
+        """Hand claimed items back untouched (no attempt counted), claimable again by any consumer."""
+        if self.is_databricks:
+            self._log.release(items)
+        else:
+            with self._transaction() as conn:
+                conn.executemany(
+                    "UPDATE pending SET lease_owner = NULL, lease_expires_at = 0 WHERE id = ? AND lease_owner = ?",
+                    [(item["_queue_id"], self.owner) for item in items]
+                )
 
-        except Exception:
-            return None
+    def release_all(self):
+        """Hand back everything this consumer still holds under a lease (segments on DBFS, items on SQLite)."""
+        if self.is_databricks:
+            self._log.release_all(self.owner)
+        else:
+            with self._transaction() as conn:
+                conn.execute("UPDATE pending SET lease_owner = NULL, lease_expires_at = 0 WHERE lease_owner = ?", (self.owner,))
+
+    @classmethod
+    def redundant(cls, items: List[dict]) -> Dict[str, List[int]]:
+        """Positions of items (oldest first) whose work is redone or undone by another item, by reason:
+        exact duplicates, ratings replaced by a later rating of the same message and writes to a conversation that
+        is deleted later on. The latest rating of a message is always kept, even if an older copy is identical, and
+        COUNTED operations are never duplicates (three identical SQL re-runs are three bumps)."""
+        removed = {"duplicates": [], "ratings": [], "deleted": []}
+        seen, last_rating, deleted_at = set(), {}, {}
+        for i, item in enumerate(items):
+            if item.get("operation") == "update_rating":
+                last_rating[item.get("message_id")] = i
+            elif item.get("operation") == "delete":
+                deleted_at[item.get("conversation_id")] = i
+        for i, item in enumerate(items):
+            key = json.dumps({k: v for k, v in cls._strip(item).items() if k not in ("attempts", "next_attempt_at")}, sort_keys=True)
+            operation, conversation_id = item.get("operation"), item.get("conversation_id")
+            if operation in cls.DELETE_COVERS and deleted_at.get(conversation_id, -1) > i:
+                removed["deleted"].append(i)
+            elif operation == "update_rating":
+                if last_rating[item.get("message_id")] != i:
+                    removed["ratings"].append(i)
+            elif key in seen and operation not in cls.COUNTED:
+                removed["duplicates"].append(i)
+            seen.add(key)
+        return removed
+
+    def compact(self) -> Dict[str, int]:
+        """Remove queued items that would be redundant work for the drain (see redundant). Items leased to other
+        consumers are left alone. Returns how many items were removed, by reason."""
+        if self.is_databricks:
+            # Nothing is rewritten: redundant records are acked in place and the others are held back under this
+            # consumer's leases, for the claims of the drain that follows (or anyone once the leases expire)
+            items = self._log.claim(float("inf"), self.owner, self.LEASE_SECONDS)
+            removed = self.redundant(items)
+            drop = {i for positions in removed.values() for i in positions}
+            self._log.ack([items[i] for i in sorted(drop)])
+            self._log.defer([item for i, item in enumerate(items) if i not in drop])
+        else:
+            # Leased items count when comparing (a leased rating may be older or newer than a free one) but only
+            # free items are deleted
+            now = time.time()
+            with self._transaction() as conn:
+                rows = conn.execute(
+                    "SELECT id, payload, lease_owner IS NULL OR lease_expires_at <= ? FROM pending ORDER BY id ASC", (now,)
+                ).fetchall()
+                redundant = self.redundant([json.loads(payload) for _, payload, _ in rows])
+                removed = {reason: [i for i in positions if rows[i][2]] for reason, positions in redundant.items()}
+                conn.executemany("DELETE FROM pending WHERE id = ?", [(rows[i][0],) for positions in removed.values() for i in positions])
+        return {reason: len(positions) for reason, positions in removed.items()}
+
+    def peek(self, n: int = 1) -> List[dict]:
+        """Oldest n queued items (due or not), without removing them."""
+        if self.is_databricks:
+            return self._log.peek(n)
+        with self._lock:
+            rows = self._conn.execute("SELECT payload FROM pending ORDER BY id ASC LIMIT ?", (n,)).fetchall()
+        return [json.loads(payload) for (payload,) in rows]
+
+    def __len__(self) -> int:
+        if self.is_databricks:
+            return len(self._log)
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM pending").fetchone()[0]
+
+    def close(self):
+        if self._conn is not None:
+            with self._lock:
+                self._conn.close()
+                self._conn = None
+
+# Class applying batches of persistence events (offline queue payloads) to the Delta tables. Every statement is a
+# multi-row MERGE keyed on the table ids, so replaying an event that was already written is a no-op.
+# Conversation and message writes set updated_timestamp (warehouse clock), which incremental syncs read from.
+# Shared by the write-behind worker (genie_room) and the offline queue reprocessor (db_offline_queue).
+class PersistenceStatements:
+    MAX_PARAMS = 250  # Bound parameters per statement, larger batches are split
+    # Similarity search arrays (column -> item type) and the ARRAY(...) literals older versions queued instead of lists
+    SEARCH_ARRAYS = {"message_id": "STRING", "completion": "STRING", "score": "FLOAT"}
+    LEGACY_ARRAY_LITERALS = {
+        "STRING": re.compile(r"ARRAY\(((?:'[^']*'(?:, '[^']*')*)?)\)"),
+        "FLOAT": re.compile(r"ARRAY\(((?:[-+0-9.eE]+(?:, [-+0-9.eE]+)*)?)\)"),
+    }
+    MESSAGE_COLUMNS = ["message_id", "conversation_id", "space_id", "user_id", "prompt", "completion", "user_attachment", "assistant_attachment", "created_timestamp"]
+    # Order to apply the operations of one batch in: rows exist before they are updated, deletes go last
+    OPERATION_ORDER = ["upsert_user", "insert_new_conversation", "insert_message", "insert_similar_search",
+                       "generate_title", "update_title", "link_conversation", "update_rating", "increment_sql_run_version",
+                       "delete"]
+
+    def __init__(self, catalog: str, schema: str):
+        self.catalog = catalog
+        self.schema = schema
+
+    def table(self, name: str) -> str:
+        return f"{self.catalog}.{self.schema}.{name}"
+
+    @classmethod
+    def rank(cls, operation: str) -> int:
+        """Position of operation in OPERATION_ORDER (unknown operations last)."""
+        return cls.OPERATION_ORDER.index(operation) if operation in cls.OPERATION_ORDER else len(cls.OPERATION_ORDER)
+
+    def group(self, events: List[dict]) -> List[Tuple[str, List[dict]]]:
+        """Events grouped by operation, in OPERATION_ORDER (unknown operations last, as their own groups)."""
+        groups: Dict[str, List[dict]] = {}
+        for event in events:
+            groups.setdefault(event.get("operation"), []).append(event)
+        return sorted(groups.items(), key=lambda item: self.rank(item[0]))
+
+    def apply(self, cursor, operation: str, events: List[dict]):
+        """Write one group of same-operation events."""
+        handler = {
+            "insert_new_conversation": self.new_conversations,
+            "insert_message": self.messages,
+            "update_rating": self.ratings,
+            "insert_similar_search": self.similarity_searches,
+            "upsert_user": self.user_logins,
+            "generate_title": self.generated_titles,
+            "update_title": self.titles,
+            "link_conversation": self.conversation_links,
+            "increment_sql_run_version": self.sql_runs,
+            "delete": self.deletes,
+        }.get(operation)
+        if handler is None:
+            raise ValueError(f"Unknown operation {operation}")
+        handler(cursor, events)
+
+    def _merge(self, cursor, rows: List[tuple], columns: List[str], statement: str):
+        """Run statement once per chunk of rows; {source} is replaced by the VALUES table named s."""
+        for chunk in param_chunks(rows, len(columns), self.MAX_PARAMS):
+            source = f"(SELECT * FROM VALUES {values_rows(len(columns), len(chunk))} AS src({', '.join(columns)})) AS s"
+            cursor.execute(statement.format(source=source), [value for row in chunk for value in row])
+
+    @staticmethod
+    def _timestamp(value: str) -> datetime:
+        """Event timestamp as an aware UTC datetime. Events queued by older versions hold naive local times of
+        the host that wrote them."""
+        return datetime.fromisoformat(value).astimezone(timezone.utc)
+
+    @staticmethod
+    def _last_by(events: List[dict], key: str) -> List[dict]:
+        """One event per key (the last one): MERGE rejects several source rows for the same target row."""
+        return list({event[key]: event for event in events}.values())
+
+    def new_conversations(self, cursor, events: List[dict]):
+        rows = [(e["space_id"], e["conversation_id"], e["user_id"], e["chat_title"], e.get("ai_title"), self._timestamp(e["created_timestamp"]))
+                for e in self._last_by(events, "conversation_id")]
+        self._merge(cursor, rows, ["space_id", "conversation_id", "user_id", "chat_title", "ai_title", "created_timestamp"], f"""
+                    MERGE INTO {self.table("conversations")} AS t
+                    USING {{source}}
+                    ON t.conversation_id = s.conversation_id
+                    WHEN NOT MATCHED THEN INSERT (space_id, conversation_id, user_id, chat_title, ai_title, created_timestamp, updated_timestamp)
+                    VALUES (s.space_id, s.conversation_id, s.user_id, s.chat_title, s.ai_title, s.created_timestamp, current_timestamp())
+                    """)
+        self.messages(cursor, events)
+
+    def messages(self, cursor, events: List[dict]):
+        rows = [(e["message_id"], e["conversation_id"], e["space_id"], e["user_id"], e["prompt"], e["completion"],
+                 e["user_attachment"], e["assistant_attachment"], self._timestamp(e["created_timestamp"]))
+                for e in self._last_by(events, "message_id")]
+        self._merge(cursor, rows, self.MESSAGE_COLUMNS, f"""
+                    MERGE INTO {self.table("messages")} AS t
+                    USING {{source}}
+                    ON t.message_id = s.message_id
+                    WHEN NOT MATCHED THEN INSERT ({", ".join(self.MESSAGE_COLUMNS)}, rating, sql_run_version, updated_timestamp)
+                    VALUES ({", ".join(f"s.{col}" for col in self.MESSAGE_COLUMNS)}, NULL, 1, current_timestamp())
+                    """)
+
+    def ratings(self, cursor, events: List[dict]):
+        rows = [(e["message_id"], str(e["rating"]).split('.')[-1]) for e in self._last_by(events, "message_id")]
+        self._merge(cursor, rows, ["message_id", "rating"], f"""
+                    MERGE INTO {self.table("messages")} AS t
+                    USING {{source}}
+                    ON t.message_id = s.message_id
+                    WHEN MATCHED THEN UPDATE SET t.rating = s.rating, t.updated_timestamp = current_timestamp()
+                    """)
+
+    def sql_runs(self, cursor, events: List[dict]):
+        """Re-executions of a message's SQL, counted per message so one statement bumps each row once."""
+        runs = Counter(e["message_id"] for e in events)
+        self._merge(cursor, list(runs.items()), ["message_id", "runs"], f"""
+                    MERGE INTO {self.table("messages")} AS t
+                    USING {{source}}
+                    ON t.message_id = s.message_id
+                    WHEN MATCHED THEN UPDATE SET t.sql_run_version = coalesce(t.sql_run_version, 0) + s.runs, t.updated_timestamp = current_timestamp()
+                    """)
+
+    @classmethod
+    def array_values(cls, value, item_type: str) -> list:
+        """Items of a similarity search array. Legacy ARRAY(...) literals are accepted only if they hold nothing but
+        plain quoted strings or numbers; anything else is rejected."""
+        if isinstance(value, list):
+            return value
+        match = cls.LEGACY_ARRAY_LITERALS[item_type].fullmatch(str(value))
+        if match is None:
+            raise ValueError(f"Unexpected array literal in similarity search event: {str(value)[:50]}")
+        if item_type == "STRING":
+            return re.findall(r"'([^']*)'", match.group(1))
+        return [float(x) for x in match.group(1).split(", ")] if match.group(1) else []
+
+    def similarity_searches(self, cursor, events: List[dict]):
+        # Result arrays are bound as JSON strings and parsed on the warehouse, never interpolated into the SQL
+        events = list({(e["user_id"], e["created_timestamp"]): e for e in events}.values())
+        columns = ["space_id", "message_id", "user_id", "user_name", "user_email", "prompt", "completion", "score", "created_timestamp"]
+        rows = [tuple(json.dumps(self.array_values(e[col], self.SEARCH_ARRAYS[col])) if col in self.SEARCH_ARRAYS else e[col] for col in columns)
+                for e in events]
+        for chunk in param_chunks(rows, len(columns), self.MAX_PARAMS):
+            cursor.execute(f"""
+                            MERGE INTO {self.table("similarity_search")} AS t
+                            USING (SELECT space_id, from_json(message_id, 'ARRAY<STRING>') AS message_id, user_id, user_name, user_email, prompt,
+                                          from_json(completion, 'ARRAY<STRING>') AS completion, from_json(score, 'ARRAY<FLOAT>') AS score,
+                                          timestamp_seconds(created_timestamp) AS created_timestamp
+                                   FROM VALUES {values_rows(len(columns), len(chunk))} AS src({", ".join(columns)})) AS s
+                            ON t.user_id = s.user_id AND t.created_timestamp = s.created_timestamp
+                            WHEN NOT MATCHED THEN INSERT ({", ".join(columns)})
+                            VALUES ({", ".join(f"s.{col}" for col in columns)})
+                            """, [value for row in chunk for value in row])
+
+    def user_logins(self, cursor, events: List[dict]):
+        # One source row per user: first/last login of the batch and how many logins it holds.
+        # Logins not newer than last_login_timestamp were already counted, so replays don't add up twice.
+        users = {}
+        for e in events:
+            login = self._timestamp(e["login_timestamp"])
+            user = users.setdefault(e["user_id"], {"first": login, "last": login, "logins": 0})
+            user.update(user_name=e["user_name"], email=e["email"], groups=json.dumps(e["groups"]))
+            user["first"], user["last"], user["logins"] = min(user["first"], login), max(user["last"], login), user["logins"] + 1
+        rows = [(user_id, u["user_name"], u["email"], u["groups"], u["first"], u["last"], u["logins"]) for user_id, u in users.items()]
+        for chunk in param_chunks(rows, 7, self.MAX_PARAMS):
+            cursor.execute(f"""
+                            MERGE INTO {self.table("users_info")} AS t
+                            USING (SELECT user_id, user_name, email, from_json(groups, 'ARRAY<STRING>') AS groups, first_login, last_login, logins
+                                   FROM VALUES {values_rows(7, len(chunk))} AS src(user_id, user_name, email, groups, first_login, last_login, logins)) AS s
+                            ON t.user_id = s.user_id
+                            WHEN MATCHED AND t.last_login_timestamp < s.last_login THEN
+                                UPDATE SET t.last_login_timestamp = s.last_login, t.total_logins = t.total_logins + s.logins
+                            WHEN NOT MATCHED THEN INSERT (user_id, user_name, email, groups, first_login_timestamp, last_login_timestamp, total_logins)
+                            VALUES (s.user_id, s.user_name, s.email, s.groups, s.first_login, s.last_login, s.logins)
+                            """, [value for row in chunk for value in row])
+
+    def generated_titles(self, cursor, events: List[dict]):
+        """Titles whose generation failed in the app: summarize and save them in one statement."""
+        rows = [(e["conversation_id"], e["chat_title"]) for e in self._last_by(events, "conversation_id")]
+        for chunk in param_chunks(rows, 2, self.MAX_PARAMS):
+            cursor.execute(f"""
+                            MERGE INTO {self.table("conversations")} AS t
+                            USING (SELECT conversation_id, AI_SUMMARIZE(chat_title, 5) AS ai_title
+                                   FROM VALUES {values_rows(2, len(chunk))} AS src(conversation_id, chat_title)) AS s
+                            ON t.conversation_id = s.conversation_id
+                            WHEN MATCHED AND t.ai_title IS NULL THEN UPDATE SET t.ai_title = s.ai_title, t.updated_timestamp = current_timestamp()
+                            """, [value for row in chunk for value in row])
+
+    def titles(self, cursor, events: List[dict]):
+        rows = [(e["conversation_id"], e["ai_title"]) for e in self._last_by(events, "conversation_id")]
+        self._merge(cursor, rows, ["conversation_id", "ai_title"], f"""
+                    MERGE INTO {self.table("conversations")} AS t
+                    USING {{source}}
+                    ON t.conversation_id = s.conversation_id
+                    WHEN MATCHED THEN UPDATE SET t.ai_title = s.ai_title, t.updated_timestamp = current_timestamp()
+                    """)
+
+    def conversation_links(self, cursor, events: List[dict]):
+        """Genie conversation opened behind a conversation answered from the answer cache."""
+        rows = [(e["conversation_id"], e["genie_conversation_id"]) for e in self._last_by(events, "conversation_id")]
+        self._merge(cursor, rows, ["conversation_id", "genie_conversation_id"], f"""
+                    MERGE INTO {self.table("conversations")} AS t
+                    USING {{source}}
+                    ON t.conversation_id = s.conversation_id
+                    WHEN MATCHED THEN UPDATE SET t.genie_conversation_id = s.genie_conversation_id, t.updated_timestamp = current_timestamp()
+                    """)
+
+    def deletes(self, cursor, events: List[dict]):
+        conversation_ids = list(dict.fromkeys(e["conversation_id"] for e in events))
+        for chunk in param_chunks(conversation_ids, 1, self.MAX_PARAMS):
+            placeholders = ", ".join(["?"] * len(chunk))
+            # Messages first to guarantee referential integrity
+            cursor.execute(f"DELETE FROM {self.table('messages')} WHERE conversation_id IN ({placeholders})", chunk)
+            # Tombstones let sessions drop deleted conversations in their incremental sync
+            cursor.execute(f"""
+                            MERGE INTO {self.table("deleted_conversations")} AS t
+                            USING (SELECT conversation_id, space_id, user_id FROM {self.table("conversations")}
+                                   WHERE conversation_id IN ({placeholders})) AS s
+                            ON t.conversation_id = s.conversation_id
+                            WHEN NOT MATCHED THEN INSERT (conversation_id, space_id, user_id, deleted_timestamp)
+                            VALUES (s.conversation_id, s.space_id, s.user_id, current_timestamp())
+                            """, chunk)
+            cursor.execute(f"DELETE FROM {self.table('conversations')} WHERE conversation_id IN ({placeholders})", chunk)
+
+def history_delta(cursor, catalog: str, schema: str, space_id: str, user_id: str, since) -> Tuple[List[dict], List[dict], List[str]]:
+    """Conversations, messages and deleted conversation ids of a user written after since (warehouse clock).
+    Filters on the write time (updated_timestamp), not created_timestamp, so rows written late (e.g. drained from
+    the offline queue hours after they were created) are still returned. A failing tombstone lookup (e.g. no
+    deleted_conversations table) only leaves deletes out."""
+    cursor.execute(f"""
+                    SELECT conversation_id, COALESCE(ai_title, chat_title) AS title, created_timestamp
+                    FROM {catalog}.{schema}.conversations
+                    WHERE space_id = ? AND user_id = ? AND updated_timestamp > ?
+                    ORDER BY created_timestamp DESC
+                    """, (space_id, user_id, since))
+    cols = [c[0] for c in cursor.description]
+    conversations = [dict(zip(cols, r)) for r in cursor.fetchall()]
+
+    cursor.execute(f"""
+                    SELECT conversation_id, message_id, prompt, completion, assistant_attachment, rating, created_timestamp
+                    FROM {catalog}.{schema}.messages
+                    WHERE space_id = ? AND user_id = ? AND updated_timestamp > ?
+                    ORDER BY created_timestamp ASC
+                    """, (space_id, user_id, since))
+    cols = [c[0] for c in cursor.description]
+    messages = [dict(zip(cols, r)) for r in cursor.fetchall()]
+
+    try:
+        cursor.execute(f"""
+                        SELECT conversation_id
+                        FROM {catalog}.{schema}.deleted_conversations
+                        WHERE space_id = ? AND user_id = ? AND deleted_timestamp > ?
+                        """, (space_id, user_id, since))
+        deleted = [r[0] for r in cursor.fetchall()]
+    except Exception as e:
+        logging.warning(f"Couldn't sync deleted chats: {str(e)}")
+        deleted = []
+    return conversations, messages, deleted
+
+# Class to compute adaptive polling intervals: short first poll, capped exponential growth and jitter
+class PollingStrategy:
+    # Per-status interval caps (seconds). Once Genie is running the query the answer is close, so poll tighter.
+    DEFAULT_STATUS_HINTS = {
+        "SUBMITTED": 1.0,
+        "FETCHING_METADATA": 1.5,
+        "FILTERING_CONTEXT": 1.5,
+        "ASKING_AI": 3.0,
+        "PENDING_WAREHOUSE": 5.0,
+        "EXECUTING_QUERY": 1.0,
+    }
+
+    def __init__(self, initial_interval: float = 0.25, max_interval: float = 5.0, multiplier: float = 1.6,
+                 jitter: float = 0.2, status_hints: Optional[Dict[str, float]] = None):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.jitter = jitter  # +/- fraction applied to every interval
+        self.status_hints = dict(self.DEFAULT_STATUS_HINTS if status_hints is None else status_hints)
+
+    def next_interval(self, attempt: int, status: Optional[str] = None) -> float:
+        """Seconds to sleep before poll number attempt + 1, given the last observed status."""
+        interval = min(self.max_interval, self.initial_interval * (self.multiplier ** attempt))
+        if status in self.status_hints:
+            interval = min(interval, self.status_hints[status])
+        if self.jitter:
+            interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(0.0, interval)
+
+# Class to record polls and wait time per message, to tune PollingStrategy against real latencies
+class PollMetrics:
+    HISTOGRAM_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300)
+
+    def __init__(self, max_records: int = 5000):
+        self._records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def record(self, message_id: str, polls: int, wait_seconds: float, elapsed_seconds: float, status: Optional[str]):
+        """Store one finished (or timed out) wait."""
+        with self._lock:
+            self._records.append({
+                "message_id": message_id,
+                "polls": polls,
+                "wait_seconds": wait_seconds,
+                "elapsed_seconds": elapsed_seconds,
+                "status": status,
+            })
+
+    def records(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._records)
+
+    def summary(self) -> Dict[str, Any]:
+        """Count, mean and percentiles of polls and elapsed time over the recorded waits."""
+        records = self.records()
+        if not records:
+            return {"count": 0}
+        polls = sorted(r["polls"] for r in records)
+        elapsed = sorted(r["elapsed_seconds"] for r in records)
+        def pick(values, q):
+            return values[min(len(values) - 1, int(q * len(values)))]
+        return {
+            "count": len(records),
+            "avg_polls": sum(polls) / len(polls),
+            "p50_polls": pick(polls, 0.5),
+            "p95_polls": pick(polls, 0.95),
+            "avg_elapsed_seconds": sum(elapsed) / len(elapsed),
+            "p50_elapsed_seconds": pick(elapsed, 0.5),
+            "p95_elapsed_seconds": pick(elapsed, 0.95),
+        }
+
+    def histogram(self, buckets: Tuple[float, ...] = HISTOGRAM_BUCKETS) -> Dict[str, int]:
+        """Elapsed-time histogram, keyed by bucket upper bound ("<=N" seconds, plus ">last")."""
+        counts = {f"<={b}": 0 for b in buckets}
+        counts[f">{buckets[-1]}"] = 0
+        for r in self.records():
+            for b in buckets:
+                if r["elapsed_seconds"] <= b:
+                    counts[f"<={b}"] += 1
+                    break
+            else:
+                counts[f">{buckets[-1]}"] += 1
+        return counts
+
+# Shared by every GenieClient unless one is passed explicitly
+default_poll_metrics = PollMetrics()
 
 class GenieClient:
-    def __init__(self, host: str, space_id: str, token: str):
+    def __init__(self, host: str, space_id: str, token: str, polling: Optional[PollingStrategy] = None, poll_metrics: Optional[PollMetrics] = None):
         self.host = host
         self.space_id = space_id
         self.token = token
+        self.polling = polling or PollingStrategy()
+        self.poll_metrics = poll_metrics or default_poll_metrics
         
         # Configure SDK with retry settings and explicit PAT auth
         config = Config(
@@ -105,47 +997,66 @@ class GenieClient:
         
         self.client = WorkspaceClient(config=config)
     
-    def start_conversation(self, question: str) -> Dict[str, Any]:
-        """Start a new conversation with the given question"""
+    @staticmethod
+    def message_description(message) -> Optional[str]:
+        """Return the description of the first query attachment, from a GenieMessage or its dict form."""
+        if isinstance(message, dict):
+            for attachment in message.get("attachments") or []:
+                description = (attachment.get("query") or {}).get("description")
+                if description:
+                    return description
+            return None
+        for attachment in getattr(message, "attachments", None) or []:
+            if attachment.query and attachment.query.description:
+                return attachment.query.description
+        return None
+
+    def start_conversation(self, question: str, wait: bool = True) -> Dict[str, Any]:
+        """Start a new conversation with the given question.
+        With wait=False it returns as soon as Genie accepts the message; poll with wait_for_message_completion."""
         response = self.client.genie.start_conversation(
             space_id=self.space_id,
             content=question
         )
-        response = response.result()
-        genie_description = None
-        for attachment in response.attachments or []:
-            if attachment.query and attachment.query.description:
-                genie_description = attachment.query.description
-                break
+        if wait:
+            response = response.result()
+            genie_description = self.message_description(response)
+            conversation_id, message_id = response.conversation_id, response.message_id
+        else:
+            started = response.response
+            response = started.message or self.client.genie.get_message(
+                space_id=self.space_id,
+                conversation_id=started.conversation_id,
+                message_id=started.message_id
+            )
+            genie_description = None
+            conversation_id, message_id = started.conversation_id, started.message_id
         response_dict = {
             "space_id": self.space_id,
-            "conversation_id": str(response.conversation_id),
+            "conversation_id": str(conversation_id),
             "user_id": str(response.user_id),
             "chat_title": question,
             "assistant_description": str(genie_description),
-            "created_timestamp": datetime.fromtimestamp(response.created_timestamp / 1000).isoformat(),
-            "message_id": str(response.message_id)
+            "created_timestamp": datetime.fromtimestamp(response.created_timestamp / 1000, timezone.utc).isoformat(),
+            "message_id": str(message_id)
         }
         return response_dict
     
-    def send_message(self, conversation_id: str, message: str) -> Dict[str, Any]:
-        """Send a follow-up message to an existing conversation"""
+    def send_message(self, conversation_id: str, message: str, wait: bool = True) -> Dict[str, Any]:
+        """Send a follow-up message to an existing conversation.
+        With wait=False it returns as soon as Genie accepts the message; poll with wait_for_message_completion."""
         response = self.client.genie.create_message(
             space_id=self.space_id,
             conversation_id=conversation_id,
             content=message
         )
-        response = response.result()
-        genie_description = None
-        for attachment in response.attachments or []:
-            if attachment.query and attachment.query.description:
-                genie_description = attachment.query.description
-                break
+        response = response.result() if wait else response.response
+        genie_description = self.message_description(response) if wait else None
         response_dict = {
             "message_id": str(response.message_id),
             "user_id": str(response.user_id),
             "assistant_description": str(genie_description),
-            "created_timestamp": datetime.fromtimestamp(response.created_timestamp / 1000).isoformat()
+            "created_timestamp": datetime.fromtimestamp(response.created_timestamp / 1000, timezone.utc).isoformat()
         }
         return response_dict
     
@@ -210,20 +1121,43 @@ class GenieClient:
             'schema': schema
         }
 
-    def wait_for_message_completion(self, conversation_id: str, message_id: str, timeout: int = 300, poll_interval: int = 2) -> Dict[str, Any]:
-        """Wait for a message to reach a terminal state (COMPLETED, ERROR, etc.)."""
+    TERMINAL_STATUSES = ("COMPLETED", "ERROR", "FAILED", "CANCELLED", "QUERY_RESULT_EXPIRED")
+
+    def wait_for_message_completion(self, conversation_id: str, message_id: str, timeout: int = 300, poll_interval: Optional[float] = None) -> Dict[str, Any]:
+        """Wait for a message to reach a terminal state (COMPLETED, ERROR, etc.).
+        Polls with self.polling (adaptive backoff) unless a fixed poll_interval is given."""
         start_time = time.time()
-        
-        while time.time() - start_time < timeout:
-            message = self.get_message(conversation_id, message_id)
-            status = message.get("status")
-            
-            if status in ["COMPLETED", "ERROR", "FAILED"]:
-                return message
-                
-            time.sleep(poll_interval)
-            
-        raise TimeoutError(f"Message processing timed out after {timeout} seconds")
+        polls = 0
+        waited = 0.0
+        attempt = 0  # Backoff step, restarted whenever the status changes
+        status = last_status = None
+
+        try:
+            while time.time() - start_time < timeout:
+                message = self.get_message(conversation_id, message_id)
+                polls += 1
+                status = message.get("status")
+
+                if status in self.TERMINAL_STATUSES:
+                    return message
+
+                if status != last_status:
+                    attempt, last_status = 0, status
+                if poll_interval is not None:
+                    interval = poll_interval
+                else:
+                    interval = self.polling.next_interval(attempt, status)
+                    attempt += 1
+                interval = min(interval, max(0.0, timeout - (time.time() - start_time)))
+                time.sleep(interval)
+                waited += interval
+
+            raise TimeoutError(f"Message processing timed out after {timeout} seconds")
+
+        finally:
+            elapsed = time.time() - start_time
+            self.poll_metrics.record(message_id, polls, waited, elapsed, status)
+            logging.info(f"Message {message_id} reached {status} after {polls} polls ({waited:.2f}s sleeping, {elapsed:.2f}s total).")
 
     def get_space(self, space_id: str) -> dict:
         """Get details of a specific Genie space."""
@@ -283,4 +1217,999 @@ class GenieClient:
                                                                  num_results=num_results,
                                                                  query_text=query_text,
                                                                  filters_json=filters)
-        return response.result.data_array #[0][0] to access result content of first match
\ No newline at end of file
+        return response.result.data_array #[0][0] to access result content of first match
+
+    def index_version(self, index: str, catalog: str, schema: str) -> Tuple[Any, Any]:
+        """Fingerprint of the vector index sync state; changes whenever a sync adds or removes rows."""
+        response = self.client.vector_search_indexes.get_index(index_name=f"{catalog}.{schema}.{index}")
+        status = response.status
+        return (getattr(status, "indexed_row_count", None), getattr(status, "message", None))
+
+# Class to share warm GenieClient instances across sessions and threads
+class GenieClientRegistry:
+    def __init__(self, max_clients: int = 64, ttl_seconds: int = 1800):
+        self.max_clients = max_clients
+        self.ttl_seconds = ttl_seconds
+        self._clients: "OrderedDict[Tuple[str, str, str], Tuple[GenieClient, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(host: str, token: str, space_id: str) -> Tuple[str, str, str]:
+        """Build the registry key. Tokens are hashed so they never appear in keys or logs."""
+        return (host, token_fingerprint(token), space_id)
+
+    def get(self, host: str, space_id: str, token: str) -> GenieClient:
+        """Return a warm client for (host, token, space_id), creating it on first use or after expiry."""
+        key = self._key(host, token, space_id)
+        now = time.monotonic()
+
+        with self._lock:
+            self._evict_expired(now)
+            entry = self._clients.get(key)
+            if entry is not None:
+                self._clients[key] = (entry[0], now)
+                self._clients.move_to_end(key)
+                return entry[0]
+
+        # Build outside the lock: Config/WorkspaceClient setup is slow and must not block other sessions
+        client = GenieClient(host=host, space_id=space_id, token=token)
+
+        with self._lock:
+            entry = self._clients.get(key)
+            if entry is not None:  # Another thread won the race, keep its client
+                client = entry[0]
+            self._clients[key] = (client, now)
+            self._clients.move_to_end(key)
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)  # Least recently used
+        return client
+
+    def invalidate(self, host: str, space_id: str, token: str):
+        """Drop a client, e.g. after its token has been revoked."""
+        with self._lock:
+            self._clients.pop(self._key(host, token, space_id), None)
+
+    def clear(self):
+        """Drop every cached client."""
+        with self._lock:
+            self._clients.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._clients)
+
+    def _evict_expired(self, now: float):
+        """Remove clients idle for longer than ttl_seconds. Caller must hold the lock."""
+        expired = [key for key, (_, last_used) in self._clients.items() if now - last_used > self.ttl_seconds]
+        for key in expired:
+            del self._clients[key]
+
+
+# Class to share Databricks SQL connections across persistence paths
+class SQLConnectionPool:
+    def __init__(self, pool_size: int = 5, max_overflow: int = 5, max_idle_seconds: int = 300,
+                 health_check_after: int = 60, acquire_timeout: int = 30):
+        self.pool_size = pool_size                  # Idle connections kept per key
+        self.max_overflow = max_overflow            # Extra connections allowed under burst, closed on release
+        self.max_idle_seconds = max_idle_seconds    # Idle connections older than this are closed
+        self.health_check_after = health_check_after  # Idle time after which a connection is probed with SELECT 1
+        self.acquire_timeout = acquire_timeout      # Max seconds to wait for a free connection
+        self._pools: Dict[Tuple[str, str, str], Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self._closed = False                        # Set by close_all: nothing goes back to the idle pools
+
+    def _pool_for(self, key: Tuple[str, str, str]) -> Dict[str, Any]:
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = {
+                    "cond": threading.Condition(),
+                    "idle": deque(),  # (connection, idle_since)
+                    "in_use": 0,
+                    "created": 0,
+                    "closed": 0,
+                    "waits": 0,
+                    "wait_seconds": 0.0,
+                    "max_wait_seconds": 0.0,
+                    "timeouts": 0,
+                    "failed_health_checks": 0,
+                }
+                self._pools[key] = pool
+            return pool
+
+    @contextmanager
+    def connection(self, host: str, http_path: str, token: str):
+        """Borrow a connection for (host, http_path, token) and give it back when the block exits.
+        Connections that raised inside the block are discarded instead of returned."""
+        pool = self._pool_for((host, http_path, token_fingerprint(token)))
+        conn = self._acquire(pool, host, http_path, token)
+        try:
+            yield conn
+        except Exception:
+            self._release(pool, conn, discard=True)
+            raise
+        else:
+            self._release(pool, conn)
+
+    def _acquire(self, pool: Dict[str, Any], host: str, http_path: str, token: str):
+        """Return a healthy idle connection or open a new one, waiting if the pool is exhausted."""
+        cond = pool["cond"]
+        start = time.monotonic()
+        deadline = start + self.acquire_timeout
+
+        with cond:
+            while True:
+                candidate = self._take_idle(pool)
+                if candidate is not None:
+                    break
+                if pool["in_use"] < self.pool_size + self.max_overflow:
+                    pool["in_use"] += 1  # Reserve the slot, connect outside the lock
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    pool["timeouts"] += 1
+                    raise TimeoutError(f"Timed out after {self.acquire_timeout}s waiting for a SQL connection.")
+                cond.wait(remaining)
+
+            waited = time.monotonic() - start
+            if waited > 0.001:
+                pool["waits"] += 1
+                pool["wait_seconds"] += waited
+                pool["max_wait_seconds"] = max(pool["max_wait_seconds"], waited)
+
+        if candidate is not None:
+            conn, idle_since = candidate
+            if self._is_healthy(conn, time.monotonic() - idle_since):
+                return conn
+            with cond:
+                pool["failed_health_checks"] += 1
+            self._close(pool, conn)
+
+        try:
+            conn = sql.connect(server_hostname=host, http_path=http_path, access_token=token)
+        except Exception:
+            with cond:
+                pool["in_use"] -= 1
+                cond.notify()
+            raise
+        with cond:
+            pool["created"] += 1
+        return conn
+
+    def _take_idle(self, pool: Dict[str, Any]):
+        """Pop the most recently used idle connection, closing any that idled out. Caller holds the condition."""
+        now = time.monotonic()
+        while pool["idle"]:
+            conn, idle_since = pool["idle"].pop()
+            if now - idle_since > self.max_idle_seconds:
+                self._close(pool, conn, locked=True)
+                continue
+            pool["in_use"] += 1
+            return conn, idle_since
+        return None
+
+    def _is_healthy(self, conn, idle_seconds: float) -> bool:
+        """Cheap liveness check, with a SELECT 1 probe for connections idle longer than health_check_after."""
+        if not getattr(conn, "open", True):
+            return False
+        if idle_seconds < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            return True
+        except Exception:
+            return False
+
+    def _release(self, pool: Dict[str, Any], conn, discard: bool = False):
+        cond = pool["cond"]
+        with cond:
+            pool["in_use"] -= 1
+            if not discard and not self._closed and len(pool["idle"]) < self.pool_size and getattr(conn, "open", True):
+                pool["idle"].append((conn, time.monotonic()))
+                conn = None
+            cond.notify()
+        if conn is not None:
+            self._close(pool, conn)
+
+    def _close(self, pool: Dict[str, Any], conn, locked: bool = False):
+        try:
+            conn.close()
+        except Exception as close_err:
+            logging.warning(f"Error closing pooled connection: {str(close_err)}")
+        if locked:
+            pool["closed"] += 1
+        else:
+            with pool["cond"]:
+                pool["closed"] += 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Usage counters per (host, http_path) to size the pool. Tokens are reported by fingerprint prefix."""
+        with self._lock:
+            pools = list(self._pools.items())
+        report = {}
+        for (host, http_path, fingerprint), pool in pools:
+            with pool["cond"]:
+                report[f"{host}{http_path}#{fingerprint[:8]}"] = {
+                    "in_use": pool["in_use"],
+                    "idle": len(pool["idle"]),
+                    "created": pool["created"],
+                    "closed": pool["closed"],
+                    "waits": pool["waits"],
+                    "total_wait_seconds": round(pool["wait_seconds"], 3),
+                    "avg_wait_seconds": round(pool["wait_seconds"] / pool["waits"], 3) if pool["waits"] else 0.0,
+                    "max_wait_seconds": round(pool["max_wait_seconds"], 3),
+                    "timeouts": pool["timeouts"],
+                    "failed_health_checks": pool["failed_health_checks"],
+                }
+        return report
+
+    def close_all(self):
+        """Close every idle connection, e.g. on shutdown. Borrowed connections are closed on release."""
+        with self._lock:
+            self._closed = True
+            pools = list(self._pools.values())
+        for pool in pools:
+            with pool["cond"]:
+                idle = list(pool["idle"])
+                pool["idle"].clear()
+            for conn, _ in idle:
+                self._close(pool, conn)
+
+
+# Class exposing GenieClient to asyncio: blocking SDK calls run in worker threads, waits sleep on the event loop
+class AsyncGenieClient:
+    STATEMENT_TERMINAL_STATES = ("SUCCEEDED", "FAILED", "CANCELED", "CLOSED")
+
+    def __init__(self, client: GenieClient):
+        self.sync = client
+        self.space_id = client.space_id
+        self.polling = client.polling
+        self.poll_metrics = client.poll_metrics
+
+    message_description = staticmethod(GenieClient.message_description)
+
+    async def start_conversation(self, question: str) -> Dict[str, Any]:
+        """Start a new conversation without waiting for the answer."""
+        return await asyncio.to_thread(self.sync.start_conversation, question, False)
+
+    async def send_message(self, conversation_id: str, message: str) -> Dict[str, Any]:
+        """Send a follow-up message without waiting for the answer."""
+        return await asyncio.to_thread(self.sync.send_message, conversation_id, message, False)
+
+    async def upload_message_attachment(self, conversation_id: str, message_id: str, file: bytes, filename: str):
+        return await asyncio.to_thread(self.sync.upload_message_attachment, conversation_id, message_id, file, filename)
+
+    async def get_message(self, conversation_id: str, message_id: str) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.sync.get_message, conversation_id, message_id)
+
+    async def get_query_result(self, conversation_id: str, message_id: str, attachment_id: str) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.sync.get_query_result, conversation_id, message_id, attachment_id)
+
+    async def wait_for_message_completion(self, conversation_id: str, message_id: str, timeout: int = 300, poll_interval: Optional[float] = None) -> Dict[str, Any]:
+        """Async twin of GenieClient.wait_for_message_completion: same strategy and metrics, no thread held while waiting."""
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        polls = 0
+        waited = 0.0
+        attempt = 0
+        status = last_status = None
+
+        try:
+            while loop.time() - start_time < timeout:
+                message = await self.get_message(conversation_id, message_id)
+                polls += 1
+                status = message.get("status")
+
+                if status in GenieClient.TERMINAL_STATUSES:
+                    return message
+
+                if status != last_status:
+                    attempt, last_status = 0, status
+                if poll_interval is not None:
+                    interval = poll_interval
+                else:
+                    interval = self.polling.next_interval(attempt, status)
+                    attempt += 1
+                interval = min(interval, max(0.0, timeout - (loop.time() - start_time)))
+                await asyncio.sleep(interval)
+                waited += interval
+
+            raise TimeoutError(f"Message processing timed out after {timeout} seconds")
+
+        finally:
+            elapsed = loop.time() - start_time
+            self.poll_metrics.record(message_id, polls, waited, elapsed, status)
+            logging.info(f"Message {message_id} reached {status} after {polls} polls ({waited:.2f}s sleeping, {elapsed:.2f}s total).")
+
+    async def send_feedback(self, space_id: str, conversation_id: str, message_id: str, rating):
+        return await asyncio.to_thread(self.sync.send_feedback, space_id, conversation_id, message_id, rating)
+
+    async def delete_conversation(self, space_id: str, conversation_id: str):
+        return await asyncio.to_thread(self.sync.delete_conversation, space_id, conversation_id)
+
+    async def execute_statement(self, warehouse_id: str, sql: str, disposition, format):
+        return await asyncio.to_thread(self.sync.execute_statement, warehouse_id, sql, disposition, format)
+
+    async def get_statement(self, statement_id: str):
+        return await asyncio.to_thread(self.sync.get_statement, statement_id)
+
+    async def wait_for_statement(self, statement_id: str, timeout: int = 300, poll_interval: Optional[float] = None):
+        """Poll a statement until it reaches a terminal state and return it."""
+        loop = asyncio.get_running_loop()
+        start_time = loop.time()
+        attempt = 0
+
+        while True:
+            stmt = await self.get_statement(statement_id)
+            state = stmt.status.state.value
+
+            if state in self.STATEMENT_TERMINAL_STATES:
+                return stmt
+
+            if loop.time() - start_time > timeout:
+                raise TimeoutError(f"Statement {statement_id} timed out.")
+
+            interval = poll_interval if poll_interval is not None else self.polling.next_interval(attempt, "EXECUTING_QUERY")
+            attempt += 1
+            await asyncio.sleep(interval)
+
+    async def get_chunk(self, statement_id: str, chunk_index: int):
+        return await asyncio.to_thread(self.sync.get_chunk, statement_id, chunk_index)
+
+    async def current_user(self) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.sync.current_user)
+
+    async def similarity_search(self, index: str, catalog: str, schema: str, columns: list, num_results: int, query_text: str, filters: str):
+        return await asyncio.to_thread(self.sync.similarity_search, index, catalog, schema, columns, num_results, query_text, filters)
+
+    async def index_version(self, index: str, catalog: str, schema: str) -> Tuple[Any, Any]:
+        return await asyncio.to_thread(self.sync.index_version, index, catalog, schema)
+
+# Class running one background asyncio loop, so sync callers (Streamlit threads) can drive coroutines on it
+class EventLoopThread:
+    def __init__(self, max_workers: int = 64, name: str = "genie-event-loop"):
+        self.max_workers = max_workers  # Threads for blocking SDK/SQL calls offloaded with asyncio.to_thread
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or not self._thread.is_alive():
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=f"{self.name}-io"))
+                thread = threading.Thread(target=loop.run_forever, name=self.name, daemon=True)
+                thread.start()
+                self._loop, self._thread = loop, thread
+            return self._loop
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Run a coroutine on the background loop and block until it returns."""
+        loop = self._ensure_started()
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("EventLoopThread.run() cannot be called from the loop thread itself; await the coroutine instead.")
+        return asyncio.run_coroutine_threadsafe(coro, loop).result(timeout)
+
+    def submit(self, coro):
+        """Schedule a coroutine on the background loop and return a concurrent.futures.Future."""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_started())
+
+    def stop(self):
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join(timeout=5)
+                self._loop = self._thread = None
+
+
+# Class caching regenerated SQL results, shared across sessions and bounded by total DataFrame bytes
+class ResultCache:
+    # TTL (seconds) per freshness class
+    DEFAULT_TTLS = {
+        "volatile": 60,      # Depends on the clock or randomness: current_date(), now(), rand()...
+        "standard": 900,
+        "static": 86400,     # Caller knows the data does not change (e.g. closed periods)
+    }
+    VOLATILE_PATTERN = re.compile(r"\b(current_date|current_timestamp|now|getdate|curdate|unix_timestamp|rand|random|randn|uuid)\s*\(", re.IGNORECASE)
+    _LITERAL_PATTERN = re.compile(r"('(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.)*\")")
+    _COMMENT_PATTERN = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, ttls: Optional[Dict[str, int]] = None):
+        self.max_bytes = max_bytes
+        self.ttls = dict(self.DEFAULT_TTLS if ttls is None else ttls)
+        self._entries: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def normalize_sql(cls, sql_text: str) -> str:
+        """Canonical SQL text: comments dropped, whitespace collapsed, lowercased outside string literals, no trailing ';'."""
+        parts = cls._LITERAL_PATTERN.split(sql_text or "")
+        normalized = []
+        for i, part in enumerate(parts):
+            if i % 2:  # String literal, kept verbatim
+                normalized.append(part)
+            else:
+                part = cls._COMMENT_PATTERN.sub(" ", part)
+                normalized.append(" ".join(part.split()).lower())
+        return " ".join(p for p in normalized if p).strip().rstrip(";").strip()
+
+    @classmethod
+    def freshness(cls, sql_text: str) -> str:
+        """Pick the freshness class of a statement from its text."""
+        return "volatile" if cls.VOLATILE_PATTERN.search(sql_text or "") else "standard"
+
+    @classmethod
+    def key(cls, sql_text: str, warehouse_id: str, catalog: str, schema: str, *extra) -> tuple:
+        return (cls.normalize_sql(sql_text), warehouse_id, catalog, schema) + tuple(extra)
+
+    def get(self, key: tuple):
+        """Cached DataFrame for key or None. Returns a deep copy so callers cannot mutate the cached frame."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires_at"] <= time.monotonic():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["df"].copy()
+
+    def put(self, key: tuple, df, freshness: str = "standard"):
+        """Store a result; evicts least recently used entries until the byte budget fits."""
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return  # Larger than the whole cache, not worth evicting everything for it
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = {
+                "df": df,
+                "bytes": size,
+                "freshness": freshness,
+                "expires_at": time.monotonic() + self.ttls.get(freshness, self.ttls["standard"]),
+            }
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate(self, key: tuple):
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _drop(self, key: tuple):
+        """Remove one entry. Caller must hold the lock."""
+        self._bytes -= self._entries.pop(key)["bytes"]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+# Class caching small values (search results, user info...) with a TTL and an LRU bound, shared across sessions
+class TTLCache:
+    def __init__(self, max_entries: int = 1024, ttl_seconds: int = 600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Any, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        """Cached value for key, or default if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, ttl_seconds: Optional[int] = None):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + (self.ttl_seconds if ttl_seconds is None else ttl_seconds))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate) -> int:
+        """Drop every entry whose key matches predicate(key). Returns how many were dropped."""
+        with self._lock:
+            keys = [key for key in self._entries if predicate(key)]
+            for key in keys:
+                del self._entries[key]
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+# Class writing persistence events behind the request path: events are batched per key (e.g. operation + target)
+# and handed to a write callback on size or time triggers, from a single background thread.
+# Batches are written by rank (order(key), lower first) and then by age, so rows exist before they are updated.
+class PersistenceWriter:
+    _FLUSH, _STOP, _TICK = object(), object(), object()  # Control messages sent through the queue
+
+    def __init__(self, write: Callable[[Hashable, List[dict]], None], on_failure: Callable[[Hashable, List[dict], Exception], None],
+                 max_batch: int = 50, flush_interval: float = 2.0, name: str = "persistence-writer",
+                 order: Optional[Callable[[Hashable], int]] = None):
+        self.write = write              # Writes one batch; raising hands the whole batch to on_failure
+        self.on_failure = on_failure
+        self.order = order or (lambda key: 0)
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._queue: "queue.Queue" = queue.Queue()
+        self._lock = threading.Lock()
+        self._pending = 0               # Submitted events not written (nor failed) yet
+        self._stats = {"events": 0, "batches": 0, "failed_events": 0, "flush_seconds_total": 0.0,
+                       "flush_seconds_max": 0.0, "last_flush_seconds": 0.0}
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, key: Hashable, event: dict):
+        """Queue an event; it is written with the next batch for its key."""
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("PersistenceWriter is stopped")
+            self._pending += 1
+        self._queue.put((key, event))
+
+    def flush(self, timeout: Optional[float] = 30) -> bool:
+        """Write every event submitted so far. Returns False if that took longer than timeout."""
+        done = threading.Event()
+        self._queue.put((self._FLUSH, done))
+        return done.wait(timeout)
+
+    def stop(self, timeout: Optional[float] = 30):
+        """Flush what is queued and stop the worker (registered at exit by the owner)."""
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+        self._queue.put((self._STOP, None))
+        self._thread.join(timeout)
+
+    def depth(self) -> int:
+        with self._lock:
+            return self._pending
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            batches = self._stats["batches"]
+            return {
+                "depth": self._pending,
+                "events": self._stats["events"],
+                "batches": batches,
+                "failed_events": self._stats["failed_events"],
+                "last_flush_seconds": round(self._stats["last_flush_seconds"], 3),
+                "avg_flush_seconds": round(self._stats["flush_seconds_total"] / batches, 3) if batches else 0.0,
+                "max_flush_seconds": round(self._stats["flush_seconds_max"], 3),
+            }
+
+    def _run(self):
+        batches: "OrderedDict[Hashable, List[dict]]" = OrderedDict()
+        deadline = None  # Time-based flush of the oldest open batch
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                key, event = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                key, event = self._TICK, None
+
+            if key is self._FLUSH or key is self._STOP:
+                self._write_all(batches)
+                deadline = None
+                if key is self._STOP:
+                    return
+                event.set()
+                continue
+
+            if key is not self._TICK:
+                batches.setdefault(key, []).append(event)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                if len(batches[key]) >= self.max_batch:
+                    self._write_all(batches, up_to=key)
+            if deadline is not None and time.monotonic() >= deadline:
+                self._write_all(batches)
+                deadline = None
+
+    def _write_all(self, batches: "OrderedDict[Hashable, List[dict]]", up_to: Optional[Hashable] = None):
+        """Write the pending batches by rank, oldest first within a rank. With up_to, only that batch and the ones
+        ranked before it."""
+        for key in sorted(batches, key=self.order):  # Stable sort: same rank keeps arrival order
+            if up_to is None or key == up_to or self.order(key) < self.order(up_to):
+                self._write_batch(key, batches.pop(key))
+
+    def _write_batch(self, key: Hashable, events: List[dict]):
+        start = time.monotonic()
+        failed = 0
+        try:
+            self.write(key, events)
+        except Exception as e:
+            failed = len(events)
+            logging.warning(f"Write-behind batch {key[0] if isinstance(key, tuple) else key} of {failed} events failed: {str(e)}")
+            try:
+                self.on_failure(key, events, e)
+            except Exception as fallback_err:
+                logging.error(f"Could not hand failed batch to fallback: {str(fallback_err)}")
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self._pending -= len(events)
+            self._stats["events"] += len(events) - failed
+            self._stats["failed_events"] += failed
+            self._stats["batches"] += 1
+            self._stats["flush_seconds_total"] += elapsed
+            self._stats["flush_seconds_max"] = max(self._stats["flush_seconds_max"], elapsed)
+            self._stats["last_flush_seconds"] = elapsed
+
+# Class draining the offline queue periodically from a background thread of the app process. Runs are spaced by
+# a jittered interval that backs off exponentially while drain reports the warehouse unhealthy (False or raising).
+# An exclusive lock on lock_file keeps a single drainer among the processes of a host.
+class DrainScheduler:
+    def __init__(self, drain: Callable[[], bool], interval: float = 300, max_interval: float = 3600,
+                 lock_file: Optional[str] = None, name: str = "offline-queue-drain"):
+        self.drain = drain              # One drain run; False or an exception means the warehouse is unhealthy
+        self.interval = interval
+        self.max_interval = max_interval
+        self.lock_file = lock_file
+        self._lock_fd = None
+        self._stop = threading.Event()
+        self._stats = {"runs": 0, "failures": 0, "consecutive_failures": 0, "last_run": None, "locked": False}
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self, timeout: Optional[float] = 30):
+        """Stop after the current run (registered at exit by the owner) and release the lock."""
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+        self._release()
+
+    def next_delay(self) -> float:
+        failures = self._stats["consecutive_failures"]
+        delay = min(self.max_interval, self.interval * 2 ** failures)
+        return delay * random.uniform(0.8, 1.2)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(self._stats)
+
+    def _acquire(self) -> bool:
+        """Hold the drain lock (kept once acquired). False if another process holds it."""
+        if self._lock_fd is not None or self.lock_file is None or fcntl is None:
+            return True
+        fd = os.open(self.lock_file, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        self._stats["locked"] = True
+        return True
+
+    def _release(self):
+        if self._lock_fd is not None:
+            fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+            os.close(self._lock_fd)
+            self._lock_fd = None
+            self._stats["locked"] = False
+
+    def _run(self):
+        while not self._stop.wait(self.next_delay()):
+            if not self._acquire():
+                continue  # Another process drains the queue
+            try:
+                healthy = self.drain()
+            except Exception as e:
+                logging.warning(f"Offline queue drain failed: {str(e)}")
+                healthy = False
+            self._stats["runs"] += 1
+            self._stats["last_run"] = time.time()
+            if healthy is False:
+                self._stats["failures"] += 1
+                self._stats["consecutive_failures"] += 1
+                logging.warning(f"Warehouse unhealthy, backing off offline queue drains ({self._stats['consecutive_failures']} failed runs in a row).")
+            else:
+                self._stats["consecutive_failures"] = 0
+
+# Class implementing an in-memory full-text index over conversations (documents): title and prompt tokens in an
+# inverted index, a sorted vocabulary for prefix matches (bisect) and a trigram index for fuzzy matches.
+# Updated incrementally; search ranks documents matching every query token.
+class ChatSearchIndex:
+    FIELD_WEIGHTS = {"title": 2.0, "prompt": 1.0}
+    PREFIX_WEIGHT = 0.7           # A query token that starts a longer token
+    FUZZY_WEIGHT = 0.5            # Times the trigram similarity, for typos
+    MIN_FUZZY_SIMILARITY = 0.4
+    MAX_EXPANSIONS = 50           # Vocabulary tokens tried per query token for prefix matches
+
+    def __init__(self):
+        self._postings: Dict[str, Dict[str, float]] = {}          # token -> {document: weight}
+        self._fields: Dict[str, Dict[str, Counter]] = {}          # document -> field -> token counts
+        self._vocabulary: List[str] = []                          # Sorted tokens
+        self._trigrams: Dict[str, set] = {}                       # trigram -> tokens
+
+    @staticmethod
+    def tokens(text: str) -> List[str]:
+        return normalize_text(text).split()
+
+    @staticmethod
+    def trigrams(token: str) -> set:
+        padded = f"  {token} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def _index(self, document: str, field: str, counts: Counter, sign: int):
+        for token, count in counts.items():
+            postings = self._postings.get(token)
+            if postings is None and sign < 0:
+                continue
+            if postings is None:
+                postings = self._postings[token] = {}
+                bisect.insort(self._vocabulary, token)
+                for trigram in self.trigrams(token):
+                    self._trigrams.setdefault(trigram, set()).add(token)
+            weight = postings.get(document, 0.0) + sign * count * self.FIELD_WEIGHTS[field]
+            if weight > 1e-9:
+                postings[document] = weight
+            else:
+                postings.pop(document, None)
+            if not postings:
+                del self._postings[token]
+                del self._vocabulary[bisect.bisect_left(self._vocabulary, token)]
+                for trigram in self.trigrams(token):
+                    self._trigrams[trigram].discard(token)
+                    if not self._trigrams[trigram]:
+                        del self._trigrams[trigram]
+
+    def set_field(self, document: str, field: str, texts: List[str]):
+        """Replace the indexed text of one field of a document."""
+        fields = self._fields.setdefault(document, {})
+        self._index(document, field, fields.pop(field, Counter()), -1)
+        fields[field] = Counter(token for text in texts for token in self.tokens(text))
+        self._index(document, field, fields[field], 1)
+
+    def add_text(self, document: str, text: str, field: str = "prompt"):
+        """Index more text in a field of a document (e.g. a new message prompt)."""
+        counts = Counter(self.tokens(text))
+        self._fields.setdefault(document, {}).setdefault(field, Counter()).update(counts)
+        self._index(document, field, counts, 1)
+
+    def remove(self, document: str):
+        for field, counts in self._fields.pop(document, {}).items():
+            self._index(document, field, counts, -1)
+
+    def _matches(self, token: str) -> Dict[str, float]:
+        """Documents matching one query token: exact, prefix or fuzzy, scored by the best of them."""
+        candidates = {token: 1.0} if token in self._postings else {}
+        start = bisect.bisect_left(self._vocabulary, token)
+        for other in self._vocabulary[start:start + self.MAX_EXPANSIONS]:
+            if not other.startswith(token):
+                break
+            candidates.setdefault(other, self.PREFIX_WEIGHT)
+        if len(token) >= 3:
+            query_trigrams = self.trigrams(token)
+            shared = Counter(other for trigram in query_trigrams for other in self._trigrams.get(trigram, ()))
+            for other, count in shared.items():
+                similarity = count / (len(query_trigrams) + len(self.trigrams(other)) - count)
+                if similarity >= self.MIN_FUZZY_SIMILARITY and other not in candidates:
+                    candidates[other] = self.FUZZY_WEIGHT * similarity
+
+        scores: Dict[str, float] = {}
+        for other, factor in candidates.items():
+            for document, weight in self._postings[other].items():
+                scores[document] = max(scores.get(document, 0.0), factor * weight)
+        return scores
+
+    def search(self, query: str, limit: int = 50) -> List[Tuple[str, float]]:
+        """Documents matching every query token, best first, as (document, score)."""
+        ranked: Optional[Dict[str, float]] = None
+        for token in dict.fromkeys(self.tokens(query)):
+            scores = self._matches(token)
+            ranked = scores if ranked is None else {d: ranked[d] + s for d, s in scores.items() if d in ranked}
+            if not ranked:
+                return []
+        return sorted((ranked or {}).items(), key=lambda item: item[1], reverse=True)[:limit]
+
+# Class holding the chat history of a session, indexed for O(1) lookups: conversations by conversation_id (newest
+# first), messages by conversation_id and message_id (oldest first). Each conversation has a version counter,
+# bumped on every change, so derived data (e.g. exports) can be memoized per (conversation_id, version).
+class ConversationStore:
+    MESSAGE_ID_PREFIXES = ("user_", "assistant_")  # Rows added by the session; the database keeps the bare id
+
+    def __init__(self):
+        self._conversations: "OrderedDict[str, dict]" = OrderedDict()
+        self._messages: Dict[str, "OrderedDict[str, dict]"] = {}   # Loaded conversations only
+        self._message_conversation: Dict[str, str] = {}
+        self._before: Dict[str, Any] = {}                           # Key of the previous page of messages
+        self._versions: Dict[str, int] = {}
+        self._local_ids = 0
+        self.index = ChatSearchIndex()                              # Titles and loaded prompts
+
+    @classmethod
+    def message_key(cls, message_id: Optional[str]) -> str:
+        message_id = str(message_id or "")
+        for prefix in cls.MESSAGE_ID_PREFIXES:
+            if message_id.startswith(prefix):
+                return message_id[len(prefix):]
+        return message_id
+
+    def _touch(self, conversation_id: str):
+        self._versions[conversation_id] = self._versions.get(conversation_id, 0) + 1
+
+    def version(self, conversation_id: str) -> int:
+        return self._versions.get(conversation_id, 0)
+
+    # Conversations
+    def __contains__(self, conversation_id: str) -> bool:
+        return conversation_id in self._conversations
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def conversations(self) -> List[dict]:
+        return list(self._conversations.values())
+
+    def conversation(self, conversation_id: str) -> Optional[dict]:
+        return self._conversations.get(conversation_id)
+
+    def add_conversations(self, conversations: List[dict], first: bool = False) -> int:
+        """Add conversations not known yet, at the end (next page) or on top (new ones, given newest first).
+        Returns how many were added."""
+        added = [c for c in conversations if c.get("conversation_id") not in self._conversations]
+        for conv in reversed(added) if first else added:
+            self._conversations[conv["conversation_id"]] = conv
+            if first:
+                self._conversations.move_to_end(conv["conversation_id"], last=False)
+            self.index.set_field(conv["conversation_id"], "title", [conv.get("title") or ""])
+            self._touch(conv["conversation_id"])
+        return len(added)
+
+    def set_title(self, conversation_id: str, title: str) -> bool:
+        """Returns True if the title changed."""
+        conv = self._conversations.get(conversation_id)
+        if conv is None or not title or conv.get("title") == title:
+            return False
+        conv["title"] = title
+        self.index.set_field(conversation_id, "title", [title])
+        self._touch(conversation_id)
+        return True
+
+    def remove_conversation(self, conversation_id: str) -> bool:
+        """Forget a conversation and its messages. Returns True if it was known."""
+        known = self._conversations.pop(conversation_id, None) is not None
+        for key in self._messages.pop(conversation_id, {}):
+            self._message_conversation.pop(key, None)
+        self._before.pop(conversation_id, None)
+        self.index.remove(conversation_id)
+        self._touch(conversation_id)
+        return known
+
+    # Messages
+    def is_loaded(self, conversation_id: str) -> bool:
+        return conversation_id in self._messages
+
+    def earlier_page(self, conversation_id: str):
+        """Key of the previous page of messages, None once every message is loaded."""
+        return self._before.get(conversation_id)
+
+    def messages(self, conversation_id: str) -> List[dict]:
+        return list(self._messages.get(conversation_id, {}).values())
+
+    def message(self, message_id: str) -> Optional[dict]:
+        key = self.message_key(message_id)
+        conversation_id = self._message_conversation.get(key)
+        return None if conversation_id is None else self._messages[conversation_id].get(key)
+
+    def set_messages(self, conversation_id: str, messages: List[dict], before=None):
+        """Store the latest page of a conversation's messages (oldest first)."""
+        self._messages[conversation_id] = OrderedDict()
+        self._before[conversation_id] = before
+        self.index.set_field(conversation_id, "prompt", [])
+        for m in messages:
+            self.add_message(dict(m, conversation_id=conversation_id))
+        self._touch(conversation_id)
+
+    def prepend_messages(self, conversation_id: str, messages: List[dict], before=None):
+        """Insert the previous page of messages (oldest first) before the loaded ones."""
+        rows = self._messages.setdefault(conversation_id, OrderedDict())
+        for m in reversed(messages):
+            key = self.message_key(m.get("message_id"))
+            if key not in rows:
+                rows[key] = m
+                rows.move_to_end(key, last=False)
+                self._message_conversation[key] = conversation_id
+                self.index.add_text(conversation_id, m.get("prompt") or "")
+        self._before[conversation_id] = before
+        self._touch(conversation_id)
+
+    def add_message(self, message: dict, merge: bool = False) -> bool:
+        """Append a message to its conversation. A message already known is left as is, or updated with the new
+        fields if merge (user and assistant rows of one exchange share the message id). Returns True if new."""
+        conversation_id = message.get("conversation_id")
+        key = self.message_key(message.get("message_id"))
+        if not key:
+            self._local_ids += 1
+            key = f"local-{self._local_ids}"  # Not persisted yet
+        rows = self._messages.setdefault(conversation_id, OrderedDict())
+        if key in rows:
+            if merge:
+                rows[key].update(message)
+                self._touch(conversation_id)
+            return False
+        rows[key] = message
+        self._message_conversation[key] = conversation_id
+        self.index.add_text(conversation_id, message.get("prompt") or "")
+        self._touch(conversation_id)
+        return True
+
+    def update_message(self, message_id: str, **fields) -> Optional[dict]:
+        """Update fields of a known message. Returns the message, None if unknown."""
+        message = self.message(message_id)
+        if message is not None:
+            message.update(fields)
+            self._touch(self._message_conversation[self.message_key(message_id)])
+        return message
+
+    def search(self, query: str, limit: int = 50, found: List[dict] = ()) -> List[dict]:
+        """Conversations matching the query (titles, and prompts of loaded messages), best first, followed by the
+        conversations found by a server-side search (e.g. not loaded yet) that didn't rank here."""
+        ranked = [self._conversations[document] for document, _ in self.index.search(query, limit) if document in self._conversations]
+        seen = {conv["conversation_id"] for conv in ranked}
+        for conv in found:
+            if conv["conversation_id"] not in seen:
+                seen.add(conv["conversation_id"])
+                ranked.append(self._conversations.get(conv["conversation_id"], conv))
+        return ranked
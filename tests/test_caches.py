@@ -0,0 +1,127 @@
+# pytest -q tests/test_caches.py --> runs cache tests
+
+import sys
+import os
+import pandas as pd
+from types import SimpleNamespace
+from unittest.mock import patch, MagicMock, AsyncMock
+
+# Ensure parent directory matches modules location
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+def test_result_cache_normalizes_sql_and_counts_hits():
+    from modules import ResultCache
+    cache = ResultCache()
+
+    key = cache.key("SELECT region, count(*)\n  FROM sales -- by region\n WHERE country = 'ES';", "wh", "cat", "sch")
+    same = cache.key("select region,   COUNT(*) from SALES where country = 'ES'", "wh", "cat", "sch")
+    other_literal = cache.key("select region, count(*) from sales where country = 'es'", "wh", "cat", "sch")
+    assert key == same
+    assert key != other_literal
+
+    assert cache.get(key) is None
+    cache.put(key, pd.DataFrame({"region": ["EMEA"], "n": [3]}))
+    assert cache.get(same)["n"].iloc[0] == 3
+    served = cache.get(key)
+    served.loc[0, "n"] = 99                       # callers get a copy
+    assert cache.get(key)["n"].iloc[0] == 3
+    assert cache.stats()["hits"] == 3 and cache.stats()["misses"] == 1
+
+def test_result_cache_ttl_and_byte_bounded_lru(monkeypatch):
+    from modules import ResultCache
+    df = pd.DataFrame({"x": range(1000)})
+    size = int(df.memory_usage(deep=True).sum())
+    cache = ResultCache(max_bytes=2 * size, ttls={"volatile": 10, "standard": 100})
+
+    assert ResultCache.freshness("select current_date()") == "volatile"
+    cache.put(("a",), df, "volatile")
+    cache.put(("b",), df)
+    cache.get(("a",))              # a becomes most recently used
+    cache.put(("c",), df)          # over budget: evicts b
+    assert cache.get(("b",)) is None
+    assert cache.stats()["evictions"] == 1
+
+    now = __import__("time").monotonic()
+    monkeypatch.setattr("modules.time.monotonic", lambda: now + 50)
+    assert cache.get(("a",)) is None   # volatile TTL expired
+    assert cache.get(("c",)) is not None
+
+@patch("modules.WorkspaceClient")
+def test_semantic_search_cache_normalizes_query_and_follows_index_version(MockWorkspace, monkeypatch):
+    mock_ws = MagicMock()
+    MockWorkspace.return_value = mock_ws
+
+    import genie_room
+    monkeypatch.setattr(genie_room, "persist_similarity_search", lambda *args: None)
+    mock_ws.current_user.me.return_value = SimpleNamespace(id="u1", display_name="Ana", user_name="ana@x.com", groups=[])
+    mock_ws.vector_search_indexes.query_index.return_value.result.data_array = [["q", "c", "answer", "m1", "u1", 0.9]]
+    mock_ws.vector_search_indexes.get_index.return_value.status = SimpleNamespace(indexed_row_count=10, message="synced")
+
+    first = genie_room.semantic_search("space-sem", "tok-sem", "/path", "cat", "sch", "Sales by region?")
+    second = genie_room.semantic_search("space-sem", "tok-sem", "/path", "cat", "sch", "  sales BY region ")
+    assert first == second
+    assert mock_ws.vector_search_indexes.query_index.call_count == 1
+
+    # A new index sync drops the cached searches once the version is checked again
+    mock_ws.vector_search_indexes.get_index.return_value.status = SimpleNamespace(indexed_row_count=11, message="synced")
+    genie_room.semantic_index_checks.clear()
+    genie_room.semantic_search("space-sem", "tok-sem", "/path", "cat", "sch", "sales by region")
+    assert mock_ws.vector_search_indexes.query_index.call_count == 2
+
+@patch("modules.WorkspaceClient")
+def test_answer_cache_reruns_sql_and_opens_genie_on_follow_up(MockWorkspace, monkeypatch):
+    mock_ws = MagicMock()
+    MockWorkspace.return_value = mock_ws
+
+    import genie_room
+    monkeypatch.setattr(genie_room, "persist_new_conversation", lambda *args: "title")
+    monkeypatch.setattr(genie_room, "persist_message", lambda *args: None)
+    df = pd.DataFrame({"model_year": [2024], "n": [7]})
+    monkeypatch.setattr(genie_room, "process_genie_response_async", AsyncMock(return_value=(df, "SELECT 1")))
+    executed = []
+    async def fake_execute(*args, **kwargs):
+        executed.append(args[7])
+        return df
+    monkeypatch.setattr(genie_room, "execute_sql_with_polling_async", fake_execute)
+
+    started = SimpleNamespace(message=None, conversation_id="conv-1", message_id="msg-1")
+    mock_ws.genie.start_conversation.return_value.response = started
+    mock_ws.genie.create_message.return_value.response = SimpleNamespace(message_id="msg-2", user_id="u1", created_timestamp=1_700_000_000_000)
+    mock_ws.genie.get_message.return_value = SimpleNamespace(user_id="u1", created_timestamp=1_700_000_000_000,
+                                                             as_dict=lambda: {"status": "COMPLETED", "attachments": []})
+    mock_ws.current_user.me.return_value = SimpleNamespace(id="u1", display_name="Ana", user_name="ana@x.com", groups=[])
+
+    args = ("tok-answer", "space-answer", "/path", "cat", "sch")
+    conv_id, *_ = genie_room.start_new_conversation("Count of vins by model year?", *args, warehouse_id="wh")
+    assert conv_id == "conv-1"
+
+    cached_conv, result, query_text, message_id, _, _ = genie_room.start_new_conversation("count of VINs by model year", *args, warehouse_id="wh")
+    assert genie_room.is_cached_id(cached_conv) and genie_room.is_cached_id(message_id)
+    assert query_text == "SELECT 1" and executed == ["SELECT 1"]
+    assert mock_ws.genie.start_conversation.call_count == 1
+
+    # Opt-out goes to Genie even for a cached question
+    genie_room.start_new_conversation("count of VINs by model year", *args, warehouse_id="wh", use_answer_cache=False)
+    assert mock_ws.genie.start_conversation.call_count == 2
+
+    # Operators are part of the question: no cached answer for the opposite filter
+    genie_room.start_new_conversation("orders with amount > 100", *args, warehouse_id="wh")
+    genie_room.start_new_conversation("orders with amount < 100", *args, warehouse_id="wh")
+    assert mock_ws.genie.start_conversation.call_count == 4 and executed == ["SELECT 1"]
+
+    # The first follow-up opens the real Genie conversation with one message carrying the original question and SQL
+    links = []
+    monkeypatch.setattr(genie_room, "persist_conversation_link", lambda *args: links.append(args[-2:]))
+    genie_room.continue_conversation(cached_conv, "and by region?", *args)
+    assert mock_ws.genie.start_conversation.call_count == 5 and mock_ws.genie.create_message.call_count == 0
+    content = mock_ws.genie.start_conversation.call_args.kwargs["content"]
+    assert "count of VINs by model year" in content and "SELECT 1" in content and "and by region?" in content
+    assert links == [(cached_conv, "conv-1")]
+
+    # After a restart the link is read back from the conversations table
+    genie_room.answer_aliases.clear()
+    monkeypatch.setattr(genie_room, "load_answer_alias", lambda *args: {"question": "q", "query_text": "SELECT 1", "genie_conversation_id": "conv-1"})
+    genie_room.continue_conversation(cached_conv, "and by color?", *args)
+    assert mock_ws.genie.create_message.call_args.kwargs["conversation_id"] == "conv-1"
+
+    assert genie_room.invalidate_answer_cache("space-answer") == 3
@@ -0,0 +1,61 @@
+# pytest -q tests/test_chat_search_index.py --> runs sidebar chat search tests
+
+import sys
+import os
+
+# Ensure parent directory matches modules location
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules import ChatSearchIndex, ConversationStore
+
+def test_search_ranks_exact_prefix_and_fuzzy_matches():
+    index = ChatSearchIndex()
+    index.set_field("c1", "title", ["Sales by region"])
+    index.set_field("c2", "title", ["Inventory"])
+    index.add_text("c2", "What were the sales last quarter?")
+    index.set_field("c3", "title", ["Salesforce leads"])
+    index.set_field("c4", "title", ["Regional margins"])
+
+    assert [d for d, _ in index.search("sales")] == ["c1", "c3", "c2"]   # title, title prefix, prompt
+    assert [d for d, _ in index.search("reg")] == ["c1", "c4"]            # prefixes of region / regional
+    assert [d for d, _ in index.search("inventroy")] == ["c2"]            # typo
+    assert [d for d, _ in index.search("sales region")] == ["c1"]         # every token must match
+    assert index.search("weather") == [] and index.search("?!") == []
+
+def test_index_updates_incrementally():
+    index = ChatSearchIndex()
+    index.set_field("c1", "title", ["Fleet usage"])
+    index.set_field("c1", "title", ["Battery health"])
+    assert index.search("fleet") == [] and [d for d, _ in index.search("battery")] == ["c1"]
+
+    index.add_text("c1", "charging cycles per vehicle")
+    assert [d for d, _ in index.search("cycles")] == ["c1"]
+    index.remove("c1")
+    assert index.search("battery") == [] and len(index) == 0
+    assert index._vocabulary == [] and index._trigrams == {}
+
+def test_conversation_store_keeps_the_index_current():
+    store = ConversationStore()
+    store.add_conversations([{"conversation_id": "c1", "title": "Monthly revenue"}, {"conversation_id": "c2", "title": "Headcount"}])
+    store.set_messages("c2", [{"message_id": "m1", "prompt": "revenue per employee"}])
+    assert [c["conversation_id"] for c in store.search("revenue")] == ["c1", "c2"]
+
+    store.add_message({"conversation_id": "c1", "message_id": "user_m2", "prompt": "and churn?"}, merge=True)
+    store.set_title("c2", "Attrition")
+    assert [c["conversation_id"] for c in store.search("churn")] == ["c1"]
+    assert [c["conversation_id"] for c in store.search("attr")] == ["c2"]
+
+    store.remove_conversation("c1")
+    assert [c["conversation_id"] for c in store.search("revenue")] == ["c2"]
+
+def test_conversation_store_appends_server_side_matches():
+    store = ConversationStore()
+    store.add_conversations([{"conversation_id": "c1", "title": "Monthly revenue"}, {"conversation_id": "c2", "title": "Headcount"}])
+    store.set_title("c2", "Revenue per head")
+    # Server-side matches: a loaded chat (listed with its current title) and chats beyond the loaded pages
+    found = [{"conversation_id": "c2", "title": "Headcount"}, {"conversation_id": "c9", "title": "Old revenue"},
+             {"conversation_id": "c8", "title": "Prompt mentions revenue"}]
+    results = store.search("revenue", found=found)
+    assert [c["conversation_id"] for c in results] == ["c1", "c2", "c9", "c8"]
+    assert results[1]["title"] == "Revenue per head"
+    assert [c["conversation_id"] for c in store.search("weather", found=found[1:2])] == ["c9"]
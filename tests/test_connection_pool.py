@@ -0,0 +1,67 @@
+# pytest -q tests/test_connection_pool.py --> runs SQL connection pool tests
+
+from unittest.mock import patch, MagicMock
+import sys
+import os
+import pytest
+
+# Ensure parent directory matches modules location
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+# Test connections are reused, overflow is closed and failures are discarded
+@patch("modules.sql.connect")
+def test_pool_reuses_and_limits_connections(mock_connect):
+    mock_connect.side_effect = lambda **kwargs: MagicMock(open=True)
+
+    from modules import SQLConnectionPool
+    pool = SQLConnectionPool(pool_size=1, max_overflow=1, acquire_timeout=0)
+
+    # Idle connection is handed out again for the same key
+    with pool.connection("h", "/path", "tok") as first:
+        pass
+    with pool.connection("h", "/path", "tok") as second:
+        assert second is first
+    assert mock_connect.call_count == 1
+
+    # Overflow connection is closed on release instead of kept idle
+    with pool.connection("h", "/path", "tok"):
+        with pool.connection("h", "/path", "tok"):
+            # Pool exhausted: waiting times out
+            with pytest.raises(TimeoutError):
+                with pool.connection("h", "/path", "tok"):
+                    pass
+    stats = list(pool.stats().values())[0]
+    assert stats["idle"] == 1
+    assert stats["closed"] == 1
+
+    # A connection that raised inside the block is discarded
+    with pytest.raises(RuntimeError):
+        with pool.connection("h", "/path", "tok") as broken:
+            raise RuntimeError("boom")
+    broken.close.assert_called_once()
+
+    stats = list(pool.stats().values())[0]
+    assert stats["in_use"] == 0
+    assert stats["idle"] == 0
+    assert stats["closed"] == 2
+    assert stats["timeouts"] == 1
+
+# Test connections borrowed during close_all are closed on release, not pooled again
+@patch("modules.sql.connect")
+def test_close_all_closes_borrowed_connections_on_release(mock_connect):
+    mock_connect.side_effect = lambda **kwargs: MagicMock(open=True)
+
+    from modules import SQLConnectionPool
+    pool = SQLConnectionPool(pool_size=2, max_overflow=0)
+    with pool.connection("h", "/path", "tok") as borrowed:
+        with pool.connection("h", "/path", "tok") as idle:
+            pass
+        pool.close_all()
+        idle.close.assert_called_once()
+        borrowed.close.assert_not_called()
+    borrowed.close.assert_called_once()
+
+    stats = list(pool.stats().values())[0]
+    assert stats["idle"] == 0
+    assert stats["in_use"] == 0
+    assert stats["closed"] == 2
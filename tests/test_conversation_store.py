@@ -0,0 +1,48 @@
+# pytest -q tests/test_conversation_store.py --> runs session conversation store tests
+
+import sys
+import os
+
+# Ensure parent directory matches modules location
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from modules import ConversationStore
+
+def test_conversations_keep_order_dedupe_and_versions():
+    store = ConversationStore()
+    assert store.add_conversations([{"conversation_id": "c3", "title": "three"}, {"conversation_id": "c2", "title": "two"}]) == 2
+    assert store.add_conversations([{"conversation_id": "c2", "title": "dup"}, {"conversation_id": "c1", "title": "one"}]) == 1  # next page
+    assert store.add_conversations([{"conversation_id": "c5"}, {"conversation_id": "c4"}], first=True) == 2                    # new chats
+    assert [c["conversation_id"] for c in store.conversations()] == ["c5", "c4", "c3", "c2", "c1"]
+    assert store.conversation("c2")["title"] == "two"
+
+    version = store.version("c3")
+    assert store.set_title("c3", "AI title") and not store.set_title("c3", "AI title")
+    assert store.version("c3") == version + 1
+
+    assert store.remove_conversation("c3") and not store.remove_conversation("c3")
+    assert "c3" not in store and len(store) == 4
+
+def test_messages_are_indexed_paged_and_merged():
+    store = ConversationStore()
+    store.set_messages("c1", [{"message_id": "m3", "prompt": "q3"}, {"message_id": "m4", "prompt": "q4"}], before=("t3", "m3"))
+    assert store.is_loaded("c1") and not store.is_loaded("c2")
+    assert store.earlier_page("c1") == ("t3", "m3")
+
+    store.prepend_messages("c1", [{"message_id": "m1", "conversation_id": "c1"}, {"message_id": "m2", "conversation_id": "c1"}])
+    assert [m["message_id"] for m in store.messages("c1")] == ["m1", "m2", "m3", "m4"]
+    assert store.earlier_page("c1") is None
+
+    # Rows added by the session carry user_/assistant_ prefixes: one exchange, one message
+    assert store.add_message({"conversation_id": "c1", "message_id": "user_m5", "prompt": "q5"}, merge=True)
+    assert not store.add_message({"conversation_id": "c1", "message_id": "assistant_m5", "completion": "a5"}, merge=True)
+    assert not store.add_message({"conversation_id": "c1", "message_id": "m5", "completion": "from db"})   # sync: known
+    assert store.message("m5")["completion"] == "a5" and store.message("m5")["prompt"] == "q5"
+
+    version = store.version("c1")
+    assert store.update_message("assistant_m3", rating="POSITIVE")["rating"] == "POSITIVE"
+    assert store.version("c1") == version + 1 and store.update_message("nope", rating="x") is None
+
+    store.add_conversations([{"conversation_id": "c1"}])
+    store.remove_conversation("c1")
+    assert store.message("m3") is None and store.messages("c1") == []
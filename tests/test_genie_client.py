@@ -109,3 +109,201 @@ def test_wait_for_message_completion_polls_until_complete(MockWorkspace, monkeyp
 
     finished = gc.wait_for_message_completion("conv", "msg", timeout=5, poll_interval=0)
     assert finished.get("status") == "COMPLETED"
+
+@patch("modules.WorkspaceClient")
+def test_client_registry_reuses_and_evicts(MockWorkspace, monkeypatch):
+    from modules import GenieClientRegistry
+    registry = GenieClientRegistry(max_clients=2, ttl_seconds=60)
+
+    # Same (host, token, space_id) returns the same warm client
+    c1 = registry.get("h", "space-1", "tok")
+    assert registry.get("h", "space-1", "tok") is c1
+    assert registry.get("h", "space-1", "rotated-tok") is not c1
+
+    # LRU: a third key evicts the least recently used one
+    registry.get("h", "space-2", "tok")
+    assert len(registry) == 2
+    assert registry.get("h", "space-1", "tok") is not c1
+
+    # TTL: idle clients are rebuilt after expiry
+    c2 = registry.get("h", "space-2", "tok")
+    now = __import__("time").monotonic()
+    monkeypatch.setattr("modules.time.monotonic", lambda: now + 120)
+    assert registry.get("h", "space-2", "tok") is not c2
+
+@patch("modules.WorkspaceClient")
+def test_wait_for_message_completion_adaptive_backoff_records_metrics(MockWorkspace, monkeypatch):
+    from modules import GenieClient, PollingStrategy, PollMetrics
+    metrics = PollMetrics()
+    polling = PollingStrategy(initial_interval=0.25, max_interval=4, multiplier=2, jitter=0)
+    gc = GenieClient(host="h", space_id="s", token="t", polling=polling, poll_metrics=metrics)
+
+    gc.get_message = MagicMock(side_effect=[
+        {"status": "ASKING_AI"},
+        {"status": "ASKING_AI"},
+        {"status": "ASKING_AI"},
+        {"status": "EXECUTING_QUERY"},
+        {"status": "COMPLETED", "attachments": []}
+    ])
+    sleeps = []
+    monkeypatch.setattr("modules.time.sleep", sleeps.append)
+
+    finished = gc.wait_for_message_completion("conv", "msg", timeout=60)
+    assert finished["status"] == "COMPLETED"
+
+    # Exponential growth, restarted when the status changes
+    assert sleeps == [0.25, 0.5, 1.0, 0.25]
+    record = metrics.records()[-1]
+    assert record["polls"] == 5
+    assert record["wait_seconds"] == sum(sleeps)
+    assert metrics.summary()["count"] == 1
+
+def test_polling_strategy_caps_and_status_hints():
+    from modules import PollingStrategy
+    polling = PollingStrategy(initial_interval=0.5, max_interval=5, multiplier=2, jitter=0)
+    assert polling.next_interval(0) == 0.5
+    assert polling.next_interval(10) == 5
+    assert polling.next_interval(10, "EXECUTING_QUERY") == PollingStrategy.DEFAULT_STATUS_HINTS["EXECUTING_QUERY"]
+
+    jittered = PollingStrategy(initial_interval=1, jitter=0.2)
+    assert all(0.8 <= jittered.next_interval(0) <= 1.2 for _ in range(50))
+
+@patch("modules.WorkspaceClient")
+def test_sync_wrapper_drives_async_conversation(MockWorkspace, monkeypatch):
+    mock_ws = MagicMock()
+    MockWorkspace.return_value = mock_ws
+
+    import genie_room
+    persisted = []
+    monkeypatch.setattr(genie_room, "persist_message", lambda *args: persisted.append(args))
+
+    # create_message returns immediately, completion is polled asynchronously
+    mock_ws.genie.create_message.return_value.response = SimpleNamespace(
+        message_id="msg-2", user_id="user-1", created_timestamp=1_700_000_000_000, attachments=[]
+    )
+    mock_ws.genie.get_message.side_effect = [
+        SimpleNamespace(as_dict=lambda: {"status": "ASKING_AI"}),
+        SimpleNamespace(as_dict=lambda: {"status": "COMPLETED", "content": "Hello!", "attachments": []}),
+    ]
+
+    result, query_text, message_id, description = genie_room.continue_conversation(
+        "conv-1", "Hi", "tok-async", "space-async", "/path", "cat", "sch"
+    )
+    assert result == "Hello!"
+    assert message_id == "msg-2"
+    assert len(persisted) == 1
+    mock_ws.genie.create_message.return_value.result.assert_not_called()
+
+def test_fetch_json_chunks_concurrent_and_ordered():
+    import asyncio
+    import genie_room
+
+    class FakeAsyncClient:
+        def __init__(self):
+            self.in_flight = self.max_in_flight = 0
+
+        async def get_chunk(self, statement_id, idx):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.01 * (5 - idx))  # Later chunks arrive first
+            self.in_flight -= 1
+            return SimpleNamespace(data_array=[[str(idx), f"row-{idx}"]])
+
+    stmt = SimpleNamespace(
+        manifest=SimpleNamespace(total_chunk_count=5),
+        result=SimpleNamespace(data_array=[["0", "row-0"]])
+    )
+    client = FakeAsyncClient()
+    df = asyncio.run(genie_room.fetch_json_chunks(client, "stmt-1", stmt, ["idx", "value"], max_concurrency=2))
+
+    assert list(df["idx"]) == ["0", "1", "2", "3", "4"]
+    assert client.max_in_flight == 2
+
+def test_fetch_external_chunks_refreshes_expired_links_and_keeps_order():
+    import asyncio
+    import requests
+    import pandas as pd
+    import genie_room
+
+    def link(idx, url, expiration="2999-01-01T00:00:00Z"):
+        return SimpleNamespace(chunk_index=idx, external_link=url, http_headers=None, expiration=expiration)
+
+    class FakeAsyncClient:
+        refreshed = []
+
+        async def get_chunk(self, statement_id, idx):
+            self.refreshed.append(idx)
+            return SimpleNamespace(external_links=[link(idx, f"fresh-{idx}")])
+
+    downloads = []
+
+    def fake_download(url, headers=None):
+        downloads.append(url)
+        if url == "stale-2":  # Expires mid-download: presigned URL answers 403
+            response = SimpleNamespace(status_code=403)
+            raise requests.HTTPError("expired", response=response)
+        return pd.DataFrame({"url": [url]})
+
+    stmt = SimpleNamespace(
+        manifest=SimpleNamespace(total_chunk_count=3),
+        result=SimpleNamespace(external_links=[link(0, "inline-0")])
+    )
+    client = FakeAsyncClient()
+
+    # Chunk 1 needs a link, chunk 2 gets a stale one that fails on download
+    original_get_chunk = client.get_chunk
+    async def get_chunk(statement_id, idx):
+        if idx == 2 and idx not in client.refreshed:
+            client.refreshed.append(idx)
+            return SimpleNamespace(external_links=[link(idx, "stale-2")])
+        return await original_get_chunk(statement_id, idx)
+    client.get_chunk = get_chunk
+
+    df = asyncio.run(genie_room.fetch_external_chunks(client, "stmt", stmt, download=fake_download))
+    assert list(df["url"]) == ["inline-0", "fresh-1", "fresh-2"]
+    assert "stale-2" in downloads
+
+def test_read_arrow_stream_keeps_types():
+    import pyarrow as pa
+    import pandas as pd
+    from io import BytesIO
+    import genie_room
+
+    table = pa.table({"year": pa.array([2020, 2021], pa.int32()), "region": ["EMEA", "NA"]})
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    df = genie_room.read_arrow_stream(BytesIO(sink.getvalue().to_pybytes()))
+    assert list(df["year"]) == [2020, 2021]
+    assert df["year"].dtype == pd.ArrowDtype(pa.int32())
+
+def test_build_typed_dataframe_uses_schema_types():
+    import pandas as pd
+    import genie_room
+
+    schema_columns = [
+        {"name": "model_year", "type_name": "INT"},
+        {"name": "price", "type_name": "DECIMAL", "type_precision": 10, "type_scale": 2},
+        {"name": "big_id", "type_name": "LONG"},
+        {"name": "region", "type_name": "STRING"},
+        {"name": "sold_on", "type_name": "DATE"},
+        {"name": "active", "type_name": "BOOLEAN"},
+    ]
+    regions = ["EMEA", "NA"]
+    data_array = [
+        [str(2020 + i % 5), f"{i}.25", str(9007199254740993 + i) if i else None, regions[i % 2], "2024-01-31", "true"]
+        for i in range(200)
+    ]
+
+    df = genie_room.build_typed_dataframe(data_array, schema_columns)
+    assert df["model_year"].dtype == "int16"
+    assert df["price"].dtype == "float64"
+    assert df["big_id"].dtype == "Int64" and df["big_id"].iloc[1] == 9007199254740994  # No float precision loss
+    assert df["region"].dtype == "category"
+    assert pd.api.types.is_datetime64_any_dtype(df["sold_on"])
+    assert df["active"].dtype == "boolean"
+
+    # Unparseable values keep the raw strings instead of becoming nulls
+    df = genie_room.build_typed_dataframe([["n/a"], ["3"]], [{"name": "c", "type_name": "INT"}])
+    assert list(df["c"]) == ["n/a", "3"]
@@ -0,0 +1,375 @@
+# pytest -q tests/test_offline_queue.py --> runs offline queue tests
+
+import sys
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, MagicMock
+
+# Ensure parent directory matches modules location
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+def test_sqlite_queue_batches_in_order(tmp_path, monkeypatch):
+    monkeypatch.delenv("DATABRICKS_RUNTIME_VERSION", raising=False)
+    from modules import OfflineQueue
+    queue = OfflineQueue(sqlite_file=str(tmp_path / "fallback.db"))
+
+    queue.enqueue({"operation": "insert_message", "n": 0})
+    queue.enqueue_many([{"operation": "insert_message", "n": n} for n in range(1, 5)])
+    assert len(queue) == 5
+    assert [item["n"] for item in queue.peek(2)] == [0, 1]
+    assert len(queue) == 5   # peek does not remove
+
+    assert [item["n"] for item in queue.dequeue_batch(3)] == [0, 1, 2]
+    assert queue.dequeue()["n"] == 3
+    assert [item["n"] for item in queue.dequeue_batch(10)] == [4]
+    assert queue.dequeue() is None and queue.dequeue_batch(5) == []
+
+    mode = sqlite3.connect(str(tmp_path / "fallback.db")).execute("PRAGMA journal_mode").fetchone()[0]
+    assert mode == "wal"
+    queue.close()
+
+def test_sqlite_queue_concurrent_writers_and_reader(tmp_path, monkeypatch):
+    monkeypatch.delenv("DATABRICKS_RUNTIME_VERSION", raising=False)
+    from modules import OfflineQueue
+    queue = OfflineQueue(sqlite_file=str(tmp_path / "fallback.db"))
+
+    def writer(w):
+        for n in range(50):
+            queue.enqueue({"writer": w, "n": n})
+    threads = [threading.Thread(target=writer, args=(w,)) for w in range(8)]
+    for t in threads:
+        t.start()
+    drained = []
+    while any(t.is_alive() for t in threads) or len(queue):
+        drained.extend(queue.dequeue_batch(25))
+    for t in threads:
+        t.join()
+
+    assert len(drained) == 400
+    # Per writer, items come out in the order they went in
+    for w in range(8):
+        assert [item["n"] for item in drained if item["writer"] == w] == list(range(50))
+    queue.close()
+
+def test_segment_log_rotates_checkpoints_and_compacts(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABRICKS_RUNTIME_VERSION", "15.4")
+    from modules import OfflineQueue
+    (tmp_path / "1700000000.5.json").write_text('{"operation": "delete", "n": -1}')  # written by older versions
+
+    queue = OfflineQueue(dbfs_path=str(tmp_path))
+    queue._log.max_segment_bytes = 64
+    for n in range(10):
+        queue.enqueue({"operation": "insert_message", "n": n})
+    segments = sorted(p.name for p in tmp_path.glob("segment-*.jsonl"))
+    assert len(segments) > 2
+    assert not (tmp_path / "1700000000.5.json").exists()
+
+    assert [item["n"] for item in queue.peek(2)] == [-1, 0]
+    assert [item["n"] for item in queue.dequeue_batch(6)] == [-1, 0, 1, 2, 3, 4]
+    assert len(queue) == 5
+
+    # A new queue (e.g. the reprocessor job) resumes from the checkpoint
+    resumed = OfflineQueue(dbfs_path=str(tmp_path))
+    assert [item["n"] for item in resumed.dequeue_batch(100)] == [5, 6, 7, 8, 9]
+    assert resumed.dequeue() is None
+    assert len(list(tmp_path.glob("segment-*.jsonl"))) == 1   # read segments are compacted away
+
+def test_sqlite_claims_are_leased_acked_and_expire(tmp_path, monkeypatch):
+    monkeypatch.delenv("DATABRICKS_RUNTIME_VERSION", raising=False)
+    from modules import OfflineQueue
+    a = OfflineQueue(sqlite_file=str(tmp_path / "fallback.db"), owner="a")
+    b = OfflineQueue(sqlite_file=str(tmp_path / "fallback.db"), owner="b")
+    a.enqueue_many([{"operation": "insert_message", "n": n} for n in range(5)])
+
+    claimed_a = a.claim(2)
+    assert [item["n"] for item in claimed_a] == [0, 1]
+    assert [item["n"] for item in b.claim(2)] == [2, 3]      # leased items are hidden from other consumers
+    a.ack(claimed_a[:1])
+    a.release(claimed_a[1:])
+    assert len(a) == 4
+    assert [item["n"] for item in b.claim(5)] == [1, 4]
+
+    # b dies: once its leases expire, a claims everything b held
+    now = time.time()
+    monkeypatch.setattr("modules.time.time", lambda: now + OfflineQueue.LEASE_SECONDS + 1)
+    claimed = a.claim(10)
+    assert [item["n"] for item in claimed] == [1, 2, 3, 4]
+    a.retry(claimed[:1], "boom")                              # retried in place, lease released
+    a.ack(claimed[1:])
+    [item] = a.peek(10)
+    assert item["n"] == 1 and item["attempts"] == 1 and len(a) == 1
+    a.close()
+    b.close()
+
+def test_segment_log_leases_segments_to_one_consumer(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABRICKS_RUNTIME_VERSION", "15.4")
+    from modules import OfflineQueue
+    a = OfflineQueue(dbfs_path=str(tmp_path), owner="a")
+    b = OfflineQueue(dbfs_path=str(tmp_path), owner="b")
+    a._log.max_segment_bytes = 1
+    a.enqueue_many([{"operation": "insert_message", "n": n} for n in range(2)])
+    a.enqueue_many([{"operation": "insert_message", "n": n} for n in range(2, 4)])
+    assert len(list(tmp_path.glob("segment-*.jsonl"))) == 2
+
+    claimed_a = a.claim(1)
+    assert [item["n"] for item in claimed_a] == [0]
+    assert [item["n"] for item in b.claim(10)] == [2, 3]     # segment 0 is leased to a
+    a.ack(claimed_a)
+    assert [item["n"] for item in a.claim(10)] == [1]        # a resumes after its acked offset
+
+    # Both stop without acking: their segments go to another consumer once the leases expired
+    now = time.time()
+    monkeypatch.setattr("modules.time.time", lambda: now + OfflineQueue.LEASE_SECONDS + 1)
+    c = OfflineQueue(dbfs_path=str(tmp_path), owner="c")
+    claimed_c = c.claim(10)
+    assert [item["n"] for item in claimed_c] == [1, 2, 3]
+    c.ack(claimed_c)
+    assert len(c) == 0 and c.claim(10) == []
+    assert len(list(tmp_path.glob("segment-*.jsonl"))) == 1   # only the active segment is kept
+
+def test_segment_log_skips_items_not_due_in_place(tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABRICKS_RUNTIME_VERSION", "15.4")
+    from modules import OfflineQueue
+    queue = OfflineQueue(dbfs_path=str(tmp_path))
+    later = time.time() + 3600
+    queue.enqueue_many([{"operation": "insert_message", "n": 0, "next_attempt_at": later}, {"operation": "insert_message", "n": 1},
+                        {"operation": "insert_message", "n": 2, "next_attempt_at": later}])
+    size = sum(p.stat().st_size for p in tmp_path.glob("segment-*.jsonl"))
+
+    [item] = queue.claim(10)
+    assert item["n"] == 1
+    queue.ack([item])
+    assert queue.claim(10) == [] and len(queue) == 2
+    assert sum(p.stat().st_size for p in tmp_path.glob("segment-*.jsonl")) == size   # not moved to the end
+
+    # Counts only read what was appended since the last count
+    queue.enqueue({"operation": "insert_message", "n": 3})
+    assert len(queue) == 3
+
+    # Once due they come back in their original order
+    monkeypatch.setattr("modules.time.time", lambda: later + 1)
+    claimed = queue.claim(10)
+    assert [item["n"] for item in claimed] == [0, 2, 3]
+    queue.ack(claimed)
+    assert len(queue) == 0
+
+def test_compaction_removes_redundant_items(tmp_path, monkeypatch):
+    items = [
+        {"operation": "insert_new_conversation", "conversation_id": "c1", "message_id": "m1"},
+        {"operation": "update_rating", "conversation_id": "c2", "message_id": "m2", "rating": "POSITIVE"},
+        {"operation": "update_title", "conversation_id": "c1", "ai_title": "t"},
+        {"operation": "update_rating", "conversation_id": "c2", "message_id": "m2", "rating": "NEGATIVE"},
+        {"operation": "insert_message", "conversation_id": "c2", "message_id": "m3"},
+        {"operation": "insert_message", "conversation_id": "c2", "message_id": "m3"},
+        {"operation": "delete", "conversation_id": "c1"},
+        {"operation": "update_rating", "conversation_id": "c2", "message_id": "m2", "rating": "NONE"},
+    ]
+    monkeypatch.delenv("DATABRICKS_RUNTIME_VERSION", raising=False)
+    from modules import OfflineQueue
+    queue = OfflineQueue(sqlite_file=str(tmp_path / "fallback.db"))
+    queue.enqueue_many(items)
+    leased = queue.claim(1)                                   # leased items are not compacted
+    assert queue.compact() == {"duplicates": 1, "ratings": 2, "deleted": 1}
+    assert [item["operation"] for item in queue.peek(10)] == ["insert_new_conversation", "insert_message", "delete", "update_rating"]
+    assert queue.peek(10)[-1]["rating"] == "NONE"
+    queue.ack(leased)
+    queue.close()
+
+    # A free rating older than a leased one is dropped, the newest (free) one is kept even though it equals the oldest
+    a = OfflineQueue(sqlite_file=str(tmp_path / "ratings.db"), owner="a")
+    b = OfflineQueue(sqlite_file=str(tmp_path / "ratings.db"), owner="b")
+    a.enqueue_many([dict(items[1], rating=rating) for rating in ("POSITIVE", "NEGATIVE", "POSITIVE")])
+    oldest, leased = b.claim(2)
+    b.release([oldest])
+    assert a.compact() == {"duplicates": 0, "ratings": 1, "deleted": 0}
+    assert [item["rating"] for item in a.peek(10)] == ["NEGATIVE", "POSITIVE"]
+    a.close()
+    b.close()
+
+    monkeypatch.setenv("DATABRICKS_RUNTIME_VERSION", "15.4")
+    log_queue = OfflineQueue(dbfs_path=str(tmp_path / "log"))
+    log_queue.enqueue_many(items)
+    size = sum(p.stat().st_size for p in (tmp_path / "log").glob("segment-*.jsonl"))
+    assert log_queue.compact() == {"duplicates": 1, "ratings": 2, "deleted": 2}
+    assert sum(p.stat().st_size for p in (tmp_path / "log").glob("segment-*.jsonl")) == size   # nothing rewritten
+    assert len(log_queue) == 3
+    assert [item["operation"] for item in log_queue.dequeue_batch(10)] == ["insert_message", "delete", "update_rating"]
+    assert log_queue.compact() == {"duplicates": 0, "ratings": 0, "deleted": 0}
+
+def test_compaction_keeps_every_sql_run_increment(tmp_path, monkeypatch):
+    from modules import OfflineQueue
+    runs = [{"operation": "increment_sql_run_version", "message_id": "m1"}] * 3
+    monkeypatch.delenv("DATABRICKS_RUNTIME_VERSION", raising=False)
+    queue = OfflineQueue(sqlite_file=str(tmp_path / "fallback.db"))
+    queue.enqueue_many(runs + [{"operation": "insert_message", "message_id": "m2"}] * 2)
+    assert queue.compact() == {"duplicates": 1, "ratings": 0, "deleted": 0}
+    assert [item["operation"] for item in queue.dequeue_batch(10)].count("increment_sql_run_version") == 3
+    queue.close()
+
+    monkeypatch.setenv("DATABRICKS_RUNTIME_VERSION", "15.4")
+    log_queue = OfflineQueue(dbfs_path=str(tmp_path / "log"))
+    log_queue.enqueue_many(runs)
+    assert log_queue.compact() == {"duplicates": 0, "ratings": 0, "deleted": 0}
+    assert len(log_queue.dequeue_batch(10)) == 3
+
+@patch("db_offline_queue.sql.connect")
+def test_reprocess_applies_one_merge_per_operation_and_isolates_bad_items(mock_connect, tmp_path, monkeypatch):
+    monkeypatch.delenv("DATABRICKS_RUNTIME_VERSION", raising=False)
+    from modules import OfflineQueue
+    import db_offline_queue
+    cursor = MagicMock()
+    mock_connect.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value = cursor
+    def execute(statement, params=None):
+        if params and "bad" in params:
+            raise RuntimeError("constraint violation")
+    cursor.execute.side_effect = execute
+
+    queue = OfflineQueue(sqlite_file=str(tmp_path / "fallback.db"))
+    queue.enqueue_many(
+        [{"operation": "delete", "conversation_id": "c9"}]
+        + [{"operation": "update_rating", "message_id": f"m{n}", "rating": "GenieFeedbackRating.POSITIVE"} for n in range(3)]
+        + [{"operation": "update_title", "conversation_id": c, "ai_title": "t"} for c in ("c1", "bad")]
+    )
+    db_offline_queue.reprocess_offline_queue(queue, "host", "tok", "/path", "cat", "sch", batch_size=2)
+
+    statements = [c.args[0] for c in cursor.execute.call_args_list]
+    assert sum("SET t.rating" in st for st in statements) == 2      # 3 ratings over batches of 2
+    # First batch is (delete, rating): the delete runs after the rating
+    assert "SET t.rating" in statements[0] and "DELETE FROM cat.sch.messages" in statements[1]
+    assert mock_connect.call_count == 1
+    # Only the bad item went back to the queue, with its retry counted and scheduled later
+    assert queue.dequeue_batch(10) == []
+    [item] = queue.peek(10)
+    assert item["conversation_id"] == "bad" and item["attempts"] == 1 and item["next_attempt_at"] > time.time()
+    queue.close()
+
+class FakeWarehouse:
+    """Cursor over in-memory conversations/messages tables: applies the insert MERGEs (current_timestamp() is the
+    warehouse clock) and answers the history delta selects, filtering on the column they name."""
+    def __init__(self, now):
+        from modules import PersistenceStatements
+        self.now, self.tables, self.description, self.rows = now, {"conversations": {}, "messages": {}}, [], []
+        self.columns = {"conversations": ["space_id", "conversation_id", "user_id", "chat_title", "ai_title", "created_timestamp"],
+                        "messages": PersistenceStatements.MESSAGE_COLUMNS}
+
+    def execute(self, statement, params=()):
+        if "deleted_conversations" in statement:
+            raise RuntimeError("TABLE_OR_VIEW_NOT_FOUND")
+        table = "conversations" if ".conversations" in statement else "messages"
+        if statement.lstrip().startswith("MERGE"):
+            cols = self.columns[table]
+            for i in range(0, len(params), len(cols)):
+                row = dict(zip(cols, params[i:i + len(cols)]))
+                if "current_timestamp()" in statement:
+                    row["updated_timestamp"] = self.now
+                self.tables[table].setdefault(row[cols[1] if table == "conversations" else cols[0]], row)
+            return
+        column = re.search(r"AND (\w+) > \?", statement).group(1)
+        select = [c.strip().split()[-1] for c in re.search(r"SELECT (.*?)\s+FROM", statement, re.S).group(1).split(",")]
+        rows = [r for r in self.tables[table].values() if r.get(column) and r[column] > params[2]]
+        self.description = [(c,) for c in select]
+        self.rows = [tuple(r.get("chat_title") if c == "title" else r.get(c) for c in select) for r in rows]
+
+    def fetchall(self):
+        return self.rows
+
+@patch("db_offline_queue.sql.connect")
+def test_rows_drained_late_appear_in_the_next_history_delta(mock_connect, tmp_path, monkeypatch):
+    monkeypatch.delenv("DATABRICKS_RUNTIME_VERSION", raising=False)
+    from modules import OfflineQueue, history_delta
+    import db_offline_queue
+    synced_at = datetime(2026, 10, 16, 12, 0, tzinfo=timezone.utc)
+    warehouse = FakeWarehouse(now=synced_at + timedelta(seconds=30))
+    mock_connect.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value = warehouse
+
+    # Written while the warehouse was down, hours before the last sync
+    created = (synced_at - timedelta(hours=3)).isoformat()
+    queue = OfflineQueue(sqlite_file=str(tmp_path / "fallback.db"))
+    queue.enqueue({"operation": "insert_new_conversation", "space_id": "s", "conversation_id": "c1", "user_id": "u",
+                   "chat_title": "Late chat", "message_id": "m1", "prompt": "q", "completion": "a",
+                   "user_attachment": None, "assistant_attachment": None, "created_timestamp": created})
+    assert db_offline_queue.reprocess_offline_queue(queue, "host", "tok", "/path", "cat", "sch")
+
+    conversations, messages, deleted = history_delta(warehouse, "cat", "sch", "s", "u", synced_at)
+    assert [c["conversation_id"] for c in conversations] == ["c1"] and conversations[0]["title"] == "Late chat"
+    assert [m["message_id"] for m in messages] == ["m1"]
+    assert deleted == []   # no tombstone table: deletes are left out, the rest still syncs
+    queue.close()
+
+@patch("db_offline_queue.sql.connect")
+def test_drains_one_after_the_other_release_segment_leases(mock_connect, tmp_path, monkeypatch):
+    monkeypatch.setenv("DATABRICKS_RUNTIME_VERSION", "15.4")
+    from modules import OfflineQueue
+    import db_offline_queue
+    cursor = MagicMock()
+    mock_connect.return_value.__enter__.return_value.cursor.return_value.__enter__.return_value = cursor
+    a = OfflineQueue(dbfs_path=str(tmp_path), owner="a")
+    b = OfflineQueue(dbfs_path=str(tmp_path), owner="b")
+
+    a.enqueue_many([{"operation": "update_title", "conversation_id": f"c{n}", "ai_title": "t"} for n in range(3)])
+    assert db_offline_queue.reprocess_offline_queue(a, "host", "tok", "/path", "cat", "sch")
+    assert list(tmp_path.glob("*.lease")) == []
+
+    # The next drain, by another consumer, doesn't wait for a's leases to expire
+    a.enqueue_many([{"operation": "update_title", "conversation_id": f"c{n}", "ai_title": "t2"} for n in range(3, 5)])
+    assert db_offline_queue.reprocess_offline_queue(b, "host", "tok", "/path", "cat", "sch")
+    assert len(b) == 0 and len(a) == 0
+    assert cursor.execute.call_count == 2
+    assert list(tmp_path.glob("*.lease")) == []
+
+def test_retry_backoff_skips_items_not_due_and_dead_letters(tmp_path, monkeypatch):
+    monkeypatch.delenv("DATABRICKS_RUNTIME_VERSION", raising=False)
+    from modules import OfflineQueue
+    queue = OfflineQueue(sqlite_file=str(tmp_path / "fallback.db"))
+    queue.enqueue_many([{"operation": "insert_message", "n": n} for n in range(3)])
+
+    first, second, third = queue.dequeue_batch(3)
+    queue.retry([first], "boom", max_retries=2)
+    queue.enqueue(second)                               # put back untouched: keeps its place
+    assert [item["n"] for item in queue.dequeue_batch(5)] == [1]   # item 0 is not due yet
+
+    # Time passes: item 0 is due again, keeps its original position and backs off longer each time
+    now = time.time()
+    monkeypatch.setattr("modules.time.time", lambda: now + 3600)
+    [item] = queue.dequeue_batch(5)
+    assert item["n"] == 0 and item["attempts"] == 1
+    assert queue.retry_delay(3) > queue.retry_delay(1) * 3
+
+    queue.retry([item], "boom", max_retries=2)
+    monkeypatch.setattr("modules.time.time", lambda: now + 7200)
+    [item] = queue.dequeue_batch(5)
+    assert queue.retry([item], "still boom", max_retries=2) == 1
+    assert len(queue) == 0
+    assert [(d["n"], d["attempts"], d["last_error"]) for d in queue.dead_letters()] == [(0, 3, "still boom")]
+    queue.close()
+
+def test_drain_scheduler_backs_off_and_holds_a_process_lock(tmp_path):
+    from modules import DrainScheduler
+    results = [False, False, True, True]
+    runs = []
+    def drain():
+        runs.append(time.monotonic())
+        if len(runs) == 2:
+            raise RuntimeError("warehouse down")
+        return results[min(len(runs), len(results)) - 1]
+
+    lock_file = str(tmp_path / "drain.lock")
+    holder = DrainScheduler(drain, lock_file=lock_file)      # another process draining
+    assert holder._acquire()
+    scheduler = DrainScheduler(drain, interval=0.01, max_interval=0.05, lock_file=lock_file).start()
+    time.sleep(0.2)
+    assert runs == []                                        # the lock keeps a single drainer
+    holder.stop()
+    deadline = time.monotonic() + 5
+    while len(runs) < 4 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    scheduler.stop()
+
+    stats = scheduler.stats()
+    assert stats["runs"] >= 4 and stats["failures"] == 2 and stats["consecutive_failures"] == 0
+    assert not stats["locked"] and not scheduler._thread.is_alive()
+    assert runs[2] - runs[1] >= 0.03                         # backed off (0.01 * 2**2, jittered) after two failures
@@ -0,0 +1,117 @@
+# pytest -q tests/test_persistence_writer.py --> runs write-behind persistence tests
+
+import sys
+import os
+import threading
+from unittest.mock import MagicMock
+
+# Ensure parent directory matches modules location
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+def test_writer_batches_per_key_and_hands_failures_to_fallback():
+    from modules import PersistenceWriter
+    written, failed = [], []
+    def write(key, events):
+        if key == "bad":
+            raise RuntimeError("warehouse down")
+        written.append((key, [e["n"] for e in events]))
+
+    writer = PersistenceWriter(write, lambda key, events, err: failed.extend(events), max_batch=3, flush_interval=60)
+    for n in range(4):
+        writer.submit("messages", {"n": n})
+    writer.submit("bad", {"n": 9})
+    assert writer.flush(timeout=5)
+
+    assert written == [("messages", [0, 1, 2]), ("messages", [3])]   # size trigger, then the flush
+    assert failed == [{"n": 9}]
+    stats = writer.stats()
+    assert stats["depth"] == 0 and stats["events"] == 4 and stats["failed_events"] == 1 and stats["batches"] == 3
+
+    # Time trigger and stop
+    done = threading.Event()
+    writer.write = lambda key, events: done.set()
+    writer.flush_interval = 0.05
+    writer.submit("messages", {"n": 10})
+    assert done.wait(5)
+    writer.stop()
+
+def test_writer_writes_lower_ranked_batches_first():
+    from modules import PersistenceWriter, PersistenceStatements
+    written = []
+    writer = PersistenceWriter(lambda key, events: written.append(key), lambda key, events, err: None,
+                               max_batch=2, flush_interval=60, order=PersistenceStatements.rank)
+    writer.submit("increment_sql_run_version", {})
+    writer.submit("insert_message", {})
+    writer.submit("update_rating", {})
+    writer.submit("increment_sql_run_version", {})   # full batch: the inserts and ratings it may update go first
+    writer.submit("delete", {})
+    assert writer.flush(timeout=5)
+    assert written == ["insert_message", "update_rating", "increment_sql_run_version", "delete"]
+    writer.stop()
+
+def test_write_batch_builds_multi_row_statements(monkeypatch):
+    import genie_room
+    cursor = MagicMock()
+    conn = MagicMock()
+    conn.cursor.return_value.__enter__.return_value = cursor
+    pool = MagicMock()
+    pool.connection.return_value.__enter__.return_value = conn
+    monkeypatch.setattr(genie_room, "sql_pool", pool)
+
+    # Ratings: one MERGE, last rating per message wins
+    ratings = [{"message_id": "m1", "rating": "POSITIVE"}, {"message_id": "m2", "rating": "NEGATIVE"}, {"message_id": "m1", "rating": "NEGATIVE"}]
+    genie_room.write_batch(("update_rating", "/path", "tok", "cat", "sch"), ratings)
+    statement, params = cursor.execute.call_args.args
+    assert "MERGE INTO cat.sch.messages" in statement
+    assert params == ["m1", "NEGATIVE", "m2", "NEGATIVE"]
+
+    # Messages: split so each statement stays under the bound parameter limit, inserted only if missing
+    from modules import PersistenceStatements
+    cursor.reset_mock()
+    message = {"conversation_id": "c", "space_id": "s", "user_id": "u", "prompt": "p", "completion": "c",
+               "user_attachment": None, "assistant_attachment": None, "created_timestamp": "2025-01-01T00:00:00"}
+    genie_room.write_batch(("insert_message", "/path", "tok", "cat", "sch"), [dict(message, message_id=f"m{n}") for n in range(60)])
+    width = len(PersistenceStatements.MESSAGE_COLUMNS)
+    rows_per_statement = PersistenceStatements.MAX_PARAMS // width
+    assert cursor.execute.call_count == -(-60 // rows_per_statement)
+    statement, params = cursor.execute.call_args_list[0].args
+    assert "WHEN NOT MATCHED THEN INSERT" in statement
+    assert len(params) == rows_per_statement * width
+
+    # Deletes: messages, then a tombstone from the conversations row, then the conversations row
+    cursor.reset_mock()
+    genie_room.write_batch(("delete", "/path", "tok", "cat", "sch"), [{"conversation_id": "c1"}, {"conversation_id": "c1"}])
+    statements = [c.args[0] for c in cursor.execute.call_args_list]
+    assert "DELETE FROM cat.sch.messages" in statements[0]
+    assert "MERGE INTO cat.sch.deleted_conversations" in statements[1] and "FROM cat.sch.conversations" in statements[1]
+    assert "DELETE FROM cat.sch.conversations" in statements[2]
+    assert all(c.args[1] == ["c1"] for c in cursor.execute.call_args_list)
+
+    # Re-executions: one bump per message, counted
+    cursor.reset_mock()
+    genie_room.write_batch(("increment_sql_run_version", "/path", "tok", "cat", "sch"), [{"message_id": "m1"}, {"message_id": "m2"}, {"message_id": "m1"}])
+    statement, params = cursor.execute.call_args.args
+    assert "sql_run_version = coalesce(t.sql_run_version, 0) + s.runs" in statement
+    assert params == ["m1", 2, "m2", 1]
+
+def test_similarity_search_arrays_are_bound_not_interpolated():
+    import json
+    import pytest
+    from modules import PersistenceStatements
+    cursor = MagicMock()
+    search = {"space_id": "s", "user_id": "u", "user_name": "n", "user_email": "e", "prompt": "p", "created_timestamp": 1.0}
+    injected = "x'), ('boom"
+    PersistenceStatements("cat", "sch").similarity_searches(cursor, [
+        dict(search, message_id=["m1"], completion=[injected], score=[0.9]),
+        dict(search, created_timestamp=2.0, message_id="ARRAY('m2', 'm3')", completion="ARRAY('a', 'b')", score="ARRAY(0.5, 0.25)"),  # queued by older versions
+    ])
+    statement, params = cursor.execute.call_args.args
+    assert injected not in statement and "boom" not in statement
+    assert json.dumps([injected]) in params
+    legacy = params[9:]
+    assert json.loads(legacy[1]) == ["m2", "m3"] and json.loads(legacy[6]) == ["a", "b"] and json.loads(legacy[7]) == [0.5, 0.25]
+
+    with pytest.raises(ValueError):
+        PersistenceStatements("cat", "sch").similarity_searches(cursor, [dict(search, message_id="ARRAY('m'), (SELECT 1)", completion=[], score="ARRAY(1)")])
+    with pytest.raises(ValueError):
+        PersistenceStatements.array_values("ARRAY(1, current_user())", "FLOAT")